@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+
+class FrameEmbeddingStore:
+    """
+    On-disk store of the frame embeddings of every video, so that re-running the scoring (e.g. with other
+    prompt templates) skips decoding and the image tower.
+
+    Embeddings are keyed by (model, video path, FPS, preprocess config). Every video is a flat float16 memmap
+    `<key>.f16` of shape [num_frames, dim] plus a small `<key>.json` index. Both are written to temporary
+    files and renamed into place, the index last, so a video only counts as stored once it is complete.
+    """
+
+    def __init__(self, root, model_name, fps_target, preprocess_config):
+        self.root = root
+        self.model_name = model_name
+        self.fps_target = fps_target
+        self.preprocess_config = preprocess_config
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, video_path):
+        payload = json.dumps({
+            "model": self.model_name,
+            "video_path": video_path,
+            "fps_target": self.fps_target,
+            "preprocess": self.preprocess_config,
+        }, sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def _paths(self, video_path):
+        key = os.path.join(self.root, self.key(video_path))
+        return key + ".f16", key + ".json"
+
+    def __contains__(self, video_path):
+        return os.path.exists(self._paths(video_path)[1])
+
+    def load(self, video_path):
+        """Read-only [num_frames, dim] float16 memmap of the embeddings of a stored video."""
+        data_path, index_path = self._paths(video_path)
+        with open(index_path) as f:
+            index = json.load(f)
+        return np.memmap(data_path, dtype=np.float16, mode="r", shape=(index["num_frames"], index["dim"]))
+
+    def writer(self, video_path, num_frames, dim):
+        return FrameEmbeddingWriter(self, video_path, num_frames, dim)
+
+    def put(self, video_path, embeddings):
+        """Store all [num_frames, dim] embeddings of a video at once."""
+        writer = self.writer(video_path, *embeddings.shape)
+        writer.write(0, embeddings)
+        writer.finish()
+
+
+class FrameEmbeddingWriter:
+    """Fills the memmap of one video chunk by chunk; nothing is visible in the store before `finish`."""
+
+    def __init__(self, store, video_path, num_frames, dim):
+        self.store = store
+        self.video_path = video_path
+        self.num_frames = num_frames
+        self.dim = dim
+        self.data_path, self.index_path = store._paths(video_path)
+        # unique per writer, two rows of the same video can be in flight at once (one per DataLoader worker)
+        self.tmp_suffix = f"{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        self.tmp_path = f"{self.data_path}.{self.tmp_suffix}"
+        self.embeddings = np.memmap(self.tmp_path, dtype=np.float16, mode="w+", shape=(num_frames, dim))
+
+    def write(self, start, embeddings):
+        """Write [n, dim] embeddings (a numpy array or a torch tensor) of frames `start` to `start + n`."""
+        if not isinstance(embeddings, np.ndarray):
+            embeddings = embeddings.detach().cpu().numpy()
+        self.embeddings[start : start + embeddings.shape[0]] = embeddings
+
+    def finish(self):
+        self.embeddings.flush()
+        del self.embeddings
+        os.replace(self.tmp_path, self.data_path)
+
+        index = {
+            "model": self.store.model_name,
+            "video_path": self.video_path,
+            "fps_target": self.store.fps_target,
+            "preprocess": self.store.preprocess_config,
+            "num_frames": self.num_frames,
+            "dim": self.dim,
+            "dtype": "float16",
+        }
+        tmp_index_path = f"{self.index_path}.{self.tmp_suffix}"
+        with open(tmp_index_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_index_path, self.index_path)
+
+    def abort(self):
+        del self.embeddings
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
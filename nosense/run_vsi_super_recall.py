@@ -1,7 +1,10 @@
 import os
+import sys
+import json
+import subprocess
 import pandas as pd
 from PIL import Image
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 from decord import VideoReader, cpu
 from tqdm import tqdm
 from open_clip import create_model_from_pretrained, get_tokenizer
@@ -9,6 +12,11 @@ from torch.amp import autocast
 import torch
 import numpy as np
 from argparse import ArgumentParser
+from frame_embedding_store import FrameEmbeddingStore
+from text_embedding_table import TextEmbeddingTable
+from sharding import count_frames, balance_shards, merge_predictions
+from tensor_preprocess import TensorPreprocess, preprocess_output_size
+from video_reader import open_video_reader, sample_frame_indices, iter_frame_chunks
 
 # where to load the open-clip weights from
 try:
@@ -87,10 +95,14 @@ relation_templates = [
 
 # === DATASET ===
 class VideoFrameDataset(Dataset):
-    def __init__(self, parquet_path, videos_root, fps_target=1):
+    def __init__(self, parquet_path, videos_root, fps_target=1, embedding_store=None, rows=None, decode_size=None):
         self.df = pd.read_parquet(parquet_path)
+        if rows is not None:
+            self.df = self.df.iloc[rows]
         self.videos_root = videos_root
         self.fps_target = fps_target
+        self.embedding_store = embedding_store
+        self.decode_size = decode_size
 
     def __len__(self):
         return len(self.df)
@@ -98,32 +110,163 @@ class VideoFrameDataset(Dataset):
     def __getitem__(self, idx):
         row = self.df.iloc[idx]
         video_path = os.path.join(self.videos_root, row["video_path"])
+        meta = {
+            "video_path": str(row["video_path"]),
+            "question": str(row["question"]),
+            "answer": str(row["answer"]),
+            "options": list(row["options"]),
+            "row": int(row.name),
+        }
+
+        # the frame embeddings are on disk, no need to decode
+        if self.embedding_store is not None and str(row["video_path"]) in self.embedding_store:
+            return {"frames": None, "cached": True, "meta": meta}
 
         try:
-            vr = VideoReader(video_path, ctx=cpu(0))
-            native_fps = vr.get_avg_fps()
-            step = int(round(native_fps / self.fps_target))
+            vr = open_video_reader(video_path, self.decode_size)
 
-            # grab 1 FPS frames
-            frame_buffers = []
-            for i in range(0, len(vr), step):
-                frame = vr[i].asnumpy()
-                image = Image.fromarray(frame)
-                frame_buffers.append(image)
+            # grab 1 FPS frames, as one uint8 [T, H, W, C] array
+            frames = np.concatenate(list(iter_frame_chunks(vr, sample_frame_indices(vr, self.fps_target), 64)))
+            meta["num_frames"] = len(frames)
 
+            return {"frames": frames, "cached": False, "meta": meta}
+
+        except Exception as e:
+            # counted as a wrong prediction, like in the chunked mode
+            print(f"Error processing {video_path}: {e}")
+            return {"frames": None, "cached": False, "meta": meta}
+
+class VideoFrameChunkDataset(IterableDataset):
+    """
+    Streams the 1 FPS frames of every video as preprocessed chunks of `chunk_size` frames, so a worker never
+    holds more than one chunk of a video. Videos are split round-robin over the DataLoader workers, so chunks
+    of different videos interleave; every chunk carries the index of its video and the last one is flagged.
+    """
+    def __init__(self, parquet_path, videos_root, preprocess, fps_target=1, chunk_size=512, embedding_store=None, rows=None, tensor_preprocess=None, decode_size=None):
+        self.df = pd.read_parquet(parquet_path)
+        if rows is not None:
+            self.df = self.df.iloc[rows]
+        self.videos_root = videos_root
+        self.preprocess = preprocess
+        self.tensor_preprocess = tensor_preprocess
+        self.fps_target = fps_target
+        self.chunk_size = chunk_size
+        self.embedding_store = embedding_store
+        self.decode_size = decode_size
+
+    def __len__(self):
+        return len(self.df)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        for idx in range(worker_id, len(self.df), num_workers):
+            row = self.df.iloc[idx]
+            video_path = os.path.join(self.videos_root, row["video_path"])
             meta = {
                 "video_path": str(row["video_path"]),
                 "question": str(row["question"]),
                 "answer": str(row["answer"]),
                 "options": list(row["options"]),
-                "num_frames": len(frame_buffers),
+                "row": int(row.name),
             }
 
-            return {"frames": frame_buffers, "meta": meta}
-
-        except Exception as e:
-            print(f"Error processing {video_path}: {e}")
-            return None
+            # the frame embeddings are on disk, no need to decode
+            if self.embedding_store is not None and meta["video_path"] in self.embedding_store:
+                yield {"video_index": idx, "start": 0, "frames": None, "cached": True, "last": True, "meta": meta}
+                continue
+
+            try:
+                vr = open_video_reader(video_path, self.decode_size)
+
+                # grab 1 FPS frames, one chunk at a time
+                frame_indices = sample_frame_indices(vr, self.fps_target)
+                meta["num_frames"] = len(frame_indices)
+                for start, frames in zip(range(0, len(frame_indices), self.chunk_size), iter_frame_chunks(vr, frame_indices, self.chunk_size)):
+                    if self.tensor_preprocess is not None:
+                        images = self.tensor_preprocess(frames)
+                    else:
+                        images = torch.stack([self.preprocess(Image.fromarray(frame)) for frame in frames])
+                    last = start + self.chunk_size >= len(frame_indices)
+                    yield {"video_index": idx, "start": start, "frames": images, "cached": False, "last": last, "meta": meta}
+
+            except Exception as e:
+                print(f"Error processing {video_path}: {e}")
+                yield {"video_index": idx, "start": 0, "frames": None, "cached": False, "last": True, "meta": meta}
+
+def parse_object(question):
+    """The object of interest of a question."""
+    obj = question.replace("These are frames of a video.\nWhich of the following correctly represents the order in which", "")
+    obj = obj.replace("appeared in the video?", "")
+    obj = obj.replace("the ", "").strip()
+    return obj
+
+def parse_objects(options):
+    """All answer choice objects, in the order of the first option."""
+    return [x.strip() for x in options[0].replace("A. ", "").split(",")]
+
+def score_options(relation_scores, opts, objects):
+    """Per-option sums of the main object-sub-object scores of the top frames (in temporal order)."""
+    # get individual answer positions
+    ind_opt_positions = []
+    for opt in opts:
+        ind_objs = [x.strip() for x in opt.replace("A. ", "").replace("B. ", "").replace("C. ", "").replace("D. ", "").split(",")]
+        ind_objs_pos = [objects.index(x) for x in ind_objs]
+        ind_opt_positions.append(ind_objs_pos)
+
+    # get per-option score sums
+    opt_scores = []
+    for pos in ind_opt_positions:
+        pos_tensor = torch.tensor(pos, device=relation_scores.device)
+        # gather one score per frame according to option's ordering
+        ordered_scores = relation_scores[torch.arange(4), pos_tensor]
+        opt_scores.append(ordered_scores.sum().item())
+    return opt_scores
+
+def top_relation_scores(sims, k=4):
+    """Relation-score rows of the `k` frames most similar to the main object, in temporal order."""
+    obj_only_sims = sims[:, 0]
+
+    # get the top 4 cosine sims with the main object
+    top_values, top_indices = torch.topk(obj_only_sims, k=k, dim=0)
+
+    # get the top indices, sort them in ascending order and get the corresponding main object-sub-object scores
+    top_indices_sorted = torch.sort(top_indices).values
+    return sims[top_indices_sorted, 1:]
+
+def build_text_table(model, tokenizer, model_name, df, path, batch_size, device, read_only=False):
+    """Text table with the prompt and relation ensembles of every question of `df` encoded upfront."""
+    text_table = TextEmbeddingTable(model, tokenizer, model_name, prompt_templates, relation_templates, path, batch_size, device, read_only)
+    queries = [(parse_object(question), parse_objects(options)) for question, options in zip(df["question"], df["options"])]
+    text_table.build([obj for obj, _ in queries], [(obj, other_obj) for obj, objects in queries for other_obj in objects])
+    return text_table
+
+class StreamingTopK:
+    """
+    Running top-k of the frames of a video by their similarity to the main object, holding only the
+    relation-score rows and frame indices of the current top-k instead of every frame embedding.
+    """
+    def __init__(self, k=4):
+        self.k = k
+        self.values = None
+        self.indices = None
+        self.relation_scores = None
+
+    def update(self, sims, start):
+        indices = torch.arange(start, start + sims.size(0), device=sims.device)
+        values, relation_scores = sims[:, 0], sims[:, 1:]
+        if self.values is not None:
+            values = torch.cat([self.values, values])
+            indices = torch.cat([self.indices, indices])
+            relation_scores = torch.cat([self.relation_scores, relation_scores])
+        top_values, top = torch.topk(values, k=min(self.k, values.size(0)), dim=0)
+        self.values, self.indices, self.relation_scores = top_values, indices[top], relation_scores[top]
+
+    def sorted_relation_scores(self):
+        """Relation-score rows of the top-k frames, sorted by frame index."""
+        order = torch.argsort(self.indices)
+        return self.relation_scores[order]
 
 if __name__ == "__main__":
 
@@ -132,12 +275,76 @@ if __name__ == "__main__":
     parser.add_argument('--test_split', type=int, required=True, choices=[10, 30, 60, 120, 240])
     parser.add_argument('--gpu_bs', type=int, required=False, default=512)
     parser.add_argument('--data_root', type=str, required=False, default="./vsi-super-recall/")
+    parser.add_argument('--frame_chunk_size', type=int, required=False, default=0, help="decode, encode and rank frames in chunks of this many frames (0 decodes whole videos)")
+    parser.add_argument('--num_workers', type=int, required=False, default=2)
+    parser.add_argument('--embedding_store', type=str, required=False, default="", help="directory to store frame embeddings in and reuse them from in later runs")
+    parser.add_argument('--text_table', type=str, required=False, default="", help="file to store the text embeddings of the prompt and relation ensembles in")
+    parser.add_argument('--device', type=str, required=False, default="cuda")
+    parser.add_argument('--pil_preprocess', action="store_true", help="preprocess frames one PIL image at a time instead of as uint8 tensor batches")
+    parser.add_argument('--decode_downscale', action="store_true", help="let decord decode frames at just the size the preprocessing crops or resizes to")
+    parser.add_argument('--num_shards', type=int, required=False, default=1, help="split the test split over this many worker processes")
+    parser.add_argument('--devices', type=str, required=False, default="cuda", help="comma-separated devices the shards are assigned to round-robin, e.g. cuda:0,cuda:1 or cpu")
+    parser.add_argument('--shard_id', type=int, required=False, default=-1, help="set by the coordinator for its workers")
+    parser.add_argument('--output_dir', type=str, required=False, default="", help="directory to write per-sample predictions (and the shard assignment) to")
     args = parser.parse_args()
 
     parquet_path = f"{args.data_root}test_{args.test_split}mins.parquet"
+    if args.num_shards > 1 and not args.output_dir:
+        args.output_dir = f"./predictions_{args.model}_{args.test_split}mins"
+
+    # coordinator: balance the rows over the shards by frame count, run one worker per shard and merge their predictions
+    if args.num_shards > 1 and args.shard_id < 0:
+        df = pd.read_parquet(parquet_path)
+        args.num_shards = min(args.num_shards, len(df))
+        frame_counts = [count_frames(os.path.join(args.data_root, video_path), FPS_TARGET) for video_path in df["video_path"]]
+        shards = balance_shards(frame_counts, args.num_shards)
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "shards.json"), "w") as f:
+            json.dump({"rows": shards, "frames": [sum(frame_counts[row] for row in rows) for rows in shards]}, f)
+
+        devices = args.devices.split(",")
+
+        # the text table is built once over all rows and the workers only read it, so they never overwrite each other's entries
+        args.text_table = args.text_table or os.path.join(args.output_dir, "text_table.pt")
+        model, _ = create_model_from_pretrained(CLIP_MODELS[args.model], cache_dir=CACHE_DIR, device=devices[0])
+        model.eval()
+        with torch.inference_mode(), autocast(torch.device(devices[0]).type):
+            build_text_table(model, get_tokenizer(CLIP_MODELS[args.model], cache_dir=CACHE_DIR), args.model, df, args.text_table, args.gpu_bs, devices[0])
+        del model
+        if devices[0].startswith("cuda"):
+            torch.cuda.empty_cache()
+
+        workers = []
+        for shard_id in range(args.num_shards):
+            # later flags override the ones of the coordinator
+            cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--shard_id", str(shard_id), "--device", devices[shard_id % len(devices)], "--output_dir", args.output_dir, "--text_table", args.text_table]
+            workers.append(subprocess.Popen(cmd))
+        failed = [shard_id for shard_id, worker in enumerate(workers) if worker.wait() != 0]
+        assert len(failed) == 0, f"shards {failed} failed"
+
+        predictions = merge_predictions([os.path.join(args.output_dir, f"predictions_shard{shard_id}.jsonl") for shard_id in range(args.num_shards)], len(df))
+        with open(os.path.join(args.output_dir, "predictions.jsonl"), "w") as f:
+            for prediction in predictions:
+                f.write(json.dumps(prediction) + "\n")
+        correct = sum(prediction["correct"] for prediction in predictions)
+        total = len(predictions)
+        failed = sum(prediction.get("failed", False) for prediction in predictions)
+
+        print("Current model: {}".format(args.model))
+        print("Current test split: {}".format(args.test_split))
+        print("Accuracy: {}% (correct={}/total={})".format(100. * correct/total, correct, total))
+        if failed > 0:
+            print("Failed to decode the video of {} rows, counted as wrong predictions".format(failed))
+        sys.exit(0)
+
+    # rows of this worker, all rows without sharding
+    rows = None
+    if args.shard_id >= 0:
+        with open(os.path.join(args.output_dir, "shards.json")) as f:
+            rows = json.load(f)["rows"][args.shard_id]
 
     # load clip model
-    model, preprocess = create_model_from_pretrained(CLIP_MODELS[args.model], cache_dir=CACHE_DIR, device="cuda")
+    model, preprocess = create_model_from_pretrained(CLIP_MODELS[args.model], cache_dir=CACHE_DIR, device=args.device)
     tokenizer = get_tokenizer(CLIP_MODELS[args.model], cache_dir=CACHE_DIR)
     if torch.__version__ >= "2.0":
         try:
@@ -146,106 +353,211 @@ if __name__ == "__main__":
             raise e
     model.eval()
 
+    # batched tensor version of the preprocessing, if it supports the transforms of the model
+    tensor_preprocess = None
+    if not args.pil_preprocess:
+        try:
+            tensor_preprocess = TensorPreprocess.from_open_clip(preprocess)
+        except ValueError as e:
+            print(f"Falling back to PIL preprocessing: {e}")
+
+    # decode frames just large enough for the preprocessing
+    decode_size = preprocess_output_size(preprocess) if args.decode_downscale else None
+
+    # frame embeddings of earlier runs with the same model, FPS and preprocessing
+    embedding_store = None
+    if args.embedding_store:
+        preprocess_config = repr(preprocess) + (" (tensor)" if tensor_preprocess is not None else "") + (f" (decoded at {decode_size})" if decode_size is not None else "")
+        embedding_store = FrameEmbeddingStore(args.embedding_store, args.model, FPS_TARGET, preprocess_config)
+
     # get video dataloader
-    dataset = VideoFrameDataset(parquet_path, args.data_root, FPS_TARGET)
-    dataloader = DataLoader(
-        dataset,
-        batch_size=1,
-        num_workers=2,
-        pin_memory=True,
-        prefetch_factor=1,
-        collate_fn=lambda x: x[0],
-    )
+    if args.frame_chunk_size > 0:
+        # chunks are preprocessed in the workers, no batching on top of them
+        dataset = VideoFrameChunkDataset(parquet_path, args.data_root, preprocess, FPS_TARGET, args.frame_chunk_size, embedding_store, rows, tensor_preprocess, decode_size)
+        dataloader = DataLoader(
+            dataset,
+            batch_size=None,
+            num_workers=args.num_workers,
+            pin_memory=args.device.startswith("cuda"),
+            prefetch_factor=2 if args.num_workers > 0 else None,
+        )
+    else:
+        dataset = VideoFrameDataset(parquet_path, args.data_root, FPS_TARGET, embedding_store, rows, decode_size)
+        dataloader = DataLoader(
+            dataset,
+            batch_size=1,
+            num_workers=args.num_workers,
+            pin_memory=args.device.startswith("cuda"),
+            prefetch_factor=1 if args.num_workers > 0 else None,
+            collate_fn=lambda x: x[0],
+        )
 
     # for tracking accuracy
     correct = 0
     total = 0
-
-    with torch.inference_mode(), autocast("cuda"):
-
-        # iterate through full test set
-        for batch_index, sample in tqdm(enumerate(dataloader), ascii=True, total=len(dataloader), desc="Running..."):
-
-            # assume bs=1
-            assert isinstance(sample, dict)
-            assert "meta" in sample
-            assert "frames" in sample
-
-            # get test sample
-            m = sample["meta"]
-            question = m["question"]
-            answer = m["answer"]
-            opts = m["options"]
-            frames = sample["frames"]
-
-            # first, get the object of interest
-            obj = question.replace("These are frames of a video.\nWhich of the following correctly represents the order in which", "")
-            obj = obj.replace("appeared in the video?", "")
-            obj = obj.replace("the ", "").strip()
-
-            # get object embedding (ensembled)
-            prompts = [p.format(obj.strip()) for p in prompt_templates]
-            texts_ = tokenizer(prompts, context_length=model.context_length).to("cuda")
-            text_features_all = model.encode_text(texts_, normalize=True)
-            text_features = text_features_all.mean(dim=0, keepdim=True)
-            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-
-            # get all answer choice objects
-            objects = [x.strip() for x in opts[0].replace("A. ", "").split(",")]
-
-            # compute 4 relational embeddings (one per option)
-            relational_embeddings = []
-            for other_obj in objects:
-                prompts_rel = [t.format(obj.strip(), other_obj.strip()) for t in relation_templates]
-                texts_rel = tokenizer(prompts_rel, context_length=model.context_length).to("cuda")
-                text_feats_rel_all = model.encode_text(texts_rel, normalize=True)
-                text_feats_rel = text_feats_rel_all.mean(dim=0, keepdim=True)
-                text_feats_rel = text_feats_rel / text_feats_rel.norm(dim=-1, keepdim=True)
-                relational_embeddings.append(text_feats_rel)
-
-            # get full concatenated text embedding (main object + 4 main obj w/ option obj)
-            text_features_final = torch.cat([text_features] + relational_embeddings, dim=0)
-
-            # get frame embeddings
-            frame_features = []
-            for i in range(0, len(frames), args.gpu_bs):
-                fs = frames[i : i + args.gpu_bs]
-                images_ = torch.stack([preprocess(image) for image in fs]).to("cuda")
-                feats = model.encode_image(images_, normalize=True)
-                frame_features.append(feats)
-            frame_features = torch.cat(frame_features, dim=0)
-
-            # get sims
-            sims = (frame_features @ text_features_final.t())
-            obj_only_sims = sims[:, 0]
-
-            # get the top 4 cosine sims with the main object
-            top_values, top_indices = torch.topk(obj_only_sims, k=4, dim=0)
-
-            # get the top indices, sort them in ascending order and get the corresponding main object-sub-object scores
-            top_indices_sorted = torch.sort(top_indices).values
-            relation_scores = sims[top_indices_sorted, 1:]
-
-            # get individual answer positions
-            ind_opt_positions = []
-            for opt in opts:
-                ind_objs = [x.strip() for x in opt.replace("A. ", "").replace("B. ", "").replace("C. ", "").replace("D. ", "").split(",")]
-                ind_objs_pos = [objects.index(x) for x in ind_objs]
-                ind_opt_positions.append(ind_objs_pos)
-
-            # get per-option score sums
-            opt_scores = []
-            for pos in ind_opt_positions:
-                pos_tensor = torch.tensor(pos, device=relation_scores.device)
-                # gather one score per frame according to option's ordering
-                ordered_scores = relation_scores[torch.arange(4), pos_tensor]
-                opt_scores.append(ordered_scores.sum().item())
-
-            # update accuracy
-            total += 1
-            if np.argmax(opt_scores) == ANSWER_MAPPING[answer]:
-                correct += 1
-
+    failed = 0  # videos that could not be decoded, counted as wrong
+
+    # per-sample predictions, merged by the coordinator when sharded
+    predictions_file = None
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        predictions_name = f"predictions_shard{args.shard_id}.jsonl" if args.shard_id >= 0 else "predictions.jsonl"
+        predictions_file = open(os.path.join(args.output_dir, predictions_name), "w")
+
+    def update_accuracy(relation_scores, m, objects):
+        global correct, total
+        opt_scores = score_options(relation_scores, m["options"], objects)
+        is_correct = bool(np.argmax(opt_scores) == ANSWER_MAPPING[m["answer"]])
+
+        # update accuracy
+        total += 1
+        if is_correct:
+            correct += 1
+
+        if predictions_file is not None:
+            prediction = {
+                "row": m["row"],
+                "video_path": m["video_path"],
+                "answer": m["answer"],
+                "prediction": "ABCD"[int(np.argmax(opt_scores))],
+                "opt_scores": opt_scores,
+                "correct": is_correct,
+            }
+            predictions_file.write(json.dumps(prediction) + "\n")
+            predictions_file.flush()
+
+    def record_failed_video(m):
+        global total, failed
+        total += 1
+        failed += 1
+        if predictions_file is not None:
+            prediction = {
+                "row": m["row"],
+                "video_path": m["video_path"],
+                "answer": m["answer"],
+                "prediction": None,
+                "opt_scores": None,
+                "correct": False,
+                "failed": True,
+            }
+            predictions_file.write(json.dumps(prediction) + "\n")
+            predictions_file.flush()
+
+    def score_stored_video(m):
+        obj = parse_object(m["question"])
+        objects = parse_objects(m["options"])
+        text_features_final = text_table.features(obj, objects)
+        frame_features = torch.from_numpy(np.asarray(embedding_store.load(m["video_path"]))).to(args.device)
+        update_accuracy(top_relation_scores(frame_features @ text_features_final.t()), m, objects)
+
+    with torch.inference_mode(), autocast(torch.device(args.device).type):
+
+        # encode the prompt and relation ensembles of all questions upfront, the loop only looks them up. shard
+        # workers get the table of the coordinator and never write it
+        text_table = build_text_table(model, tokenizer, args.model, dataset.df, args.text_table, args.gpu_bs, args.device, read_only=args.shard_id >= 0)
+
+        if args.frame_chunk_size > 0:
+            # per-video state of the videos whose chunks are in flight (at most one per worker)
+            states = {}
+            progress = tqdm(ascii=True, total=len(dataset), desc="Running...")
+            for chunk in dataloader:
+                m = chunk["meta"]
+                if chunk["cached"]:
+                    score_stored_video(m)
+                    progress.update(1)
+                    continue
+                if chunk["frames"] is None:
+                    objects, text_features_final, top_k, writer = states.pop(chunk["video_index"], (None, None, None, None))
+                    if writer is not None:
+                        writer.abort()
+                    record_failed_video(m)
+                    progress.update(1)
+                    continue
+
+                if chunk["video_index"] not in states:
+                    obj = parse_object(m["question"])
+                    objects = parse_objects(m["options"])
+                    text_features_final = text_table.features(obj, objects)
+                    writer = None
+                    if embedding_store is not None:
+                        writer = embedding_store.writer(m["video_path"], m["num_frames"], text_features_final.size(1))
+                    states[chunk["video_index"]] = (objects, text_features_final, StreamingTopK(k=4), writer)
+                objects, text_features_final, top_k, writer = states[chunk["video_index"]]
+
+                # get frame embeddings and fold their sims into the running top-k
+                frames = chunk["frames"]
+                for i in range(0, frames.size(0), args.gpu_bs):
+                    images_ = frames[i : i + args.gpu_bs].to(args.device, non_blocking=True)
+                    feats = model.encode_image(images_, normalize=True)
+                    top_k.update(feats @ text_features_final.t(), chunk["start"] + i)
+                    if writer is not None:
+                        writer.write(chunk["start"] + i, feats.half())
+
+                if chunk["last"]:
+                    del states[chunk["video_index"]]
+                    if writer is not None:
+                        writer.finish()
+                    update_accuracy(top_k.sorted_relation_scores(), m, objects)
+                    progress.update(1)
+            progress.close()
+
+        else:
+            # iterate through full test set
+            for batch_index, sample in tqdm(enumerate(dataloader), ascii=True, total=len(dataloader), desc="Running..."):
+
+                # assume bs=1
+                assert isinstance(sample, dict)
+                assert "meta" in sample
+                assert "frames" in sample
+
+                # get test sample
+                m = sample["meta"]
+                if sample["cached"]:
+                    score_stored_video(m)
+                    continue
+                if sample["frames"] is None:
+                    record_failed_video(m)
+                    continue
+                question = m["question"]
+                opts = m["options"]
+                frames = sample["frames"]
+
+                # first, get the object of interest
+                obj = parse_object(question)
+
+                # get all answer choice objects
+                objects = parse_objects(opts)
+
+                # get full concatenated text embedding (main object + 4 main obj w/ option obj)
+                text_features_final = text_table.features(obj, objects)
+
+                # get frame embeddings
+                frame_features = []
+                for i in range(0, len(frames), args.gpu_bs):
+                    fs = frames[i : i + args.gpu_bs]
+                    if tensor_preprocess is not None:
+                        images_ = tensor_preprocess(fs).to(args.device)
+                    else:
+                        images_ = torch.stack([preprocess(Image.fromarray(frame)) for frame in fs]).to(args.device)
+                    feats = model.encode_image(images_, normalize=True)
+                    frame_features.append(feats)
+                frame_features = torch.cat(frame_features, dim=0)
+                if embedding_store is not None:
+                    embedding_store.put(m["video_path"], frame_features.half())
+
+                # get sims
+                sims = (frame_features @ text_features_final.t())
+                relation_scores = top_relation_scores(sims)
+
+                update_accuracy(relation_scores, m, objects)
+
+    if predictions_file is not None:
+        predictions_file.close()
+
+    if args.shard_id >= 0:
+        print("Current shard: {}/{}".format(args.shard_id, args.num_shards))
     print("Current model: {}".format(args.model))
     print("Current test split: {}".format(args.test_split))
     print("Accuracy: {}% (correct={}/total={})".format(100. * correct/total, correct, total))
+    if failed > 0:
+        print("Failed to decode the video of {} rows, counted as wrong predictions".format(failed))
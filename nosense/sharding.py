@@ -0,0 +1,40 @@
+import heapq
+import json
+
+from decord import VideoReader, cpu
+
+from video_reader import sample_frame_indices
+
+
+def count_frames(video_path, fps_target=1):
+    """Number of frames the runner samples from a video, from its metadata only."""
+    return len(sample_frame_indices(VideoReader(video_path, ctx=cpu(0)), fps_target))
+
+
+def balance_shards(frame_counts, num_shards):
+    """
+    Split the rows into `num_shards` shards of about the same number of frames: the longest videos go first,
+    each to the shard with the fewest frames so far. Ties are broken by row and shard index, so the split is
+    deterministic. Returns the (sorted) rows of every shard.
+    """
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0, shard_id) for shard_id in range(num_shards)]
+    for row in sorted(range(len(frame_counts)), key=lambda row: (-frame_counts[row], row)):
+        load, shard_id = heapq.heappop(loads)
+        shards[shard_id].append(row)
+        heapq.heappush(loads, (load + frame_counts[row], shard_id))
+    return [sorted(rows) for rows in shards]
+
+
+def merge_predictions(prediction_paths, num_rows):
+    """Per-sample predictions of all shards, sorted by row; every row must have been predicted exactly once."""
+    predictions = {}
+    for path in prediction_paths:
+        with open(path) as f:
+            for line in f:
+                prediction = json.loads(line)
+                assert prediction["row"] not in predictions, f"row {prediction['row']} was predicted twice"
+                predictions[prediction["row"]] = prediction
+    missing = sorted(set(range(num_rows)) - set(predictions))
+    assert len(missing) == 0, f"rows {missing} were not predicted"
+    return [predictions[row] for row in sorted(predictions)]
@@ -0,0 +1,97 @@
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+from torchvision.transforms import InterpolationMode
+
+
+INTERPOLATION_MODES = {
+    InterpolationMode.BICUBIC: "bicubic",
+    InterpolationMode.BILINEAR: "bilinear",
+}
+
+
+class TensorPreprocess:
+    """
+    Batched tensor version of an open_clip `preprocess` (resize, center-crop or pad, normalize) that works on
+    uint8 [N, H, W, C] decord batches directly, instead of one PIL image at a time. Frames are processed in
+    chunks of `chunk_size`, kept small since the resize needs them as floats at the decoded resolution. The
+    antialiased resize of torch follows PIL, so the output matches the PIL transforms up to one uint8 level.
+
+    `from_open_clip` raises a ValueError for transforms it does not know, in which case the PIL path is used.
+    """
+
+    def __init__(self, resize_size, interpolation, crop_size, crop_fill, mean, std, chunk_size=16):
+        self.resize_size = resize_size  # int (shorter side) or (height, width)
+        self.interpolation = interpolation
+        self.crop_size = crop_size  # (height, width) or None
+        self.crop_fill = crop_fill
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_open_clip(cls, preprocess, chunk_size=16):
+        resize_size, interpolation, crop_size, crop_fill, mean, std = None, None, None, 0, None, None
+        for t in preprocess.transforms:
+            if isinstance(t, transforms.Resize) and resize_size is None and t.max_size is None and t.interpolation in INTERPOLATION_MODES:
+                resize_size = t.size if isinstance(t.size, int) else tuple(t.size)
+                resize_size = resize_size[0] if isinstance(resize_size, tuple) and len(resize_size) == 1 else resize_size
+                interpolation = INTERPOLATION_MODES[t.interpolation]
+            elif isinstance(t, transforms.CenterCrop) or type(t).__name__ == "CenterCropOrPad":
+                crop_size = (t.size, t.size) if isinstance(t.size, int) else tuple(t.size)
+                crop_size = crop_size * 2 if len(crop_size) == 1 else crop_size
+                crop_fill = getattr(t, "fill", 0)
+            elif isinstance(t, transforms.Normalize):
+                mean, std = t.mean, t.std
+            elif isinstance(t, transforms.ToTensor) or getattr(t, "__name__", "") == "_convert_to_rgb":
+                continue
+            else:
+                raise ValueError(f"Unsupported transform for tensor preprocessing: {t}")
+        if resize_size is None or mean is None:
+            raise ValueError(f"Unsupported preprocess for tensor preprocessing: {preprocess}")
+        return cls(resize_size, interpolation, crop_size, crop_fill, mean, std, chunk_size)
+
+    def _output_size(self, height, width):
+        if not isinstance(self.resize_size, int):
+            return self.resize_size
+        # shorter side to `resize_size`, like torchvision
+        short, long = min(height, width), max(height, width)
+        new_short, new_long = self.resize_size, int(self.resize_size * long / short)
+        return (new_short, new_long) if height <= width else (new_long, new_short)
+
+    def _center_crop(self, images):
+        crop_height, crop_width = self.crop_size
+        height, width = images.shape[-2:]
+        if crop_height > height or crop_width > width:
+            pad_left, pad_top = max(crop_width - width, 0) // 2, max(crop_height - height, 0) // 2
+            pad_right, pad_bottom = max(crop_width - width, 0) - pad_left, max(crop_height - height, 0) - pad_top
+            images = F.pad(images, (pad_left, pad_right, pad_top, pad_bottom), value=self.crop_fill)
+            height, width = images.shape[-2:]
+        top, left = int(round((height - crop_height) / 2.0)), int(round((width - crop_width) / 2.0))
+        return images[..., top : top + crop_height, left : left + crop_width]
+
+    def __call__(self, frames):
+        """[N, 3, H', W'] float tensor of uint8 [N, H, W, C] frames (a numpy array or a tensor)."""
+        if not isinstance(frames, torch.Tensor):
+            frames = torch.from_numpy(frames)
+        pixel_values = []
+        for chunk in frames.split(self.chunk_size):
+            chunk = chunk.permute(0, 3, 1, 2).float() # NHWC -> NCHW
+            chunk = F.interpolate(chunk, size=self._output_size(*chunk.shape[-2:]), mode=self.interpolation, align_corners=False, antialias=True)
+            chunk = chunk.round().clamp(0, 255) # PIL resizes in uint8
+            if self.crop_size is not None:
+                chunk = self._center_crop(chunk)
+            pixel_values.append((chunk / 255. - self.mean) / self.std)
+        return torch.cat(pixel_values)
+
+
+def preprocess_output_size(preprocess):
+    """(height, width) an open_clip `preprocess` crops or resizes to (covered by any frame it accepts), or None."""
+    for t in reversed(preprocess.transforms):
+        if isinstance(t, transforms.CenterCrop) or type(t).__name__ == "CenterCropOrPad":
+            size = (t.size, t.size) if isinstance(t.size, int) else tuple(t.size)
+            return size * 2 if len(size) == 1 else size
+        if isinstance(t, transforms.Resize):
+            size = (t.size, t.size) if isinstance(t.size, int) else tuple(t.size)
+            return size * 2 if len(size) == 1 else size # the shorter side for a single size
+    return None
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+import torch
+
+
+class TextEmbeddingTable:
+    """
+    Prompt-ensembled text embeddings of the objects (over `prompt_templates`) and object pairs (over
+    `relation_templates`) of the questions, encoded upfront in large batches and then only looked up.
+
+    If `path` is given, the table is loaded from and saved to that file, keyed by the model and the templates,
+    so later runs only encode objects they have not seen yet. With `read_only`, the file is never written (e.g.
+    by the shard workers, which share the table the coordinator built).
+    """
+
+    def __init__(self, model, tokenizer, model_name, prompt_templates, relation_templates, path="", batch_size=1024, device="cuda", read_only=False):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prompt_templates = prompt_templates
+        self.relation_templates = relation_templates
+        self.path = path
+        self.read_only = read_only
+        self.batch_size = batch_size
+        self.device = device
+        self.key = hashlib.sha1(json.dumps({
+            "model": model_name,
+            "prompt_templates": prompt_templates,
+            "relation_templates": relation_templates,
+        }).encode()).hexdigest()
+
+        self.objects = {}  # obj -> [dim]
+        self.relations = {}  # (obj, other_obj) -> [dim]
+        if self.path and os.path.exists(self.path):
+            table = torch.load(self.path, map_location="cpu")
+            if table["key"] == self.key:
+                self.objects = {obj: _.to(self.device) for obj, _ in table["objects"].items()}
+                self.relations = {pair: _.to(self.device) for pair, _ in table["relations"].items()}
+
+    def __len__(self):
+        return len(self.objects) + len(self.relations)
+
+    def _encode(self, prompts, num_templates):
+        text_features_all = []
+        for i in range(0, len(prompts), self.batch_size):
+            texts_ = self.tokenizer(prompts[i : i + self.batch_size], context_length=self.model.context_length).to(self.device)
+            text_features_all.append(self.model.encode_text(texts_, normalize=True))
+        # ensemble the templates of every object (pair)
+        text_features = torch.cat(text_features_all, dim=0).unflatten(0, (-1, num_templates)).mean(dim=1)
+        return text_features / text_features.norm(dim=-1, keepdim=True)
+
+    def build(self, objects, pairs):
+        """Encode every object and (object, other object) pair that is not in the table yet."""
+        objects = sorted(set(obj for obj in objects if obj not in self.objects))
+        pairs = sorted(set(pair for pair in pairs if pair not in self.relations))
+
+        if len(objects) > 0:
+            prompts = [p.format(obj.strip()) for obj in objects for p in self.prompt_templates]
+            self.objects.update(zip(objects, self._encode(prompts, len(self.prompt_templates))))
+        if len(pairs) > 0:
+            prompts_rel = [t.format(obj.strip(), other_obj.strip()) for obj, other_obj in pairs for t in self.relation_templates]
+            self.relations.update(zip(pairs, self._encode(prompts_rel, len(self.relation_templates))))
+
+        if self.path and not self.read_only and (len(objects) > 0 or len(pairs) > 0):
+            self.save()
+
+    def save(self):
+        table = {
+            "key": self.key,
+            "objects": {obj: _.cpu() for obj, _ in self.objects.items()},
+            "relations": {pair: _.cpu() for pair, _ in self.relations.items()},
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        torch.save(table, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def features(self, obj, objects):
+        """Embedding of the main object followed by one relational embedding per answer choice object."""
+        self.build([obj], [(obj, other_obj) for other_obj in objects])
+        return torch.stack([self.objects[obj]] + [self.relations[(obj, other_obj)] for other_obj in objects])
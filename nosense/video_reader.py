@@ -0,0 +1,37 @@
+import math
+
+from decord import VideoReader, cpu
+
+
+def open_video_reader(video_path, target_size=None):
+    """
+    decord VideoReader of `video_path`. With `target_size` ((height, width) the preprocessing crops or resizes
+    to), decord scales frames down at decode time to the smallest size with the aspect ratio of the video that
+    still covers `target_size`, so full-resolution frames are never converted and resized afterwards.
+    """
+    vr = VideoReader(video_path, ctx=cpu(0))
+    if target_size is None:
+        return vr
+
+    height, width, _ = vr[0].shape
+    scale = max(target_size[0] / height, target_size[1] / width)
+    if scale >= 1:
+        vr.seek(0)
+        return vr
+    return VideoReader(video_path, ctx=cpu(0), width=math.ceil(width * scale), height=math.ceil(height * scale))
+
+
+def sample_frame_indices(vr, fps_target=1):
+    """Indices of the frames sampled at `fps_target`."""
+    step = int(round(vr.get_avg_fps() / fps_target))
+    return list(range(0, len(vr), step))
+
+
+def iter_frame_chunks(vr, frame_indices, chunk_size):
+    """
+    uint8 [n, H, W, C] arrays of the frames at `frame_indices`, `chunk_size` at a time. Each chunk is one
+    `get_batch` call in increasing frame order, so decord seeks to the keyframe before a sample only when it
+    is not already between the two, and skips the frames in between without converting them.
+    """
+    for start in range(0, len(frame_indices), chunk_size):
+        yield vr.get_batch(sorted(frame_indices[start : start + chunk_size])).asnumpy()
@@ -132,12 +132,77 @@ def expand2square(pil_img, background_color):
         result.paste(pil_img, ((height - width) // 2, 0))
         return result
 
-def process_video_with_decord(video_file, model_cfg, num_threads=-1):
+def expand2square_video(video, background_color):
+    """Tensor version of `expand2square` for a [T, H, W, C] uint8 video."""
+    num_frames, height, width, channels = video.shape
+    if width == height:
+        return video
+    size = max(width, height)
+    result = torch.tensor(background_color, dtype=video.dtype).expand(num_frames, size, size, channels).clone()
+    top, left = (size - height) // 2, (size - width) // 2
+    result[:, top : top + height, left : left + width] = video
+    return result
+
+def supports_tensor_preprocess(processor_aux):
+    """Whether `preprocess_video_tensor` can stand in for `processor_aux.preprocess` (fixed-size bicubic resize, e.g. SigLIP)."""
+    if not all(hasattr(processor_aux, _) for _ in ["size", "resample", "rescale_factor", "image_mean", "image_std"]):
+        return False
+    return isinstance(processor_aux.size, (tuple, list)) and processor_aux.resample == Image.BICUBIC
 
-    if num_threads < 1:
-        vr = VideoReader(video_file, ctx=cpu(0))
-    else:
-        vr = VideoReader(video_file, ctx=cpu(0), num_threads=num_threads)
+def preprocess_video_tensor(video, processor_aux, chunk_size=16):
+    """
+    Batched tensor version of `processor_aux.preprocess` for a [T, H, W, C] uint8 video: resize, rescale and
+    normalize run as tensor ops on `chunk_size` frames at a time instead of per PIL image. The resize needs
+    float frames at the decoded resolution, so chunks are kept small. The antialiased bicubic resize of torch
+    follows PIL, so the output matches the PIL path up to one uint8 level.
+    """
+    height, width = processor_aux.size
+    mean = torch.tensor(processor_aux.image_mean).view(1, -1, 1, 1)
+    std = torch.tensor(processor_aux.image_std).view(1, -1, 1, 1)
+
+    pixel_values = []
+    for chunk in video.split(chunk_size):
+        chunk = chunk.permute(0, 3, 1, 2).float() # THWC -> TCHW
+        chunk = torch.nn.functional.interpolate(chunk, size=(height, width), mode="bicubic", align_corners=False, antialias=True)
+        chunk = chunk.round().clamp(0, 255) # PIL resizes in uint8
+        pixel_values.append((chunk * processor_aux.rescale_factor - mean) / std)
+    return torch.cat(pixel_values)
+
+def processor_output_size(processor_aux_list):
+    """(height, width) that covers the output of every processor."""
+    return max(_.crop_size["height"] for _ in processor_aux_list), max(_.crop_size["width"] for _ in processor_aux_list)
+
+def open_video_reader(video_file, num_threads=-1, target_size=None, pad_to_square=False):
+    """
+    decord VideoReader of `video_file` and the native (width, height) of its frames.
+
+    With `target_size` ((height, width) of the processor output), decord scales frames down at decode time to
+    the smallest size with the aspect ratio of the video that still covers `target_size` (after padding to
+    square if `pad_to_square`), so full-resolution frames are never converted and resized afterwards.
+    """
+    kwargs = {} if num_threads < 1 else {"num_threads": num_threads}
+    vr = VideoReader(video_file, ctx=cpu(0), **kwargs)
+    height, width, _ = vr[0].shape
+    vr.seek(0)
+
+    if target_size is not None:
+        target_height, target_width = target_size
+        if pad_to_square:
+            scale = max(target_height, target_width) / max(width, height)
+        else:
+            scale = max(target_height / height, target_width / width)
+        if scale < 1:
+            vr = VideoReader(video_file, ctx=cpu(0), width=math.ceil(width * scale), height=math.ceil(height * scale), **kwargs)
+    return vr, (width, height)
+
+def decode_video(video_file, model_cfg, num_threads=-1, target_size=None, pad_to_square=False):
+    """
+    Sampled frames of a video (1 FPS, or `video_max_frames` uniformly sampled ones) as a [T, H, W, C] uint8
+    array, with its native (width, height); see `open_video_reader` for `target_size`. The sampled indices
+    are fetched in one `get_batch` call in increasing order, so decord seeks to the keyframe before a sample
+    only when it is not already between the two and skips the frames in between without converting them.
+    """
+    vr, video_size = open_video_reader(video_file, num_threads=num_threads, target_size=target_size, pad_to_square=pad_to_square)
     total_frame_num = len(vr)
     video_time = total_frame_num / vr.get_avg_fps()
     avg_fps = round(vr.get_avg_fps() / model_cfg.video_fps)
@@ -157,6 +222,10 @@ def process_video_with_decord(video_file, model_cfg, num_threads=-1):
     num_frames_to_sample = num_frames = len(frame_idx)
     # https://github.com/dmlc/decord/issues/208
     vr.seek(0)
+    return video, video_size, video_time, frame_time, num_frames_to_sample
+
+def process_video_with_decord(video_file, model_cfg, num_threads=-1):
+    video, _, video_time, frame_time, num_frames_to_sample = decode_video(video_file, model_cfg, num_threads=num_threads)
     return video, video_time, frame_time, num_frames_to_sample
 
 def process_videos(videos, image_processor, model_cfg, num_threads=-1):
@@ -166,14 +235,20 @@ def process_videos(videos, image_processor, model_cfg, num_threads=-1):
     new_videos_aux_list = []
     video_sizes = []
 
+    # decode frames just large enough for the processors
+    target_size = processor_output_size(processor_aux_list) if getattr(model_cfg, "video_decode_downscale", False) else None
+
     for video in videos:
-        video, video_time, frame_time, num_frames_to_sample = process_video_with_decord(video, model_cfg, num_threads=num_threads)
-        video_sizes.append((video.shape[2], video.shape[1], video.shape[0])) # W, H, T
-        video = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])] # covert to PIL.Image.Image
+        video, (width, height), video_time, frame_time, num_frames_to_sample = decode_video(video, model_cfg, num_threads=num_threads, target_size=target_size, pad_to_square=True)
+        video_sizes.append((width, height, video.shape[0])) # W, H, T
 
         video_aux_list = []
         for processor_aux in processor_aux_list:
-            video_aux = video
+            if supports_tensor_preprocess(processor_aux):
+                video_aux = expand2square_video(torch.from_numpy(video), tuple(int(x*255) for x in processor_aux.image_mean))
+                video_aux_list.append(preprocess_video_tensor(video_aux, processor_aux))
+                continue
+            video_aux = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])] # covert to PIL.Image.Image
             video_aux = [expand2square(image, tuple(int(x*255) for x in processor_aux.image_mean)) for image in video_aux]
             video_aux_list.append(processor_aux.preprocess(video_aux, return_tensors='pt')['pixel_values'])
 
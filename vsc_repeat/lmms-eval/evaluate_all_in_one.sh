@@ -92,6 +92,42 @@ while [[ $# -gt 0 ]]; do
         consolidation_mem_budget="$2"
         shift 2
         ;;
+    --surprise_trace_dir)
+        surprise_trace_dir="$2"
+        shift 2
+        ;;
+    --surprise_trace_quant_bits)
+        surprise_trace_quant_bits="$2"
+        shift 2
+        ;;
+    --surprise_trace_max_gb)
+        surprise_trace_max_gb="$2"
+        shift 2
+        ;;
+    --static_frame_threshold)
+        static_frame_threshold="$2"
+        shift 2
+        ;;
+    --ingest_batch_videos)
+        ingest_batch_videos="$2"
+        shift 2
+        ;;
+    --kv_quant_bits)
+        kv_quant_bits="$2"
+        shift 2
+        ;;
+    --kv_host_mem_budget)
+        kv_host_mem_budget="$2"
+        shift 2
+        ;;
+    --kv_disk_mem_budget)
+        kv_disk_mem_budget="$2"
+        shift 2
+        ;;
+    --kv_disk_dir)
+        kv_disk_dir="$2"
+        shift 2
+        ;;
     *)
         echo "Unknown argument: $1"
         exit 1
@@ -116,6 +152,30 @@ for model in "${models[@]}"; do
         model_family="cambrians_vsr"
         model="cambrians_vsr_${pretrained}"
         model_args="pretrained=${pretrained},conv_template=qwen_2,miv_token_len=${miv_token_len},si_token_len=${si_token_len},sensory_window_size=${sensory_window_size},compression_downsample_ratio=${compression_downsample_ratio},consolidation_method=${consolidation_method},retrieval_topk=${retrieval_topk},enable_visual_feature_caching=${enable_visual_feature_caching},surprise_threshold=${surprise_threshold},consolidation_mem_budget=${consolidation_mem_budget}"
+        if [ -n "$surprise_trace_dir" ]; then
+            model_args="${model_args},surprise_trace_dir=${surprise_trace_dir}"
+        fi
+        if [ -n "$surprise_trace_quant_bits" ]; then
+            model_args="${model_args},surprise_trace_quant_bits=${surprise_trace_quant_bits}"
+        fi
+        if [ -n "$surprise_trace_max_gb" ]; then
+            model_args="${model_args},surprise_trace_max_gb=${surprise_trace_max_gb}"
+        fi
+        if [ -n "$static_frame_threshold" ]; then
+            model_args="${model_args},static_frame_threshold=${static_frame_threshold}"
+        fi
+        if [ -n "$ingest_batch_videos" ]; then
+            model_args="${model_args},ingest_batch_videos=${ingest_batch_videos}"
+        fi
+        if [ -n "$kv_quant_bits" ]; then
+            model_args="${model_args},kv_quant_bits=${kv_quant_bits}"
+        fi
+        if [ -n "$kv_host_mem_budget" ]; then
+            model_args="${model_args},kv_host_mem_budget=${kv_host_mem_budget},kv_disk_mem_budget=${kv_disk_mem_budget:-0}"
+        fi
+        if [ -n "$kv_disk_dir" ]; then
+            model_args="${model_args},kv_disk_dir=${kv_disk_dir}"
+        fi
         ;;
     "cambrians_vsc")
         model_family="cambrians_vsc"
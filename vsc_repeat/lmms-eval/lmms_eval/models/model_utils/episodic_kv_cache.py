@@ -0,0 +1,132 @@
+from typing import Optional
+
+import torch
+
+
+class EpisodicKVCache:
+    """
+    Append-only key/value store of every frame that left the sensory window of the VSC wrappers, with
+    episodes addressed as index ranges instead of being rebuilt from per-element lists.
+
+    Elements follow the numbering of the wrappers: element 0 is the pre-image prompt and element `i` is the
+    `i`-th frame. Keys and values (stacked over layers, LBHTC) are written once into one contiguous buffer,
+    so an episode `[episodic_starts, episodic_ends)` is a single slice of it, plus the frames that are still
+    in the sensory window. Building the kv of an episode therefore costs O(episode) instead of O(history),
+    and the prompt is a cached view that is shared by all episodes.
+    """
+
+    def __init__(self, num_layers: int, reserve_frames: int = 0):
+        self.num_layers = num_layers
+        self.reserve_frames = reserve_frames
+
+        self.key_buffer: Optional[torch.Tensor] = None
+        self.value_buffer: Optional[torch.Tensor] = None
+        self.offsets = [0]  # start token of every element, plus the end of the last one
+        self.modalities = []
+        self.lengths = []
+        self.surprising_scores = []
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def seq_length(self):
+        return self.offsets[-1]
+
+    def _reserve(self, like, needed):
+        if self.key_buffer.size(3) >= needed:
+            return
+        # room for all frames of the video at once if the caller said how many there are
+        capacity = max(needed, 2 * self.key_buffer.size(3), self.seq_length + self.reserve_frames * like.size(3))
+        for name in ["key_buffer", "value_buffer"]:
+            buffer = getattr(self, name)
+            new_buffer = buffer.new_empty(buffer.shape[:3] + (capacity, buffer.size(4)))
+            new_buffer[..., : self.seq_length, :].copy_(buffer[..., : self.seq_length, :])
+            setattr(self, name, new_buffer)
+
+    def set_prefix(self, past_key_values):
+        """Store the kv cache of the pre-image prompt as element 0."""
+        assert len(self) == 0, "prefix must be set on an empty cache"
+        self.key_buffer = torch.stack([key_states for key_states, _ in past_key_values])
+        self.value_buffer = torch.stack([value_states for _, value_states in past_key_values])
+        self._append_metadata("T", self.key_buffer.size(3), 1.) # text is always surprising
+
+    def _append_metadata(self, modality, length, surprising_score):
+        self.offsets.append(self.offsets[-1] + length)
+        self.modalities.append(modality)
+        self.lengths.append(length)
+        self.surprising_scores.append(surprising_score)
+
+    def append(self, block):
+        """Copy a `StreamingBlock` (e.g. one evicted from the sensory window) in as the next element."""
+        start, end = self.seq_length, self.seq_length + block.length
+        self._reserve(block.key_states, end)
+        self.key_buffer[..., start:end, :].copy_(block.key_states)
+        self.value_buffer[..., start:end, :].copy_(block.value_states)
+        self._append_metadata(block.modality, block.length, block.surprising_score)
+
+    def snapshot(self):
+        """Plain tensors and lists from which `from_snapshot` rebuilds this cache (e.g. to keep it on CPU)."""
+        return {
+            "key_states": self.key_buffer[..., : self.seq_length, :],
+            "value_states": self.value_buffer[..., : self.seq_length, :],
+            "modalities": list(self.modalities),
+            "lengths": list(self.lengths),
+            "surprising_scores": list(self.surprising_scores),
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        cache = cls(snapshot["key_states"].size(0))
+        cache.key_buffer = snapshot["key_states"]
+        cache.value_buffer = snapshot["value_states"]
+        for modality, length, surprising_score in zip(snapshot["modalities"], snapshot["lengths"], snapshot["surprising_scores"]):
+            cache._append_metadata(modality, length, surprising_score)
+        return cache
+
+    def _episode_segments(self, episodic_starts, episodic_ends, runtime_kv_cache):
+        global_starts = min(episodic_starts, len(self))
+        global_ends = max(global_starts, min(episodic_ends, len(self)))
+        start, end = self.offsets[global_starts], self.offsets[global_ends]
+        key_states = [self.key_buffer[..., : self.offsets[1], :], self.key_buffer[..., start:end, :]]
+        value_states = [self.value_buffer[..., : self.offsets[1], :], self.value_buffer[..., start:end, :]]
+        num_runtime_elements = len(runtime_kv_cache) if runtime_kv_cache is not None else 0
+        for ele_idx in range(max(episodic_starts, len(self)), min(episodic_ends, len(self) + num_runtime_elements)):
+            block = runtime_kv_cache.block(ele_idx - len(self))
+            key_states.append(block.key_states)
+            value_states.append(block.value_states)
+        return key_states, value_states
+
+    def episode(self, episodic_starts, episodic_ends, runtime_kv_cache=None):
+        """
+        Per-layer `(key_states, value_states)` of the prompt followed by elements `[episodic_starts,
+        episodic_ends)`, taken from this cache and then from the blocks of `runtime_kv_cache` (element
+        `len(self) + i` is `runtime_kv_cache.block(i)`). Out-of-range elements are skipped.
+        """
+        key_states, value_states = self._episode_segments(episodic_starts, episodic_ends, runtime_kv_cache)
+        # one concatenation for all layers, split into per-layer views
+        return list(zip(torch.cat(key_states, dim=3).unbind(0), torch.cat(value_states, dim=3).unbind(0)))
+
+    def episodes(self, episode_ranges, runtime_kv_cache=None):
+        """
+        Several episodes (`(episodic_starts, episodic_ends)` pairs) as one left-padded batch: per-layer
+        `(key_states, value_states)` and the 2d attention mask that hides the padding. Since RoPE is applied
+        on the fly with compact positions, left padding shifts all positions of an episode by the same amount
+        and leaves its attention scores unchanged.
+        """
+        segments = [self._episode_segments(episodic_starts, episodic_ends, runtime_kv_cache) for episodic_starts, episodic_ends in episode_ranges]
+        lengths = [sum(_.size(3) for _ in key_states) for key_states, _ in segments]
+        max_length = max(lengths)
+
+        shape = self.key_buffer.shape[:1] + (len(segments),) + self.key_buffer.shape[2:3] + (max_length, self.key_buffer.size(4))
+        key_states, value_states = self.key_buffer.new_zeros(shape), self.value_buffer.new_zeros(shape)
+        attention_mask = torch.zeros((len(segments), max_length), dtype=torch.long, device=self.key_buffer.device)
+        for batch_idx, ((key_segments, value_segments), length) in enumerate(zip(segments, lengths)):
+            start = max_length - length
+            attention_mask[batch_idx, start:] = 1
+            for key_segment, value_segment in zip(key_segments, value_segments):
+                end = start + key_segment.size(3)
+                key_states[:, batch_idx : batch_idx + 1, :, start:end].copy_(key_segment)
+                value_states[:, batch_idx : batch_idx + 1, :, start:end].copy_(value_segment)
+                start = end
+        return list(zip(key_states.unbind(0), value_states.unbind(0))), attention_mask
@@ -0,0 +1,24 @@
+import torch
+
+
+def quantize_kv(states, bits, dim):
+    """
+    Asymmetric `bits`-bit (8 or 4) quantization of `states`, with one scale and offset per slice along `dim`
+    (e.g. the tokens of a block for per-channel scales). Returns `(codes, scale, offset)`: 4-bit codes are
+    packed two per byte along the last dim, scale and offset keep the dtype of `states` and a size of 1 along `dim`.
+    """
+    levels = 2**bits - 1
+    offset = states.amin(dim, keepdim=True)
+    scale = ((states.amax(dim, keepdim=True).float() - offset.float()) / levels).clamp_min(1e-5).to(states.dtype)
+    codes = ((states.float() - offset.float()) / scale.float()).round_().clamp_(0, levels).to(torch.uint8)
+    if bits == 4:
+        codes = codes[..., 0::2] | (codes[..., 1::2] << 4)
+    return codes, scale, offset
+
+
+def dequantize_kv(codes, scale, offset, bits):
+    """Inverse of `quantize_kv`, in the dtype of `scale`."""
+    if bits == 4:
+        codes = torch.stack([codes & 15, codes >> 4], dim=-1).flatten(-2)
+    return codes.to(scale.dtype) * scale + offset
+
@@ -0,0 +1,85 @@
+import glob
+import hashlib
+import json
+import os
+import uuid
+from collections import OrderedDict
+
+import torch
+
+from lmms_eval.models.model_utils.visual_feature_store import VisualFeatureStore
+
+
+def to_device(obj, device):
+    """Move every tensor of a nested list/tuple/dict structure to `device`."""
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(_, device) for _ in obj)
+    if isinstance(obj, dict):
+        return {key: to_device(value, device) for key, value in obj.items()}
+    return obj
+
+
+class MemorySnapshotCache:
+    """
+    LRU cache of the memory the streaming Cambrian-S wrappers build for a video, so that further questions
+    on the same video skip the ingest and only run their own text tokens and the decode.
+
+    Snapshots are keyed by the video and every hyperparameter the memory depends on (`make_key`). They are
+    kept on CPU, or on disk if `cache_dir` is given (in which case they also survive across runs); only the
+    `max_entries` most recently used ones are kept. On disk every rank keeps its own subdirectory, so that no
+    rank evicts a snapshot another one is about to load.
+    """
+
+    def __init__(self, max_entries: int = 1, cache_dir: str = "", rank: int = 0):
+        self.max_entries = max_entries
+        self.cache_dir = os.path.join(cache_dir, f"rank{rank}") if cache_dir else ""
+        self.entries = OrderedDict()  # key -> snapshot on CPU, or its path on disk
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for path in sorted(glob.glob(os.path.join(self.cache_dir, "*.pt")), key=os.path.getmtime):
+                self.entries[os.path.basename(path)[: -len(".pt")]] = path
+            self._evict()
+
+    @staticmethod
+    def make_key(video_path, **memory_kwargs):
+        """Key of the memory built from `video_path` with the given hyperparameters (any JSON-able values)."""
+        video = VisualFeatureStore.video_identity(video_path) if video_path is not None else None  # a replaced video gets a new key
+        payload = json.dumps({"video_path": video_path, "video": video, **memory_kwargs}, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, device):
+        """The snapshot stored under `key`, with its tensors on `device`."""
+        self.entries.move_to_end(key)
+        snapshot = self.entries[key]
+        if self.cache_dir:
+            os.utime(snapshot)  # keep the LRU order of the next run
+            snapshot = torch.load(snapshot, map_location="cpu")
+        return to_device(snapshot, device)
+
+    def put(self, key, snapshot):
+        snapshot = to_device(snapshot, "cpu")
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, key + ".pt")
+            # written aside and renamed, a crash never leaves a truncated snapshot under its key
+            tmp_path = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, path)
+            snapshot = path
+        self.entries[key] = snapshot
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            _, snapshot = self.entries.popitem(last=False)
+            if self.cache_dir and os.path.exists(snapshot):
+                os.remove(snapshot)
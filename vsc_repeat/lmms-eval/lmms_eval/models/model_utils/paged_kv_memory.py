@@ -0,0 +1,247 @@
+import math
+from typing import Dict
+
+import torch
+
+from lmms_eval.models.model_utils.kv_quantization import dequantize_kv, quantize_kv
+from lmms_eval.models.model_utils.surprise_index import SurpriseIndex
+
+
+class MemoryBlock:
+    """Page table and metadata of one memory block (the pre-image prompt or one frame)."""
+
+    def __init__(self, pages, length, modality, key_summary, key_scale=None):
+        self.pages = pages
+        self.length = length
+        self.modality = modality
+        self.key_summary = key_summary  # mean key per layer and head (LBHC), what retrieval ranks the block on
+        self.key_scale = key_scale  # per-channel (scale, offset) of the quantized keys, LBH1C each
+
+
+class PagedKVMemory:
+    """
+    Paged key/value storage for the consolidated (global) memory of the streaming Cambrian-S wrappers.
+
+    Keys and values live in one pool each, stacked over layers as `[layers, batch, heads, num_pages *
+    page_size, dim]`. Memory blocks do not own tensors, they only keep a page table into the pools. Since
+    all layers take the same consolidation decisions, page tables are shared by all layers and every page
+    operation is a single indexing kernel over the stacked pools. Dropping a block returns its pages to the free list,
+    merging two blocks averages them into the pages of the first one and frees the pages of the second, and
+    the token budget is tracked incrementally in `total_length`. Pools grow (by doubling) only when the free
+    list runs dry, so the allocator is not involved while frames stream through the memory.
+
+    Block order, surprising scores and the eviction heap live in a `SurpriseIndex`; blocks are addressed by
+    the ids it hands out. The mean key of every block is computed once when it is appended and kept up to date
+    by merges (`key_summaries`), so retrieval never has to go over the kv of the memory. With a `cold_memory`
+    (`ColdKVMemory`), blocks evicted by `consolidate_memory` are spilled to it instead of being dropped.
+
+    With `quant_bits` 8 or 4, blocks are stored as asymmetric integer codes (4-bit ones packed two per byte),
+    keys with a scale per channel of the block and values with a scale per token (the token-wise outliers of
+    keys are channel-aligned, the ones of values are not). They are dequantized whenever they are read back.
+    """
+
+    def __init__(self, num_layers: int, page_size: int = 8, reserve_tokens: int = 0, cold_memory=None, quant_bits: int = 16):
+        assert quant_bits in [16, 8, 4], f"unsupported quant_bits {quant_bits}"
+        self.num_layers = num_layers
+        self.cold_memory = cold_memory
+        self.page_size = page_size
+        self.reserve_tokens = reserve_tokens
+        self.quant_bits = quant_bits
+
+        self.key_pool = None
+        self.value_pool = None
+        self.value_scale_pool = None  # per-token (scale, offset) of the quantized values
+        self.num_pages = 0
+        self.free_pages = []
+
+        self.index = SurpriseIndex()
+        self.blocks: Dict[int, MemoryBlock] = {}
+        self.total_length = 0
+        # frames appended since the last merge pass of `consolidate_memory`
+        self.unchecked_ids = []
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def block_ids(self):
+        return list(self.index)
+
+    @property
+    def lengths(self):
+        return [self.blocks[block_id].length for block_id in self.index]
+
+    @property
+    def modalities(self):
+        return [self.blocks[block_id].modality for block_id in self.index]
+
+    def key_summaries(self):
+        """Mean key of every block, in order, as `[layers, num_blocks, batch, heads, dim]`."""
+        return torch.stack([self.blocks[block_id].key_summary for block_id in self.index], dim=1)
+
+    @property
+    def surprising_scores(self):
+        return [self.index.scores[block_id] for block_id in self.index]
+
+    def _grow(self, like, min_pages):
+        # headroom for the budget, one block over it and the page padding of every block
+        num_pages = max(min_pages, 2 * self.num_pages, math.ceil(self.reserve_tokens / self.page_size) * 2)
+        if self.quant_bits < 16:
+            # last dim and dtype of the key, value and value scale pools
+            layouts = [(like.size(4) * self.quant_bits // 8, torch.uint8)] * 2 + [(2, like.dtype)]
+        else:
+            layouts = [(like.size(4), like.dtype)] * 2
+        pools = []
+        for old_pool, (last_dim, dtype) in zip([self.key_pool, self.value_pool, self.value_scale_pool], layouts):
+            pool = like.new_empty(like.shape[:3] + (num_pages * self.page_size, last_dim), dtype=dtype)
+            if old_pool is not None:
+                pool[..., : self.num_pages * self.page_size, :].copy_(old_pool)
+            pools.append(pool)
+        self.key_pool, self.value_pool = pools[:2]
+        if self.quant_bits < 16:
+            self.value_scale_pool = pools[2]
+        # reversed, so that `pop()` hands out the lowest pages first
+        self.free_pages.extend(range(num_pages - 1, self.num_pages - 1, -1))
+        self.num_pages = num_pages
+
+    def _token_index(self, pages, length, device):
+        pages = torch.tensor(pages, device=device)
+        return (pages[:, None] * self.page_size + torch.arange(self.page_size, device=device)[None, :]).flatten()[:length]
+
+    def _store(self, token_index, key_states, value_states):
+        # write kv (LBHTC) at `token_index` of the pools, returns the key scale of the block if it is quantized
+        if self.quant_bits >= 16:
+            self.key_pool.index_copy_(3, token_index, key_states)
+            self.value_pool.index_copy_(3, token_index, value_states)
+            return None
+        key_codes, key_scale, key_offset = quantize_kv(key_states, self.quant_bits, dim=3)
+        value_codes, value_scale, value_offset = quantize_kv(value_states, self.quant_bits, dim=4)
+        self.key_pool.index_copy_(3, token_index, key_codes)
+        self.value_pool.index_copy_(3, token_index, value_codes)
+        self.value_scale_pool.index_copy_(3, token_index, torch.cat([value_scale, value_offset], dim=4))
+        return key_scale, key_offset
+
+    def _load(self, block_ids):
+        # kv of the blocks, concatenated in the given order and dequantized (LBHTC)
+        device = self.key_pool.device
+        blocks = [self.blocks[block_id] for block_id in block_ids]
+        token_index = torch.cat([self._token_index(block.pages, block.length, device) for block in blocks])
+        key_states, value_states = self.key_pool.index_select(3, token_index), self.value_pool.index_select(3, token_index)
+        if self.quant_bits < 16:
+            value_scales = self.value_scale_pool.index_select(3, token_index)
+            value_states = dequantize_kv(value_states, value_scales[..., :1], value_scales[..., 1:], self.quant_bits)
+            key_scale, key_offset = [torch.cat([block.key_scale[_].expand(-1, -1, -1, block.length, -1) for block in blocks], dim=3) for _ in range(2)]
+            key_states = dequantize_kv(key_states, key_scale, key_offset, self.quant_bits)
+        return key_states, value_states
+
+    def append(self, key_states, value_states, modality, surprising_score, pinned=False):
+        """
+        Write a new block at the end of the memory and return its id. `key_states`/`value_states` are stacked
+        over layers (LBHTC). Pinned blocks (the pre-image prompt) are never dropped nor merged.
+        """
+        length = key_states.size(3)
+        num_pages = math.ceil(length / self.page_size)
+        if len(self.free_pages) < num_pages:
+            self._grow(key_states, self.num_pages + num_pages)
+
+        pages = [self.free_pages.pop() for _ in range(num_pages)]
+        key_scale = self._store(self._token_index(pages, length, key_states.device), key_states, value_states)
+
+        block_id = self.index.append(surprising_score, pinned=pinned)
+        self.blocks[block_id] = MemoryBlock(pages, length, modality, key_states.mean(3), key_scale)
+        self.total_length += length
+        if not pinned:
+            self.unchecked_ids.append(block_id)
+        return block_id
+
+    def drop(self, block_id):
+        block = self.blocks.pop(block_id)
+        self.index.remove(block_id)
+        self.free_pages.extend(block.pages)
+        self.total_length -= block.length
+        return block
+
+    def evict(self, block_id):
+        """Drop a block, after spilling it to the cold memory if there is one."""
+        if self.cold_memory is not None:
+            key_states, value_states = self.gather(block_id)
+            self.cold_memory.spill(block_id, key_states, value_states, self.blocks[block_id].modality, self.index.scores[block_id])
+        return self.drop(block_id)
+
+    def merge(self, block_id):
+        """Average the block following `block_id` into it; both blocks must have the same length."""
+        next_id = self.index.next[block_id]
+        block, next_block = self.blocks[block_id], self.blocks[next_id]
+        assert block.length == next_block.length, f"cannot merge blocks of length {block.length} and {next_block.length}"
+
+        key_states, value_states = self.gather(block_id)
+        next_key_states, next_value_states = self.gather(next_id)
+        token_index = self._token_index(block.pages, block.length, self.key_pool.device)
+        block.key_scale = self._store(token_index, (key_states + next_key_states) / 2., (value_states + next_value_states) / 2.)
+        # the mean of the averaged keys is the average of the means
+        block.key_summary = (block.key_summary + next_block.key_summary) / 2.
+
+        self.index.update_score(block_id, (self.index.scores[block_id] + self.index.scores[next_id]) / 2.)
+        self.drop(next_id)
+
+    def gather(self, block_id):
+        """kv of one block, stacked over layers (LBHTC)."""
+        return self._load([block_id])
+
+    def materialize(self):
+        """Gather all blocks, in order, into one `(key_states, value_states)` pair per layer."""
+        key_states, value_states = self._load(list(self.index))
+        return list(zip(key_states.unbind(0), value_states.unbind(0)))
+
+
+def consolidate_memory(memory: PagedKVMemory, consolidation_method, consolidation_mem_budget, surprise_threshold):
+    """
+    Bring the memory back under `consolidation_mem_budget` tokens. Pinned blocks (pre-image prompt) are never
+    dropped. `drop` removes the least surprising frames; `drop_merge` first merges runs of adjacent surprising
+    frames and merges the neighbours of every dropped frame when both of them are surprising.
+
+    Decisions are taken once on the shared `SurpriseIndex`, so every step costs O(log n) instead of a scan
+    over all blocks. The merge pass only visits the frames appended since the previous pass: after a pass no
+    two adjacent frames are both surprising, and the neighbour merge after a drop keeps it that way.
+    """
+    if memory.total_length <= consolidation_mem_budget:
+        return
+
+    index = memory.index
+    unchecked_ids, memory.unchecked_ids = memory.unchecked_ids, []
+
+    def mergeable(block_id, next_id):
+        if block_id is None or next_id is None or block_id in index.pinned:
+            return False
+        return index.scores[block_id] >= surprise_threshold and index.scores[next_id] >= surprise_threshold
+
+    if consolidation_method == "drop_merge":
+        for block_id in unchecked_ids:
+            prev_id = index.prev[block_id]
+            if mergeable(prev_id, block_id):
+                memory.merge(prev_id)
+
+        while True:
+            block_id = index.pop_min()
+            if block_id is None:
+                break
+            prev_id, next_id = index.prev[block_id], index.next[block_id]
+            memory.evict(block_id)
+
+            # merge the neighbours of the dropped frame if possible
+            if mergeable(prev_id, next_id):
+                memory.merge(prev_id)
+
+            if memory.total_length < consolidation_mem_budget:
+                break
+    elif consolidation_method == "drop":
+        while True:
+            # drop the frame with the smallest surprise
+            block_id = index.pop_min()
+            if block_id is None:
+                break
+            memory.evict(block_id)
+            if memory.total_length < consolidation_mem_budget:
+                break
+    else:
+        raise NotImplementedError
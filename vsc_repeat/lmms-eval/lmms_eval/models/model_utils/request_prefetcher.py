@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import deque
+
+import torch
+
+
+def host_nbytes(obj):
+    """Bytes of the CPU tensors of a nested list/tuple/dict structure, or of objects with a `host_nbytes` method."""
+    if hasattr(obj, "host_nbytes"):
+        return obj.host_nbytes()
+    if isinstance(obj, torch.Tensor):
+        return obj.nbytes if obj.device.type == "cpu" else 0
+    if isinstance(obj, (list, tuple)):
+        return sum(host_nbytes(_) for _ in obj)
+    if isinstance(obj, dict):
+        return sum(host_nbytes(_) for _ in obj.values())
+    return 0
+
+
+class RequestPrefetcher:
+    """
+    Iterates `loader` (e.g. the per-request DataLoader of the streaming Cambrian-S wrappers) on a background
+    thread, so that up to `prefetch` requests are loaded and preprocessed while the current one is ingested.
+
+    The next request is only loaded while fewer than `prefetch` requests wait and they hold less than
+    `max_bytes` of CPU tensors (no cap if 0), so at most one request beyond the cap is held at a time.
+    With `prefetch=0` the requests are loaded in the calling thread. The time the consumer waited for every
+    request is kept in `wait_times`.
+    """
+
+    def __init__(self, loader, prefetch=1, max_bytes=0):
+        self.loader = loader
+        self.prefetch = prefetch
+        self.max_bytes = max_bytes
+        self.wait_times = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _produce(self, items, state, cond):
+        def has_room():
+            return state["stop"] or (len(items) < self.prefetch and (self.max_bytes <= 0 or state["nbytes"] < self.max_bytes))
+
+        try:
+            loader = iter(self.loader)
+            while True:
+                # hold back the loader until there is room, instead of loading a request that has to wait anyway
+                with cond:
+                    cond.wait_for(has_room)
+                    if state["stop"]:
+                        return
+                item = next(loader, StopIteration)
+                if item is StopIteration:
+                    break
+                nbytes = host_nbytes(item)
+                with cond:
+                    items.append((item, nbytes))
+                    state["nbytes"] += nbytes
+                    cond.notify_all()
+        except Exception as e:
+            with cond:
+                state["error"] = e
+                cond.notify_all()
+            return
+        with cond:
+            state["done"] = True
+            cond.notify_all()
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            loader = iter(self.loader)
+            while True:
+                start = time.perf_counter()
+                item = next(loader, StopIteration)
+                if item is StopIteration:
+                    return
+                self.wait_times.append(time.perf_counter() - start)
+                yield item
+
+        items = deque()
+        state = {"nbytes": 0, "done": False, "stop": False, "error": None}
+        cond = threading.Condition()
+        producer = threading.Thread(target=self._produce, args=(items, state, cond), daemon=True)
+        producer.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                with cond:
+                    cond.wait_for(lambda: len(items) > 0 or state["done"] or state["error"] is not None)
+                    if len(items) == 0:
+                        if state["error"] is not None:
+                            raise state["error"]
+                        break
+                    item, nbytes = items.popleft()
+                    state["nbytes"] -= nbytes
+                    cond.notify_all()
+                self.wait_times.append(time.perf_counter() - start)
+                yield item
+        finally:
+            with cond:
+                state["stop"] = True
+                cond.notify_all()
+            producer.join()
@@ -0,0 +1,397 @@
+from typing import List, Optional, Tuple
+
+import torch
+
+
+def rotary_cos_sin(inv_freq, position_ids, dtype):
+    """
+    RoPE `cos`/`sin` tables for arbitrary (absolute) positions, without growing the rotary cache of the model.
+    The angles are computed in float64 since positions of hour-long videos are far beyond what float32 keeps exact.
+    """
+    freqs = position_ids.to(torch.float64)[:, None] * inv_freq.to(device=position_ids.device, dtype=torch.float64)[None, :]
+    emb = torch.cat((freqs, freqs), dim=-1)
+    return emb.cos().to(dtype), emb.sin().to(dtype)
+
+
+def rotate_half(x):
+    x1 = x[..., : x.shape[-1] // 2]
+    x2 = x[..., x.shape[-1] // 2 :]
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def rotate_key_states(key_states, position_ids, inv_freq, inverse=False):
+    """Apply (or undo, with `inverse=True`) RoPE at `position_ids` on `key_states` of shape BHTC (or LBHTC)."""
+    cos, sin = rotary_cos_sin(inv_freq, position_ids, key_states.dtype)
+    if inverse:
+        sin = -sin
+    return key_states * cos[None, None] + rotate_half(key_states) * sin[None, None]
+
+
+def chunked_frame_attention(query_states, key_states, value_states, layer_cache, inv_freq, num_key_value_groups):
+    """
+    Attention of a forward that stages several frames at once (`StreamingKVCache.stage_frames`), equivalent to
+    staging them one at a time: every frame attends to the prefix, to the (up to `window_size`) frames before it
+    and causally to itself, with the positions it had in the frame-by-frame ingest. Since the prefix sits right
+    before the oldest frame a frame sees, every frame gets its own copy of the prefix keys.
+
+    `query_states` are BHQC, `key_states`/`value_states` the (not repeated) views returned by `update`. Queries
+    are expected to be rotated already if the cache stores rotated keys, and raw otherwise.
+    """
+    cache = layer_cache.cache
+    layout = cache.chunk_layout(query_states.device)
+    prefix_len, num_frames = cache.prefix_len, cache.staged_frames
+
+    frame_key_states = key_states[..., prefix_len:, :]
+    if layer_cache.stores_rotated_keys:
+        prefix_key_states = cache.prefix_key_states[layer_cache.layer_idx]
+    else:
+        prefix_key_states = key_states[..., :prefix_len, :]
+        query_states = rotate_key_states(query_states, layout["query_position_ids"], inv_freq)
+        frame_key_states = rotate_key_states(frame_key_states, layout["key_position_ids"], inv_freq)
+    prefix_key_states = rotate_key_states(prefix_key_states.repeat(1, 1, num_frames, 1), layout["prefix_position_ids"], inv_freq)
+    prefix_value_states = value_states[..., :prefix_len, :].repeat(1, 1, num_frames, 1)
+
+    key_states = torch.cat([prefix_key_states, frame_key_states], dim=2).repeat_interleave(num_key_value_groups, dim=1)
+    value_states = torch.cat([prefix_value_states, value_states[..., prefix_len:, :]], dim=2).repeat_interleave(num_key_value_groups, dim=1)
+    return torch.nn.functional.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask=layout["mask"][None, None])
+
+
+class StreamingLayerCache:
+    """
+    Per-layer handle of a `StreamingKVCache`, passed to the patched `Qwen2SdpaAttention` as `past_key_value`.
+    """
+
+    def __init__(self, cache, layer_idx):
+        self.cache = cache
+        self.layer_idx = layer_idx
+        self.stores_rotated_keys = cache.rope_mode == "post"
+
+    def get_seq_length(self):
+        return self.cache.seq_length
+
+    def update(self, key_states, value_states):
+        return self.cache.update(key_states, value_states, self.layer_idx)
+
+    def key_position_ids(self, device):
+        return self.cache.key_position_ids(device)
+
+    @property
+    def staged_frames(self):
+        return self.cache.staged_frames
+
+    def staged_position_ids(self, num_tokens, device):
+        return self.cache.staged_position_ids(num_tokens, device)
+
+
+class BatchedLayerCache:
+    """
+    Per-layer handle of the sensory windows of several videos ingested in lock-step, passed to the patched
+    `Qwen2SdpaAttention` as `past_key_value`. The new tokens of the videos are padded to the longest one, row `i`
+    of the batch holds `num_tokens[i]` tokens of video `i`, which only attend to its own window (`videos[i]`).
+    """
+
+    def __init__(self, videos, num_tokens):
+        self.videos = videos
+        self.num_tokens = num_tokens
+
+    def get_seq_length(self):
+        return max(layer_cache.get_seq_length() for layer_cache in self.videos)
+
+
+def batched_layers(caches, num_tokens):
+    """`BatchedLayerCache` of every layer over the `StreamingKVCache` of several videos, see `BatchedLayerCache`."""
+    return [BatchedLayerCache([cache.layers[layer_idx] for cache in caches], num_tokens) for layer_idx in range(caches[0].num_layers)]
+
+
+class StreamingBlock:
+    """A frame block evicted from (or read out of) the sensory window, with its metadata."""
+
+    def __init__(self, key_states, value_states, modality, length, surprising_score):
+        self.key_states = key_states  # stacked over layers, LBHTC; `key_states[layer_idx]` is the kv of one layer
+        self.value_states = value_states  # stacked over layers, LBHTC
+        self.modality = modality
+        self.length = length
+        self.surprising_score = surprising_score
+
+
+class StreamingKVCache:
+    """
+    Preallocated key/value cache for the sensory window of the streaming Cambrian-S wrappers.
+
+    Keys and values of all layers live in one stacked buffer each, of shape `[layers, batch, heads, tokens,
+    dim]`, laid out along the tokens as `[prefix | window slots | staging]`. The prefix holds the pre-image
+    prompt, the window holds up to `window_size` frame blocks of `frame_len` tokens each and the staging area
+    receives the tokens of the forward pass that is currently running. `update` writes new tokens into the
+    staging area in place and returns zero-copy views over the live part of the buffer, so neither the
+    wrapper nor the attention has to `torch.cat` the window on every frame. Since the layers are stacked,
+    evictions, slot copies and prefix re-rotations run once for all layers instead of once per layer.
+
+    Once the window is full it behaves like a ring buffer: `commit` copies the staged frame over the slot of
+    the oldest frame, which is handed back as an evicted `StreamingBlock`. Slots are therefore no longer in
+    temporal order, which is why the cache also exposes the logical position of every key
+    (`key_position_ids`). The attention rotates keys with these positions, which reproduces exactly the
+    positions of the original `torch.cat` layout.
+
+    With `rope_mode="post"` keys are stored after RoPE instead, so the attention only rotates the tokens of
+    the running forward and never the whole cache. Frames keep the absolute position they were written at,
+    while the (short) prefix is re-rotated on every eviction to sit right before the oldest frame. Since
+    RoPE only depends on relative positions, attention scores are the same as with compact positions.
+    Blocks leaving the cache (`commit`, `block`, `to_legacy_cache`) are rotated back to raw keys, so the
+    global memory, its consolidation and retrieval keep working on the same keys as in `"pre"` mode.
+    """
+
+    def __init__(self, num_layers: int, window_size: int = -1, rope_mode: str = "pre", inv_freq: Optional[torch.Tensor] = None):
+        assert rope_mode in ["pre", "post"], f"Invalid rope_mode: {rope_mode}"
+        assert rope_mode == "pre" or inv_freq is not None, "rope_mode=post needs the inv_freq of the rotary embedding"
+        self.num_layers = num_layers
+        self.window_size = window_size
+        self.rope_mode = rope_mode
+        self.inv_freq = inv_freq
+        self.layers = [StreamingLayerCache(self, layer_idx) for layer_idx in range(num_layers)]
+
+        self.key_buffer: Optional[torch.Tensor] = None
+        self.value_buffer: Optional[torch.Tensor] = None
+
+        self.prefix_len = 0
+        self.frame_len = None
+        self.slot_order = []  # slot index of every frame block, oldest first
+        self.modalities = []
+        self.surprising_scores = []
+        self.num_staged = 0
+        self.staged_frames = 1  # frames the running forward stages, see `stage_frames`
+        self.num_evicted = 0
+        self.prefix_key_states = None  # raw prefix keys, only kept with rope_mode=post
+        self._ordered = True
+        self._position_ids = None
+        self._chunk_layout = None
+
+    def __len__(self):
+        return len(self.slot_order)
+
+    @property
+    def seq_length(self):
+        return self.prefix_len + len(self.slot_order) * (self.frame_len or 0)
+
+    @property
+    def position_offset(self):
+        # with rope_mode=post, frames keep their absolute positions, which run ahead of the compact ones
+        return self.num_evicted * (self.frame_len or 0) if self.rope_mode == "post" else 0
+
+    @property
+    def is_full(self):
+        return self.window_size > 0 and len(self.slot_order) >= self.window_size
+
+    def set_prefix(self, past_key_values):
+        """Store the kv cache of the pre-image prompt, e.g. `out.past_key_values` of the prompt forward."""
+        assert self.prefix_len == 0 and len(self.slot_order) == 0, "prefix must be set on an empty cache"
+        key_states = torch.stack([key_states for key_states, _ in past_key_values])
+        value_states = torch.stack([value_states for _, value_states in past_key_values])
+        if self.rope_mode == "post":
+            self.prefix_key_states = key_states
+            key_states = rotate_key_states(key_states, torch.arange(key_states.size(3), device=key_states.device), self.inv_freq)
+        # kept as is, the buffers are allocated once the frame length is known
+        self.key_buffer = key_states
+        self.value_buffer = value_states
+        self.prefix_len = key_states.size(3)
+
+    def _reserve(self, like, needed):
+        if self.key_buffer is not None and self.key_buffer.size(3) >= needed:
+            return
+
+        if self.window_size > 0:
+            # prefix + window + staging; only grows again if a forward stages more than one frame
+            frame_len = self.frame_len or max((needed - self.prefix_len) // self.staged_frames, 1)
+            capacity = max(needed, self.prefix_len + (self.window_size + self.staged_frames) * frame_len)
+        else:
+            capacity = max(needed, 2 * self.key_buffer.size(3) if self.key_buffer is not None else needed)
+
+        shape = (self.num_layers, like.size(0), like.size(1), capacity, like.size(3))
+        key_buffer = torch.empty(shape, dtype=like.dtype, device=like.device)
+        value_buffer = torch.empty(shape, dtype=like.dtype, device=like.device)
+        if self.key_buffer is not None:
+            used = self.seq_length
+            key_buffer[..., :used, :].copy_(self.key_buffer[..., :used, :])
+            value_buffer[..., :used, :].copy_(self.value_buffer[..., :used, :])
+        self.key_buffer = key_buffer
+        self.value_buffer = value_buffer
+
+    def update(self, key_states, value_states, layer_idx):
+        """Stage the kv of the running forward for `layer_idx` and return views over the whole live cache."""
+        start = self.seq_length
+        end = start + key_states.size(2)
+        self._reserve(key_states, end)
+
+        self.key_buffer[layer_idx, ..., start:end, :].copy_(key_states)
+        self.value_buffer[layer_idx, ..., start:end, :].copy_(value_states)
+        self.num_staged = key_states.size(2)
+
+        return self.key_buffer[layer_idx, ..., :end, :], self.value_buffer[layer_idx, ..., :end, :]
+
+    def staged_position_ids(self, num_tokens, device):
+        """Positions the tokens of the running forward are rotated with when `rope_mode="post"`."""
+        start = self.seq_length + self.position_offset
+        return torch.arange(start, start + num_tokens, device=device)
+
+    def key_position_ids(self, device):
+        """Logical position of every key returned by `update`, or None if the buffer is in temporal order."""
+        if self._ordered or self.rope_mode == "post":
+            return None
+        if self._position_ids is None or self._position_ids.size(0) != self.seq_length + self.num_staged:
+            slot_order = torch.tensor(self.slot_order, device=device)
+            slot_rank = torch.empty_like(slot_order)
+            slot_rank[slot_order] = torch.arange(slot_order.size(0), device=device)
+            frame_positions = slot_rank[:, None] * self.frame_len + torch.arange(self.frame_len, device=device)[None, :]
+            self._position_ids = torch.cat([
+                torch.arange(self.prefix_len, device=device),
+                self.prefix_len + frame_positions.flatten(),
+                torch.arange(self.seq_length, self.seq_length + self.num_staged, device=device),
+            ])
+        return self._position_ids
+
+    def stage_frames(self, num_frames):
+        """Announce that the next forward stages `num_frames` frames of equal length at once."""
+        assert self.num_staged == 0, "frames are staged, commit them first"
+        self.staged_frames = num_frames
+        self._chunk_layout = None
+
+    def chunk_layout(self, device):
+        """
+        Positions and mask of `chunked_frame_attention` for the staged frames, shared by all layers. Frames are
+        numbered in temporal order from the oldest one in the window, keys are ordered like the buffer.
+        """
+        if self._chunk_layout is not None:
+            return self._chunk_layout
+        num_frames = self.staged_frames
+        frame_len = self.num_staged // num_frames
+        num_cached = len(self.slot_order)
+        position_offset = self.num_evicted * frame_len if self.rope_mode == "post" else 0
+
+        frame_ids = torch.arange(num_frames, device=device)
+        num_visible = self.num_evicted + num_cached + frame_ids
+        if self.window_size > 0:
+            num_visible = num_visible.clamp(max=self.window_size)
+        oldest_visible = num_cached + frame_ids - num_visible
+
+        slot_order = torch.tensor(self.slot_order, device=device, dtype=torch.long)
+        slot_rank = torch.empty_like(slot_order)
+        slot_rank[slot_order] = torch.arange(num_cached, device=device)
+        token_ids = torch.arange(frame_len, device=device)
+        key_frame_ids = torch.cat([slot_rank, num_cached + frame_ids]).repeat_interleave(frame_len)
+        key_token_ids = token_ids.repeat(num_cached + num_frames)
+        query_chunk_ids = frame_ids.repeat_interleave(frame_len)
+        query_frame_ids = num_cached + query_chunk_ids
+        query_token_ids = token_ids.repeat(num_frames)
+
+        prefix_mask = query_chunk_ids[:, None] == frame_ids.repeat_interleave(self.prefix_len)[None, :]
+        frame_mask = (key_frame_ids[None, :] >= oldest_visible[query_chunk_ids][:, None]) & (key_frame_ids[None, :] < query_frame_ids[:, None])
+        frame_mask |= (key_frame_ids[None, :] == query_frame_ids[:, None]) & (key_token_ids[None, :] <= query_token_ids[:, None])
+
+        self._chunk_layout = {
+            "query_position_ids": position_offset + self.prefix_len + query_frame_ids * frame_len + query_token_ids,
+            "key_position_ids": position_offset + self.prefix_len + key_frame_ids * frame_len + key_token_ids,
+            "prefix_position_ids": (position_offset + oldest_visible[:, None] * frame_len + torch.arange(self.prefix_len, device=device)[None, :]).flatten(),
+            "mask": torch.cat([prefix_mask, frame_mask], dim=1),
+        }
+        return self._chunk_layout
+
+    def _slot_range(self, slot):
+        start = self.prefix_len + slot * self.frame_len
+        return start, start + self.frame_len
+
+    def _raw_key_states(self, key_states, index):
+        """Undo RoPE on the keys of the `index`-th frame block (rope_mode=post only)."""
+        start = self.prefix_len + self.position_offset + index * self.frame_len
+        position_ids = torch.arange(start, start + self.frame_len, device=key_states.device)
+        return rotate_key_states(key_states, position_ids, self.inv_freq, inverse=True)
+
+    def block(self, index) -> StreamingBlock:
+        """
+        The `index`-th frame block in temporal order (0 is the oldest frame in the window). Keys and values
+        are views into the buffers, except for rotated keys which are returned as raw copies.
+        """
+        start, end = self._slot_range(self.slot_order[index])
+        key_states = self.key_buffer[..., start:end, :]
+        if self.rope_mode == "post":
+            key_states = self._raw_key_states(key_states, index)
+        return StreamingBlock(
+            key_states,
+            self.value_buffer[..., start:end, :],
+            self.modalities[index],
+            self.frame_len,
+            self.surprising_scores[index],
+        )
+
+    def blocks(self):
+        for index in range(len(self.slot_order)):
+            yield self.block(index)
+
+    def commit(self, modality, surprising_score) -> Optional[StreamingBlock]:
+        """
+        Turn the staged tokens into a new frame block. If the window overflows, the oldest block is
+        returned (as owned copies) and its slot is reused for the new frame.
+        """
+        evicted = self.commit_frames(modality, [surprising_score])
+        return evicted[0] if len(evicted) > 0 else None
+
+    def commit_frames(self, modality, surprising_scores) -> List[StreamingBlock]:
+        """
+        Turn the staged tokens into one frame block per score, in temporal order, as if they were committed one
+        at a time. Returns the blocks they push out of the window, oldest first.
+        """
+        num_frames = len(surprising_scores)
+        assert self.num_staged > 0, "nothing staged, run a forward with `past_key_values=cache.layers` first"
+        assert num_frames == self.staged_frames, f"{self.staged_frames} frames are staged, got {num_frames} scores"
+        if self.frame_len is None:
+            self.frame_len = self.num_staged // num_frames
+        assert self.num_staged == num_frames * self.frame_len, f"all frames must have the same length ({self.num_staged} != {num_frames} * {self.frame_len})"
+
+        staged_start = self.seq_length
+        evicted_blocks = []
+        for index, surprising_score in enumerate(surprising_scores):
+            # until the window is full, the staged frame already sits in the next free slot
+            staged = staged_start + index * self.frame_len
+            if self.is_full:
+                start, end = self._slot_range(self.slot_order[0])
+                key_states = self.key_buffer[..., start:end, :].clone()
+                if self.rope_mode == "post":
+                    key_states = self._raw_key_states(key_states, 0)
+                evicted_blocks.append(StreamingBlock(
+                    key_states,
+                    self.value_buffer[..., start:end, :].clone(),
+                    self.modalities.pop(0),
+                    self.frame_len,
+                    self.surprising_scores.pop(0),
+                ))
+                slot = self.slot_order.pop(0)
+                for buffer in [self.key_buffer, self.value_buffer]:
+                    buffer[..., start:end, :].copy_(buffer[..., staged : staged + self.frame_len, :])
+                self.num_evicted += 1
+                if self.rope_mode == "post":
+                    # keep the prefix right before the oldest frame, as it is with compact positions
+                    position_ids = torch.arange(self.position_offset, self.position_offset + self.prefix_len, device=self.key_buffer.device)
+                    self.key_buffer[..., : self.prefix_len, :].copy_(rotate_key_states(self.prefix_key_states, position_ids, self.inv_freq))
+            else:
+                slot = len(self.slot_order)
+
+            self.slot_order.append(slot)
+            self._ordered = self.slot_order[0] == 0  # slot_order is always a rotation of range(len(self))
+            self.modalities.append(modality)
+            self.surprising_scores.append(surprising_score)
+
+        self.num_staged = 0
+        self.staged_frames = 1
+        self._position_ids = None
+        self._chunk_layout = None
+        return evicted_blocks
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+        """Materialize the committed cache in temporal order as a tuple of raw `(key_states, value_states)`."""
+        if self.rope_mode == "post":
+            key_states = [self.prefix_key_states]
+        else:
+            key_states = [self.key_buffer[..., : self.prefix_len, :]]
+        value_states = [self.value_buffer[..., : self.prefix_len, :]]
+        for block in self.blocks():
+            key_states.append(block.key_states)
+            value_states.append(block.value_states)
+        return tuple(zip(torch.cat(key_states, dim=3).unbind(0), torch.cat(value_states, dim=3).unbind(0)))
@@ -0,0 +1,93 @@
+import heapq
+
+
+class SurpriseIndex:
+    """
+    Layer-agnostic index over the blocks of a memory: a doubly linked list in temporal order and a min-heap on
+    surprise with lazy deletion.
+
+    Blocks are identified by ids that increase in append order, and a merge keeps the id of the earlier
+    block, so ties on the surprise are broken in temporal order (like `argmin` on the list of scores). Heap
+    entries are invalidated by removing the block or by bumping its version when its score changes, and are
+    skipped when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self.next_id = 0
+        self.head = None
+        self.tail = None
+        self.prev = {}
+        self.next = {}
+        self.scores = {}
+        self.versions = {}
+        self.pinned = set()
+        self.heap = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, block_id):
+        return block_id in self.scores
+
+    def __iter__(self):
+        block_id = self.head
+        while block_id is not None:
+            yield block_id
+            block_id = self.next[block_id]
+
+    def append(self, surprising_score, pinned=False):
+        """Add a block at the end and return its id. Pinned blocks (e.g. the prompt) are never returned by `pop_min`."""
+        block_id = self.next_id
+        self.next_id += 1
+
+        self.prev[block_id] = self.tail
+        self.next[block_id] = None
+        if self.tail is None:
+            self.head = block_id
+        else:
+            self.next[self.tail] = block_id
+        self.tail = block_id
+
+        self.scores[block_id] = surprising_score
+        self.versions[block_id] = 0
+        if pinned:
+            self.pinned.add(block_id)
+        else:
+            heapq.heappush(self.heap, (surprising_score, block_id, 0))
+        return block_id
+
+    def update_score(self, block_id, surprising_score):
+        self.scores[block_id] = surprising_score
+        self.versions[block_id] += 1
+        if block_id not in self.pinned:
+            heapq.heappush(self.heap, (surprising_score, block_id, self.versions[block_id]))
+        self._maybe_compact()
+
+    def remove(self, block_id):
+        prev_id, next_id = self.prev.pop(block_id), self.next.pop(block_id)
+        if prev_id is None:
+            self.head = next_id
+        else:
+            self.next[prev_id] = next_id
+        if next_id is None:
+            self.tail = prev_id
+        else:
+            self.prev[next_id] = prev_id
+
+        del self.scores[block_id]
+        del self.versions[block_id]
+        self.pinned.discard(block_id)
+
+    def pop_min(self):
+        """Id of the least surprising unpinned block (left in the index), or None if there is none."""
+        while self.heap:
+            _, block_id, version = heapq.heappop(self.heap)
+            if self.versions.get(block_id) == version:
+                return block_id
+        return None
+
+    def _maybe_compact(self):
+        # drop stale entries once they dominate the heap
+        if len(self.heap) > 2 * len(self) + 64:
+            self.heap = [(self.scores[_], _, self.versions[_]) for _ in self if _ not in self.pinned]
+            heapq.heapify(self.heap)
@@ -0,0 +1,91 @@
+import torch
+
+from lmms_eval.models.model_utils.kv_quantization import dequantize_kv, quantize_kv
+from lmms_eval.models.model_utils.streaming_kv_cache import StreamingBlock
+
+
+class SurpriseTraceWriter:
+    """
+    Records the ingest of a video by the streaming Cambrian-S wrappers into a `VisualFeatureStore` entry: the
+    kv of the pre-image prompt and every frame block in the order it leaves the sensory window, with its
+    surprise score. Everything after the sensory window (compression, consolidation, retrieval and the
+    questions) only depends on this sequence, so it can be replayed under other memory settings without the
+    vision encoder and the per-frame forwards (`iter_surprise_trace`). The trace depends on the settings of the
+    sensory window, which are therefore part of its key.
+
+    A frame block holds the kv of every layer, about 4 MiB in fp16 for Cambrian-S-7B (28 layers, 4 kv heads of
+    128 channels, 72 tokens), i.e. ~56 GiB for a 240-minute video at 1 fps. Blocks are therefore stored as
+    `quant_bits` codes (8 or 4, 16 keeps the fp16 kv) with the same layout as the quantized memory: per-channel
+    scales for the keys and per-token scales for the values, halving or quartering that. The prefix is kept in
+    fp16. A trace growing past `max_bytes` is given up (0 for no cap), the video is then ingested again on
+    later runs.
+    """
+
+    def __init__(self, store, key, quant_bits=16, max_bytes=0):
+        self.writer = store.writer(key)
+        self.quant_bits = quant_bits
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.modalities = []
+        self.surprising_scores = []
+
+    @property
+    def active(self):
+        return self.writer is not None
+
+    def _append(self, name, states):
+        self.num_bytes += states.numel() * states.element_size()
+        self.writer.append(name, states)
+
+    def set_prefix(self, key_states, value_states):
+        # kv stacked over layers, LBHTC
+        self._append("prefix_key_states", key_states)
+        self._append("prefix_value_states", value_states)
+
+    def append(self, block):
+        if self.writer is None:
+            return
+        if self.quant_bits < 16:
+            key_codes, key_scale, key_offset = quantize_kv(block.key_states, self.quant_bits, dim=3)
+            value_codes, value_scale, value_offset = quantize_kv(block.value_states, self.quant_bits, dim=4)
+            self._append("key_states", key_codes.unsqueeze(0))
+            self._append("key_scales", torch.cat([key_scale, key_offset], dim=3).unsqueeze(0))  # LBH2C
+            self._append("value_states", value_codes.unsqueeze(0))
+            self._append("value_scales", torch.cat([value_scale, value_offset], dim=4).unsqueeze(0))  # LBHT2
+        else:
+            self._append("key_states", block.key_states.unsqueeze(0))
+            self._append("value_states", block.value_states.unsqueeze(0))
+        self.modalities.append(block.modality)
+        self.surprising_scores.append(float(block.surprising_score))  # kept exact, thresholds are compared against it
+
+        if self.max_bytes > 0 and self.num_bytes > self.max_bytes:
+            self.abort()
+
+    def finish(self, meta=None):
+        if self.writer is not None:
+            self.writer.finish({"modalities": self.modalities, "surprising_scores": self.surprising_scores, "quant_bits": self.quant_bits, **(meta or {})})
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+
+
+def load_surprise_trace_prefix(entry, device):
+    """kv of the pre-image prompt of a recorded trace, stacked over layers (LBHTC)."""
+    num_layers = entry.shape("prefix_key_states")[0]
+    return entry.read("prefix_key_states", 0, num_layers).to(device), entry.read("prefix_value_states", 0, num_layers).to(device)
+
+
+def iter_surprise_trace(entry, device):
+    """The recorded frame blocks, read one at a time in the order they left the sensory window."""
+    quant_bits = entry.meta.get("quant_bits", 16)
+    for index, (modality, surprising_score) in enumerate(zip(entry.meta["modalities"], entry.meta["surprising_scores"])):
+        key_states = entry.read("key_states", index, index + 1)[0].to(device)
+        value_states = entry.read("value_states", index, index + 1)[0].to(device)
+        if quant_bits < 16:
+            key_scales = entry.read("key_scales", index, index + 1)[0].to(device)
+            value_scales = entry.read("value_scales", index, index + 1)[0].to(device)
+            key_states = dequantize_kv(key_states, key_scales[:, :, :, :1], key_scales[:, :, :, 1:], quant_bits)
+            value_states = dequantize_kv(value_states, value_scales[..., :1], value_scales[..., 1:], quant_bits)
+        yield StreamingBlock(key_states, value_states, modality, key_states.size(-2), surprising_score)
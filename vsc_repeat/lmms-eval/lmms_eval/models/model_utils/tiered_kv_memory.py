@@ -0,0 +1,245 @@
+import heapq
+import math
+import os
+import tempfile
+import weakref
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+
+def page_runs(pages):
+    """`(offset, first_page, num_pages)` of the runs of consecutive pages in a page table."""
+    offset = 0
+    while offset < len(pages):
+        count = 1
+        while offset + count < len(pages) and pages[offset + count] == pages[offset] + count:
+            count += 1
+        yield offset, pages[offset], count
+        offset += count
+
+
+class PinnedSlabPool:
+    """
+    Free list of the pinned slabs the host tiers grow from. A wrapper shares one between the memories of all its
+    videos, which give their slabs back once they are garbage collected: memory is pinned once for the videos
+    alive at the same time instead of for every video.
+    """
+
+    def __init__(self):
+        self.free = defaultdict(list)  # (shape, dtype) -> slabs
+
+    def take(self, shape, dtype):
+        free = self.free[(tuple(shape), dtype)]
+        return free.pop() if len(free) > 0 else torch.empty(shape, dtype=dtype, pin_memory=True)
+
+    def give(self, slabs, event=None):
+        if event is not None:
+            event.synchronize()  # spills may still be in flight
+        for slab in slabs:
+            self.free[(tuple(slab.shape), slab.dtype)].append(slab)
+
+
+class ColdBlock:
+    """Page table and metadata of one memory block in the host or disk tier."""
+
+    def __init__(self, tier, pages, length, modality, surprising_score, key_summary):
+        self.tier = tier
+        self.pages = pages
+        self.length = length
+        self.modality = modality
+        self.surprising_score = surprising_score
+        self.key_summary = key_summary  # mean key per layer and head, LBHC, kept on the device
+
+
+class ColdKVMemory:
+    """
+    Host and disk tiers of the consolidated memory of `cambrians_vsr`. Instead of being dropped, the blocks
+    `consolidate_memory` evicts from the device (`PagedKVMemory`) are spilled to a pool of pinned host memory
+    of `host_mem_budget` tokens; once it is full its least surprising blocks move on to a memory-mapped file of
+    `disk_mem_budget` tokens, and only the least surprising blocks of that file are finally dropped. The memory
+    held for a video is therefore bounded by the configuration instead of by the length of the video. The host
+    tier grows by slabs of `slab_pages` pages taken from `slab_pool` as blocks are spilled, so a video only pins
+    what it spills.
+
+    Pools are page-major (`[num_pages, 2, layers, batch, heads, page_size, dim]`, keys and values side by
+    side), so the pages of one layer of a block are contiguous. A mean key per layer stays on the device for
+    every block: retrieval ranks the cold blocks on it together with the device ones, and pages back only
+    the winners (`fetch`). Which blocks win depends on the query of the layer, so they are paged in while the
+    layer waits for them; only the spills run behind the compute.
+    """
+
+    def __init__(self, num_layers: int, host_mem_budget: int, disk_mem_budget: int = 0, disk_dir: str = "", page_size: int = 8, slab_pool: PinnedSlabPool = None, slab_pages: int = 256):
+        self.num_layers = num_layers
+        self.page_size = page_size
+        self.num_host_pages = math.ceil(host_mem_budget / page_size)
+        self.num_disk_pages = math.ceil(disk_mem_budget / page_size)
+        self.disk_dir = disk_dir
+        self.slab_pool = slab_pool if slab_pool is not None else PinnedSlabPool()
+        self.slab_pages = max(1, min(slab_pages, self.num_host_pages))
+
+        self.page_shape = None
+        self.dtype = None
+        self.host_slabs = []
+        self.disk_pool = None
+        self.free_host_pages = []
+        self.free_disk_pages = []
+        self.host_heap = []
+        self.disk_heap = []
+
+        self.blocks = {}
+        self.num_dropped = 0
+        # ids of the blocks left on the device, set once the memory is built (retrieval orders blocks by id)
+        self.device_block_ids = []
+        self._block_ids = None
+
+        self.spill_event = None
+        self.fetch_event = None
+        self.staging = None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __repr__(self):
+        tiers = {"host": [0, 0], "disk": [0, 0]}
+        for block in self.blocks.values():
+            tiers[block.tier][0] += 1
+            tiers[block.tier][1] += block.length
+        return f"{tiers['host'][0]} blocks ({tiers['host'][1]} tokens) on host, {tiers['disk'][0]} blocks ({tiers['disk'][1]} tokens) on disk, {self.num_dropped} dropped"
+
+    @property
+    def block_ids(self):
+        if self._block_ids is None:
+            self._block_ids = sorted(self.blocks)
+        return self._block_ids
+
+    @property
+    def lengths(self):
+        return [self.blocks[block_id].length for block_id in self.block_ids]
+
+    @property
+    def modalities(self):
+        return [self.blocks[block_id].modality for block_id in self.block_ids]
+
+    def key_summaries(self):
+        """Mean key of every block, in `block_ids` order, as `[layers, num_blocks, batch, heads, dim]`."""
+        return torch.stack([self.blocks[block_id].key_summary for block_id in self.block_ids], dim=1)
+
+    def _allocate(self, like):
+        # pools are only set up with the first spill, once the shape and dtype of the kv are known
+        num_layers, batch_size, num_heads, _, head_dim = like.shape
+        page_shape = (2, num_layers, batch_size, num_heads, self.page_size, head_dim)
+        self.page_shape, self.dtype = page_shape, like.dtype
+        if self.num_disk_pages > 0:
+            # the file is unlinked right away, its space is given back once the pool is garbage collected
+            fd, path = tempfile.mkstemp(suffix=".kv", dir=self.disk_dir or None)
+            os.close(fd)
+            page_bytes = math.prod(page_shape) * like.element_size()
+            pages = np.memmap(path, dtype=np.uint8, mode="w+", shape=(self.num_disk_pages, page_bytes))
+            os.remove(path)
+            self.disk_pool = torch.from_numpy(pages).view(like.dtype).view((self.num_disk_pages,) + page_shape)
+            self.free_disk_pages = list(range(self.num_disk_pages - 1, -1, -1))
+
+        self.spill_event = torch.cuda.Event()
+        self.fetch_event = torch.cuda.Event()
+        weakref.finalize(self, self.slab_pool.give, self.host_slabs, self.spill_event)
+
+    def _grow(self):
+        first_page = len(self.host_slabs) * self.slab_pages
+        self.host_slabs.append(self.slab_pool.take((self.slab_pages,) + self.page_shape, self.dtype))
+        self.free_host_pages.extend(range(min(first_page + self.slab_pages, self.num_host_pages) - 1, first_page - 1, -1))
+
+    def _host_runs(self, pages):
+        # `(offset, slab, first, count)` of the runs of `pages` that are consecutive within one slab
+        for offset, first_page, count in page_runs(pages):
+            while count > 0:
+                slab, first = divmod(first_page, self.slab_pages)
+                run = min(count, self.slab_pages - first)
+                yield offset, self.host_slabs[slab], first, run
+                offset, first_page, count = offset + run, first_page + run, count - run
+
+    def _drop(self, block_id):
+        block = self.blocks.pop(block_id)
+        (self.free_disk_pages if block.tier == "disk" else self.free_host_pages).extend(block.pages)
+        self.num_dropped += 1
+        self._block_ids = None
+
+    def _demote(self):
+        # the least surprising host block moves to disk, or is dropped if there is no disk tier
+        _, block_id = heapq.heappop(self.host_heap)
+        block = self.blocks[block_id]
+        if len(block.pages) > self.num_disk_pages:
+            self._drop(block_id)
+            return
+        while len(self.free_disk_pages) < len(block.pages):
+            _, dropped_id = heapq.heappop(self.disk_heap)
+            self._drop(dropped_id)
+
+        disk_pages = [self.free_disk_pages.pop() for _ in range(len(block.pages))]
+        self.spill_event.synchronize()  # the host pages may still be in flight from the device
+        for offset, slab, first, count in self._host_runs(block.pages):
+            self.disk_pool.index_copy_(0, torch.tensor(disk_pages[offset : offset + count]), slab[first : first + count])
+        self.free_host_pages.extend(block.pages)
+        block.tier, block.pages = "disk", disk_pages
+        heapq.heappush(self.disk_heap, (block.surprising_score, block_id))
+
+    def spill(self, block_id, key_states, value_states, modality, surprising_score):
+        """Take over a block evicted from the device, `key_states`/`value_states` are stacked over layers (LBHTC)."""
+        if self.page_shape is None:
+            self._allocate(key_states)
+        length = key_states.size(3)
+        num_pages = math.ceil(length / self.page_size)
+        assert num_pages <= self.num_host_pages, f"a block of {length} tokens does not fit in the host tier"
+        while len(self.free_host_pages) < num_pages:
+            if len(self.host_slabs) * self.slab_pages < self.num_host_pages:
+                self._grow()
+            else:
+                self._demote()
+        pages = [self.free_host_pages.pop() for _ in range(num_pages)]
+
+        states = torch.nn.functional.pad(torch.stack([key_states, value_states]), (0, 0, 0, num_pages * self.page_size - length))
+        states = states.unflatten(4, (num_pages, self.page_size)).permute(4, 0, 1, 2, 3, 5, 6).contiguous()  # [pages, 2, L, B, H, page_size, C]
+        for offset, slab, first, count in self._host_runs(pages):
+            slab[first : first + count].copy_(states[offset : offset + count], non_blocking=True)
+        self.spill_event.record()
+
+        self.blocks[block_id] = ColdBlock("host", pages, length, modality, surprising_score, key_states.mean(3))
+        heapq.heappush(self.host_heap, (surprising_score, block_id))
+        self._block_ids = None
+
+    def _staging(self, num_pages):
+        # pinned buffer the pages are gathered into, reused once the copies of the previous fetch are done
+        self.fetch_event.synchronize()
+        if self.staging is None or self.staging.size(0) < num_pages:
+            self.staging = torch.empty((max(num_pages, 2 * (0 if self.staging is None else self.staging.size(0))),) + self.page_shape[:1] + self.page_shape[2:], dtype=self.dtype, pin_memory=True)
+        return self.staging
+
+    def fetch(self, layer_idx, indices, device):
+        """
+        Page the blocks at `indices` (positions in `block_ids`) of one layer back to `device`, as
+        `(block_id, key_states, value_states)` (BHTC) per block. The pages are gathered into a pinned buffer and
+        copied on the current stream.
+        """
+        blocks = [(self.block_ids[_], self.blocks[self.block_ids[_]]) for _ in indices]
+        self.spill_event.synchronize()
+        staging = self._staging(sum(len(block.pages) for _, block in blocks))
+
+        offset = 0
+        for _, block in blocks:
+            if block.tier == "host":
+                for run_offset, slab, first, count in self._host_runs(block.pages):
+                    staging[offset + run_offset : offset + run_offset + count].copy_(slab[first : first + count, :, layer_idx])
+            else:
+                torch.index_select(self.disk_pool[:, :, layer_idx], 0, torch.tensor(block.pages), out=staging[offset : offset + len(block.pages)])
+            offset += len(block.pages)
+        out = staging[:offset].to(device, non_blocking=True)
+        self.fetch_event.record()
+
+        paged_in, offset = [], 0
+        for block_id, block in blocks:
+            num_pages = len(block.pages)
+            states = out[offset : offset + num_pages].permute(1, 2, 3, 0, 4, 5).flatten(3, 4)[..., : block.length, :]  # 2BHTC
+            paged_in.append((block_id, states[0], states[1]))
+            offset += num_pages
+        return paged_in
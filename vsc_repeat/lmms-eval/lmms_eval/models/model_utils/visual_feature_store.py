@@ -0,0 +1,209 @@
+import enum
+import functools
+import hashlib
+import json
+import os
+import shutil
+import types
+import uuid
+
+import numpy as np
+import torch
+
+
+def processor_config(obj, _seen=None):
+    """
+    JSON-able description of an image processor for cache keys, stable across processes: HF processors give
+    their `to_dict`, other objects (e.g. `ProcessorWrapper` and the transforms it wraps) their class name and
+    attributes, functions their qualified name. Nothing falls back to a repr holding a memory address.
+    """
+    _seen = set() if _seen is None else _seen
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, enum.Enum):
+        return f"{type(obj).__name__}.{obj.name}"
+    if isinstance(obj, (torch.Tensor, np.ndarray)):
+        return obj.tolist()
+    if isinstance(obj, (list, tuple)):
+        return [processor_config(_, _seen) for _ in obj]
+    if isinstance(obj, dict):
+        return {str(key): processor_config(value, _seen) for key, value in obj.items()}
+    if isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType, types.MethodType)):
+        return f"{obj.__module__}.{obj.__qualname__}"
+    if isinstance(obj, functools.partial):
+        return {"class": "partial", "func": processor_config(obj.func, _seen), "args": processor_config(obj.args, _seen), "keywords": processor_config(obj.keywords, _seen)}
+    if not hasattr(obj, "__dict__") or id(obj) in _seen:
+        return type(obj).__qualname__
+    _seen.add(id(obj))
+    config = obj.to_dict() if hasattr(obj, "to_dict") else vars(obj)
+    return {"class": type(obj).__qualname__, **processor_config(config, _seen)}
+
+
+class VisualFeatureStore:
+    """
+    Content-addressed on-disk store of the per-frame visual features of the streaming Cambrian-S wrappers.
+
+    Entries are keyed by a hash of the video (its size and mtime, or its content) and every setting the
+    features depend on (`make_key`). An entry is a directory holding, for every named [T, ...] tensor, fp16
+    (or uint8, for tensors appended as uint8) shards of `frames_per_shard` frames as raw memory-mappable files, plus an `index.json` with the shapes and
+    free-form metadata. Entries are written to a temporary directory that is renamed into place once complete,
+    and are read lazily by frame range (`FeatureEntry.frames`), so ingest only pages in the frames it reaches.
+    """
+
+    def __init__(self, root, frames_per_shard=1024):
+        self.root = root
+        self.frames_per_shard = frames_per_shard
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def video_identity(video_path, hash_content=False):
+        """Size and mtime of the video file, or the sha1 of its content."""
+        if not hash_content:
+            stat = os.stat(video_path)
+            return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        sha1 = hashlib.sha1()
+        with open(video_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                sha1.update(block)
+        return {"sha1": sha1.hexdigest()}
+
+    @classmethod
+    def make_key(cls, video_path, hash_content=False, **feature_kwargs):
+        """Key of the features of `video_path` computed with the given settings (any JSON-able values)."""
+        payload = json.dumps({"video": cls.video_identity(video_path, hash_content), **feature_kwargs}, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.root, key, "index.json"))
+
+    def get(self, key):
+        return FeatureEntry(os.path.join(self.root, key))
+
+    def writer(self, key):
+        return FeatureWriter(os.path.join(self.root, key), self.frames_per_shard)
+
+    def put(self, key, tensors, meta=None):
+        """Store a dict of [T, ...] tensors under `key` at once."""
+        writer = self.writer(key)
+        for name, tensor in tensors.items():
+            writer.append(name, tensor)
+        writer.finish(meta)
+
+
+class FeatureWriter:
+    """Appends frames to the named tensors of one entry; nothing is visible in the store before `finish`."""
+
+    def __init__(self, path, frames_per_shard):
+        self.path = path
+        # unique per writer, the same entry can be written by several processes or by several writers of one process
+        self.tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        self.frames_per_shard = frames_per_shard
+        self.tensors = {}  # name -> {"frame_shape": [...], "num_frames": int}
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+    def append(self, name, frames):
+        # quantization codes are kept as they are, everything else is stored in fp16
+        frames = frames.detach().to("cpu", torch.uint8 if frames.dtype == torch.uint8 else torch.float16).contiguous().numpy()
+        tensor = self.tensors.setdefault(name, {"frame_shape": list(frames.shape[1:]), "num_frames": 0, "dtype": str(frames.dtype)})
+        assert list(frames.shape[1:]) == tensor["frame_shape"], f"{name}: frames of shape {frames.shape[1:]} do not match {tensor['frame_shape']}"
+
+        start = 0
+        while start < frames.shape[0]:
+            # fill up the last shard before opening the next one
+            shard_id, offset = divmod(tensor["num_frames"], self.frames_per_shard)
+            end = start + min(frames.shape[0] - start, self.frames_per_shard - offset)
+            with open(os.path.join(self.tmp_path, f"{name}.{shard_id:05d}.bin"), "ab") as f:
+                f.write(frames[start:end].tobytes())
+            tensor["num_frames"] += end - start
+            start = end
+
+    def finish(self, meta=None):
+        index = {"frames_per_shard": self.frames_per_shard, "dtype": "float16", "tensors": self.tensors, "meta": meta or {}}
+        with open(os.path.join(self.tmp_path, "index.json"), "w") as f:
+            json.dump(index, f)
+        try:
+            os.rename(self.tmp_path, self.path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def abort(self):
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class FeatureEntry:
+    """A stored entry, whose tensors are memory-mapped shard by shard on first access."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            index = json.load(f)
+        self.frames_per_shard = index["frames_per_shard"]
+        self.tensors = index["tensors"]
+        self.dtype = index["dtype"]  # of the tensors written before they recorded their own
+        self.meta = index["meta"]
+        self.shards = {}
+
+    def shape(self, name):
+        return [self.tensors[name]["num_frames"]] + self.tensors[name]["frame_shape"]
+
+    def _dtype(self, name):
+        return np.dtype(self.tensors[name].get("dtype", self.dtype))
+
+    def _shard(self, name, shard_id):
+        if (name, shard_id) not in self.shards:
+            self.shards[(name, shard_id)] = np.memmap(os.path.join(self.path, f"{name}.{shard_id:05d}.bin"), dtype=self._dtype(name), mode="r").reshape([-1] + self.tensors[name]["frame_shape"])
+        return self.shards[(name, shard_id)]
+
+    def read(self, name, start, end):
+        """Frames `[start, end)` of tensor `name`, copied out of the shards."""
+        end = min(end, self.tensors[name]["num_frames"])
+        chunks = []
+        while start < end:
+            shard_id, offset = divmod(start, self.frames_per_shard)
+            num_frames = min(end - start, self.frames_per_shard - offset)
+            chunks.append(torch.from_numpy(np.array(self._shard(name, shard_id)[offset : offset + num_frames])))
+            start += num_frames
+        if len(chunks) == 0:
+            return torch.from_numpy(np.empty([0] + self.tensors[name]["frame_shape"], dtype=self._dtype(name)))
+        return torch.cat(chunks)
+
+    def frames(self, name, device=None):
+        return LazyFrames(self, name, device)
+
+
+class LazyFrames:
+    """
+    Tensor-like view of a stored [T, ...] tensor that only reads the frames it is sliced to. Supports `size`,
+    `shape`, `len`, slicing along frames (which returns a tensor on `device`) and one pending index over the
+    other dims with the frame dim left whole (e.g. `unpad_image`), which is applied to every read.
+    """
+
+    def __init__(self, entry, name, device=None, index=None):
+        self.entry = entry
+        self.name = name
+        self.device = device
+        self.index = index
+        shape = entry.shape(name)
+        self.shape = torch.Size(shape) if index is None else torch.empty(shape, device="meta")[index].shape
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and key[0] == slice(None):
+            assert self.index is None, "only one pending index is supported"
+            return LazyFrames(self.entry, self.name, self.device, key)
+        if isinstance(key, int):
+            key = slice(key % len(self), key % len(self) + 1)
+            return self[key][0]
+        assert isinstance(key, slice) and key.step in [None, 1], "frames can only be sliced by contiguous ranges"
+        start, end, _ = key.indices(len(self))
+        frames = self.entry.read(self.name, start, max(start, end))
+        if self.index is not None:
+            frames = frames[self.index]
+        return frames if self.device is None else frames.to(self.device)
@@ -16,7 +16,7 @@ sys.path = ["../"] + sys.path
 from cambrian.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from cambrian.conversation import conv_templates
 from cambrian.model.builder import load_pretrained_model
-from cambrian.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path, expand2square
+from cambrian.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path, expand2square, expand2square_video, supports_tensor_preprocess, preprocess_video_tensor, decode_video, processor_output_size
 
 from loguru import logger as eval_logger
 from PIL import Image
@@ -43,29 +43,7 @@ def is_image_file(file_path: str) -> bool:
 from decord import VideoReader, cpu
 
 def process_video_with_decord(video_file, model_cfg, num_threads=-1):
-
-    if num_threads < 1:
-        vr = VideoReader(video_file, ctx=cpu(0))
-    else:
-        vr = VideoReader(video_file, ctx=cpu(0), num_threads=num_threads)
-    total_frame_num = len(vr)
-    video_time = total_frame_num / vr.get_avg_fps()
-    avg_fps = round(vr.get_avg_fps() / model_cfg.video_fps)
-    frame_idx = [i for i in range(0, total_frame_num, avg_fps)]
-    frame_time = [i/avg_fps for i in frame_idx]
-
-    if model_cfg.video_max_frames > 0:
-        if len(frame_idx) > model_cfg.video_max_frames or model_cfg.video_force_sample:
-            uniform_sampled_frames = np.linspace(0, total_frame_num - 1, model_cfg.video_max_frames, dtype=int)
-            frame_idx = uniform_sampled_frames.tolist()
-            frame_time = [i/vr.get_avg_fps() for i in frame_idx]
-
-    video = vr.get_batch(frame_idx).asnumpy()
-    frame_time = ",".join([f"{i:.2f}s" for i in frame_time])
-
-    num_frames_to_sample = num_frames = len(frame_idx)
-    # https://github.com/dmlc/decord/issues/208
-    vr.seek(0)
+    video, _, video_time, frame_time, num_frames_to_sample = decode_video(video_file, model_cfg, num_threads=num_threads)
     return video, video_time, frame_time, num_frames_to_sample
 
 def process_videos(videos, image_processor, model_cfg, num_threads=-1):
@@ -75,14 +53,20 @@ def process_videos(videos, image_processor, model_cfg, num_threads=-1):
     new_videos_aux_list = []
     video_sizes = []
 
+    # decode frames just large enough for the processors
+    target_size = processor_output_size(processor_aux_list) if getattr(model_cfg, "video_decode_downscale", False) else None
+
     for video in videos:
-        video, video_time, frame_time, num_frames_to_sample = process_video_with_decord(video, model_cfg, num_threads=num_threads)
-        video_sizes.append((video.shape[2], video.shape[1], video.shape[0])) # W, H, T
-        video = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])] # covert to PIL.Image.Image
+        video, (width, height), video_time, frame_time, num_frames_to_sample = decode_video(video, model_cfg, num_threads=num_threads, target_size=target_size, pad_to_square=True)
+        video_sizes.append((width, height, video.shape[0])) # W, H, T
 
         video_aux_list = []
         for processor_aux in processor_aux_list:
-            video_aux = video
+            if supports_tensor_preprocess(processor_aux):
+                video_aux = expand2square_video(torch.from_numpy(video), tuple(int(x*255) for x in processor_aux.image_mean))
+                video_aux_list.append(preprocess_video_tensor(video_aux, processor_aux))
+                continue
+            video_aux = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])] # covert to PIL.Image.Image
             video_aux = [expand2square(image, tuple(int(x*255) for x in processor_aux.image_mean)) for image in video_aux]
             video_aux_list.append(processor_aux.preprocess(video_aux, return_tensors='pt')['pixel_values'])
 
@@ -109,6 +93,7 @@ class CambrianS(lmms):
         video_max_frames: int = 32,
         video_fps: int = 1,
         video_force_sample: bool = False,
+        video_decode_downscale: bool = False, # let decord decode frames at just the size the vision towers take
         add_time_instruction: bool = False,
         #############################
         miv_token_len: int = 196,
@@ -141,6 +126,7 @@ class CambrianS(lmms):
         self._model.config.video_max_frames = video_max_frames
         self._model.config.video_fps = video_fps
         self._model.config.video_force_sample = video_force_sample
+        self._model.config.video_decode_downscale = video_decode_downscale
         self._model.config.add_time_instruction = add_time_instruction
         self._model.config.miv_token_len = miv_token_len
         self._model.config.si_token_len = si_token_len
@@ -150,6 +136,7 @@ class CambrianS(lmms):
         eval_logger.info(f"video_max_frames: {video_max_frames}")
         eval_logger.info(f"video_fps: {video_fps}")
         eval_logger.info(f"video_force_sample: {video_force_sample}")
+        eval_logger.info(f"video_decode_downscale: {video_decode_downscale}")
         eval_logger.info(f"add_time_instruction: {add_time_instruction}")
         eval_logger.info(f"miv_token_len: {miv_token_len}")
         eval_logger.info(f"si_token_len: {si_token_len}")
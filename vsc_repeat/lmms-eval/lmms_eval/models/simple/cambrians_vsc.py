@@ -33,6 +33,11 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.episodic_kv_cache import EpisodicKVCache
+from lmms_eval.models.model_utils.memory_snapshot_cache import MemorySnapshotCache
+from lmms_eval.models.model_utils.request_prefetcher import RequestPrefetcher
+from lmms_eval.models.model_utils.streaming_kv_cache import StreamingKVCache
+from lmms_eval.models.model_utils.visual_feature_store import VisualFeatureStore, processor_config
 
 def is_video_file(file_path: str) -> bool:
     if isinstance(file_path, Image.Image):
@@ -68,6 +73,7 @@ class CambrianS_VSC(lmms):
         video_max_frames: int = -1,
         video_fps: int = 1,
         video_force_sample: bool = False,
+        video_decode_downscale: bool = False, # let decord decode frames at just the size the vision towers take
         add_time_instruction: bool = False,
         #############################
         miv_token_len: int = 64,
@@ -76,8 +82,15 @@ class CambrianS_VSC(lmms):
         anyres_max_subimages: int = 9,
         #############################
         enable_visual_feature_caching: bool = True,
+        visual_feature_hash_content: bool = False, # key cached visual features by the video content instead of its size and mtime
         sensory_window_size: int = 128, # disable sensory by setting to -1
         surprise_threshold: float = 0.,
+        rope_cache_mode: str = "pre", # "post" stores keys after RoPE in the sensory window
+        caption_batch_size: int = 8, # number of episodic captions decoded together
+        memory_snapshot_cache_size: int = 0, # number of videos whose memory is kept for later questions, disable by setting to 0
+        memory_snapshot_dir: str = "", # keep memory snapshots on disk instead of CPU
+        request_prefetch: int = 1, # requests loaded on a background thread while the current one is ingested, disable by setting to 0
+        request_prefetch_max_gb: float = 16., # cap on the host memory of the prefetched requests, no cap by setting to 0
         #############################
         **kwargs,
     ) -> None:
@@ -104,6 +117,7 @@ class CambrianS_VSC(lmms):
         self._model.config.video_max_frames = video_max_frames
         self._model.config.video_fps = video_fps
         self._model.config.video_force_sample = video_force_sample
+        self._model.config.video_decode_downscale = video_decode_downscale
         self._model.config.add_time_instruction = add_time_instruction
         self._model.config.miv_token_len = miv_token_len
         self._model.config.si_token_len = si_token_len
@@ -113,6 +127,7 @@ class CambrianS_VSC(lmms):
         eval_logger.info(f"video_max_frames: {video_max_frames}")
         eval_logger.info(f"video_fps: {video_fps}")
         eval_logger.info(f"video_force_sample: {video_force_sample}")
+        eval_logger.info(f"video_decode_downscale: {video_decode_downscale}")
         eval_logger.info(f"add_time_instruction: {add_time_instruction}")
         eval_logger.info(f"miv_token_len: {miv_token_len}")
         eval_logger.info(f"si_token_len: {si_token_len}")
@@ -121,9 +136,24 @@ class CambrianS_VSC(lmms):
 
         self.sensory_window_size = sensory_window_size
         self.surprise_threshold = surprise_threshold
+        self.rope_cache_mode = rope_cache_mode
+        self.caption_batch_size = caption_batch_size
+        self.request_prefetch = request_prefetch
+        self.request_prefetch_max_gb = request_prefetch_max_gb
 
         eval_logger.info(f"sensory_window_size: {sensory_window_size}")
         eval_logger.info(f"surprise_threshold: {surprise_threshold}")
+        eval_logger.info(f"rope_cache_mode: {rope_cache_mode}")
+        eval_logger.info(f"caption_batch_size: {caption_batch_size}")
+        eval_logger.info(f"memory_snapshot_cache_size: {memory_snapshot_cache_size}")
+        eval_logger.info(f"memory_snapshot_dir: {memory_snapshot_dir}")
+        eval_logger.info(f"visual_feature_hash_content: {visual_feature_hash_content}")
+        eval_logger.info(f"request_prefetch: {request_prefetch}")
+        eval_logger.info(f"request_prefetch_max_gb: {request_prefetch_max_gb}")
+
+        self.memory_snapshot_cache = None
+        if memory_snapshot_cache_size > 0:
+            self.memory_snapshot_cache = MemorySnapshotCache(memory_snapshot_cache_size, memory_snapshot_dir, rank=accelerator.process_index)
 
         self._config = self._model.config
 
@@ -136,9 +166,11 @@ class CambrianS_VSC(lmms):
         self.truncate_context = truncate_context
 
         self.enable_visual_feature_caching = enable_visual_feature_caching
+        self.visual_feature_hash_content = visual_feature_hash_content
+        self.visual_feature_store = None
         if self.enable_visual_feature_caching:
             self.cache_dir = os.path.join(".cache", self.pretrained, "visual_features")
-            os.makedirs(self.cache_dir, exist_ok=True)
+            self.visual_feature_store = VisualFeatureStore(self.cache_dir)
 
         if accelerator.num_processes > 1:
             assert accelerator.distributed_type in [DistributedType.FSDP, DistributedType.MULTI_GPU, DistributedType.DEEPSPEED], "Unsupported distributed type provided. Only DDP and FSDP are supported."
@@ -210,12 +242,221 @@ class CambrianS_VSC(lmms):
     def loglikelihood(self, requests: List[Instance]) -> List[Tuple[float, bool]]:
         raise NotImplementedError
 
+    def _caption_episodes(self, global_kv_cache, episode_ranges, episodic_caption_input_ids, max_new_tokens):
+        # greedy decoding of one caption per episode, with all episodes in one left-padded batch
+        past_key_values, attention_mask = global_kv_cache.episodes(episode_ranges)
+        input_ids = episodic_caption_input_ids.expand(len(episode_ranges), -1)
+        attention_mask = torch.cat([attention_mask, torch.ones_like(input_ids)], dim=1)
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=None,
+            use_cache=True,
+            return_dict=True,
+            past_key_values=past_key_values,
+            output_attentions=False,
+            output_hidden_states=True,
+        )
+        logits = out.logits[:, -1, :].softmax(-1)
+        pred = logits.argmax(dim=-1)
+        output_ids = torch.cat([torch.zeros_like(pred)[:, None].long().fill_(self._tokenizer.pad_token_id), pred[:, None]], dim=1)
+        # like in sequential decoding, an eos as first token is kept in the caption and later ones are not
+        num_tokens = torch.ones_like(pred)
+        finished = pred == self._tokenizer.eos_token_id
+
+        for _ in range(max_new_tokens - 1):
+            if finished.all():
+                break
+            attention_mask = torch.cat([attention_mask, torch.ones_like(attention_mask[:, :1])], dim=1)
+            out = self.model(
+                input_ids=output_ids[:, -1:],
+                attention_mask=attention_mask,
+                position_ids=None,
+                use_cache=True,
+                return_dict=True,
+                past_key_values=out.past_key_values,
+                output_attentions=False,
+                output_hidden_states=True,
+            )
+            logits = out.logits[:, -1, :]
+
+            # 1.1 repetation penalty by default
+            score = torch.gather(logits, 1, output_ids)
+            score = torch.where(score < 0, score * 1.1, score / 1.1)
+            logits.scatter_(1, output_ids, score)
+
+            pred = logits.argmax(dim=-1)
+            finished = finished | (pred == self._tokenizer.eos_token_id)
+            # finished captions are filled with the pad token, which is already in every row of output_ids
+            pred = pred.masked_fill(finished, self._tokenizer.pad_token_id)
+            num_tokens += (~finished).long()
+            output_ids = torch.cat([output_ids, pred[:, None]], dim=-1)
+
+        return [self.tokenizer.decode(output_ids[batch_idx, 1 : 1 + num_tokens[batch_idx]].tolist()) for batch_idx in range(len(episode_ranges))]
+
+    def _encode_frames(self, pixel_values):
+        # projected and raw vision features of a block of preprocessed [N, 3, H, W] frames, at miv_token_len tokens per frame
+        miv_side_len = int(math.sqrt(self.model.get_model().config.miv_token_len))
+        chunked_visual_features = self.model.encode_images([pixel_values.half().to(self._device)])[0]
+        vit_chunked_visual_features = chunked_visual_features.clone()
+        chunked_visual_features = self.model.get_model().mm_projector(chunked_visual_features)
+
+        feature_side_len = int(math.sqrt(chunked_visual_features.size(1)))
+        chunked_visual_features = chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
+        vit_chunked_visual_features = vit_chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
+        if feature_side_len != miv_side_len:
+            chunked_visual_features = torch.nn.functional.interpolate(chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
+            chunked_visual_features = chunked_visual_features.permute(0, 2, 3, 1)
+            vit_chunked_visual_features = torch.nn.functional.interpolate(vit_chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
+            vit_chunked_visual_features = vit_chunked_visual_features.permute(0, 2, 3, 1)
+        return chunked_visual_features, vit_chunked_visual_features
+
+    def _build_memory(self, pre_vid_input_ids, visual_tensors_type, visual_tensors, visual_sizes, visual_feature_key):
+        # stream the frames of a video through the sensory window and split them into episodes at surprising frames
+        def add_newline_tokens(visual_features):
+            visual_features = torch.cat([visual_features, self.model.model.image_newline[None, None, None, :].expand(*visual_features.size()[:2], 1, -1)], dim=2)
+            visual_features = visual_features.flatten(1, 2).flatten(0, 1)
+            return visual_features
+
+        if visual_tensors_type == "raw":
+            # extract image features
+            visual_tensors = visual_tensors[0].flatten(0, 1)
+            block_size = 128
+            visual_features = []
+            vit_visual_features = []
+
+            for bid in range(math.ceil(visual_tensors.size(0) / block_size)):
+                chunked_visual_features, vit_chunked_visual_features = self._encode_frames(visual_tensors[bid * block_size : (bid + 1) * block_size])
+
+                visual_features.append(chunked_visual_features)
+                vit_visual_features.append(vit_chunked_visual_features)
+            visual_features = torch.cat(visual_features, dim=0)
+            vit_visual_features = torch.cat(vit_visual_features, dim=0)
+
+            if self.visual_feature_store is not None:
+                eval_logger.info("Saving visual features to disk...")
+                self.visual_feature_store.put(visual_feature_key, {"features": visual_features, "vit_features": vit_visual_features}, meta={"visual_sizes": [list(_) for _ in visual_sizes]})
+        elif visual_tensors_type == "feature":
+            # skip visual encoder, frames are paged in from the feature store as the stream reaches them
+            visual_features = visual_tensors.frames("features", device=self._device)
+            vit_visual_features = visual_tensors.frames("vit_features")
+
+        else:
+            raise NotImplementedError
+
+        visual_features = unpad_image(visual_features, visual_sizes[0][:2])
+        vit_visual_features = unpad_image(vit_visual_features, visual_sizes[0][:2])
+
+        pre_img_embeds = self.model.get_input_embeddings()(pre_vid_input_ids)
+        global_kv_cache = EpisodicKVCache(self.model.config.num_hidden_layers, reserve_frames=visual_features.size(0))
+        runtime_kv_cache = StreamingKVCache(
+            self.model.config.num_hidden_layers,
+            window_size=self.sensory_window_size,
+            rope_mode=self.rope_cache_mode,
+            inv_freq=self.model.model.layers[0].self_attn.rotary_emb.inv_freq,
+        )
+
+        out = self.model(
+            input_ids=None,
+            inputs_embeds=pre_img_embeds,
+            attention_mask=None,
+            position_ids=None,
+            past_key_values=None,
+            use_cache=True,
+            output_attentions=False,
+            output_hidden_states=True,
+            return_dict=True,
+        )
+
+        global_kv_cache.set_prefix(out.past_key_values)
+        runtime_kv_cache.set_prefix(out.past_key_values)
+
+        episodic_starts = 1
+        episodic_ends = -1
+
+        episode_ranges = []
+        for frame_idx in range(visual_features.size(0)):
+
+            frame_feature = visual_features[frame_idx:frame_idx+1]
+
+            if frame_idx == 0:
+                surprisingness_score = 1.
+            else:
+                frame_feature_prediction = frame_feature_prediction.unflatten(1, (vit_visual_features.size(1), vit_visual_features.size(2) + 1))[:, :, :-1]
+                surprisingness_score = 1 - torch.cosine_similarity(frame_feature_prediction.flatten(1, 2), vit_visual_features[frame_idx:frame_idx+1].flatten(1, 2).to(frame_feature_prediction.device), dim=-1).mean(1).item()
+
+            frame_feature = add_newline_tokens(frame_feature).unsqueeze(0)
+            input_embeds = frame_feature
+
+            out = self.model(
+                input_ids=None,
+                inputs_embeds=input_embeds,
+                attention_mask=None,
+                position_ids=None,
+                use_cache=True,
+                return_dict=True,
+                past_key_values=runtime_kv_cache.layers,
+                output_attentions=False,
+                output_hidden_states=True,
+            )
+
+            hidden_states = out.hidden_states
+            frame_feature_prediction = self.model.model.nfp_head(hidden_states)
+
+            # the frame kv is already in the sensory window, the oldest frame falls out of it once it is full
+            evicted = runtime_kv_cache.commit("I", surprisingness_score)
+            if evicted is not None:
+                global_kv_cache.append(evicted)
+
+            if (frame_idx > 0 and surprisingness_score > self.surprise_threshold) or (frame_idx == visual_features.size(0) - 1):
+
+                episodic_ends = frame_idx + 1
+                if frame_idx == visual_features.size(0) - 1:
+                    episodic_ends = frame_idx + 2
+
+                episode_ranges.append((episodic_starts, episodic_ends))
+                episodic_starts = episodic_ends
+
+        # captions only read frames, so they are decoded once all frames are in the append-only cache
+        for block in runtime_kv_cache.blocks():
+            global_kv_cache.append(block)
+
+        return global_kv_cache, episode_ranges
+
+    def _memory_snapshot_key(self, video_path):
+        return MemorySnapshotCache.make_key(
+            video_path,
+            pretrained=self.pretrained,
+            video_max_frames=self._config.video_max_frames,
+            video_fps=self._config.video_fps,
+            video_force_sample=self._config.video_force_sample,
+            video_decode_downscale=self._config.video_decode_downscale,
+            miv_token_len=self._config.miv_token_len,
+            sensory_window_size=self.sensory_window_size,
+            surprise_threshold=self.surprise_threshold,
+            rope_cache_mode=self.rope_cache_mode,
+        )
+
+    def _visual_feature_key(self, video_path):
+        return VisualFeatureStore.make_key(
+            video_path,
+            hash_content=self.visual_feature_hash_content,
+            pretrained=self.pretrained,
+            video_max_frames=self._config.video_max_frames,
+            video_fps=self._config.video_fps,
+            video_force_sample=self._config.video_force_sample,
+            video_decode_downscale=self._config.video_decode_downscale,
+            miv_token_len=self._config.miv_token_len,
+            image_processors=[processor_config(image_processor) for image_processor in self._image_processor],
+        )
+
     def generate_until(self, requests) -> List[str]:
         res = []
         pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
 
         class Dataset(torch.utils.data.Dataset):
-            def __init__(self, requests, task_dict, tokenizer, image_processor, model_config, conv_template, pretrained, enable_visual_feature_caching, cache_dir):
+            def __init__(self, requests, task_dict, tokenizer, image_processor, model_config, conv_template, pretrained, visual_feature_store, visual_feature_key, memory_snapshot_cache, memory_snapshot_key):
                 self.requests = requests
                 self.task_dict = task_dict
                 self.tokenizer = tokenizer
@@ -223,23 +464,19 @@ class CambrianS_VSC(lmms):
                 self.model_config = model_config
                 self.conv_template = conv_template
                 self.pretrained = pretrained
-                self.enable_visual_feature_caching = enable_visual_feature_caching
-                self.cache_dir = cache_dir
+                self.visual_feature_store = visual_feature_store
+                self.visual_feature_key = visual_feature_key
+                self.memory_snapshot_cache = memory_snapshot_cache
+                self.memory_snapshot_key = memory_snapshot_key
 
             def __len__(self):
                 return len(self.requests)
 
             def __getitem__(self, idx):
-
-                def feature_path_exists(paths):
-                    if not self.enable_visual_feature_caching: return False
-                    for path in paths:
-                        if not os.path.exists(os.path.join(self.cache_dir, path.replace("/", "_") + ".pt")):
-                            return False
-                    return True
-
                 contexts, gen_kwargs, doc_to_visual, doc_id, task, split = self.requests[idx].args
                 visuals = doc_to_visual(self.task_dict[task][split][doc_id])
+                video_path = None
+                visual_feature_key = None
 
                 if visuals is not None:
                     qs = contexts
@@ -247,18 +484,23 @@ class CambrianS_VSC(lmms):
                         assert len(visuals) == 1
                         assert isinstance(visuals[0], str)
                         assert is_video_file(visuals[0])
-                        if not feature_path_exists(visuals):
+                        if self.visual_feature_store is not None:
+                            visual_feature_key = self.visual_feature_key(visuals[0])
+                        features_cached = visual_feature_key is not None and visual_feature_key in self.visual_feature_store
+                        if self.memory_snapshot_cache is not None and self.memory_snapshot_key(visuals[0]) in self.memory_snapshot_cache:
+                            # the memory of this video is cached, no need to decode it
+                            visual_tensors, visual_sizes = None, None
+                            visual_tensors_type = "snapshot"
+                            video_path = visuals[0]
+                        elif not features_cached:
                             visual_tensors, visual_sizes, _ = process_videos(visuals, self.image_processor, self.model_config, num_threads=1)
                             visual_tensors_type = "raw"
-                            visual_tensor_paths = [path.replace("/", "_") + ".pt" for path in visuals]
-                            visual_tensor_paths = visuals[0].replace("/", "_") + ".pt"
+                            video_path = visuals[0]
                         else:
-                            visual_tensor_paths = visuals[0].replace("/", "_") + ".pt"
-                            visual_tensors = torch.load(os.path.join(self.cache_dir, visual_tensor_paths))
-                            vit_visual_tensors = torch.load(os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_vit.pt")))
+                            video_path = visuals[0]
+                            visual_tensors = self.visual_feature_store.get(visual_feature_key)
                             visual_tensors_type = "feature"
-                            visual_tensors = (visual_tensors, vit_visual_tensors)
-                            visual_sizes = torch.load(os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_size.pt")))
+                            visual_sizes = visual_tensors.meta["visual_sizes"]
                     except Exception as e:
                         raise e
 
@@ -283,12 +525,19 @@ class CambrianS_VSC(lmms):
                 prompt = conv.get_prompt()
 
                 input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0)
-                return input_ids, visual_tensors_type, visual_tensors, visual_sizes, prompt, gen_kwargs, visual_tensor_paths, contexts, doc_id
+                return input_ids, visual_tensors_type, visual_tensors, visual_sizes, prompt, gen_kwargs, video_path, visual_feature_key, contexts, doc_id
 
-        dataset = Dataset(requests, self.task_dict, self.tokenizer, self._image_processor, self._config, self.conv_template, self.pretrained, self.enable_visual_feature_caching, self.cache_dir)
+        dataset = Dataset(requests, self.task_dict, self.tokenizer, self._image_processor, self._config, self.conv_template, self.pretrained, self.visual_feature_store, self._visual_feature_key, self.memory_snapshot_cache, self._memory_snapshot_key)
         dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=lambda x: x[0], num_workers=0, pin_memory=True)
+        # load the next requests while the current one is ingested
+        dataloader = RequestPrefetcher(dataloader, prefetch=self.request_prefetch, max_bytes=int(self.request_prefetch_max_gb * 2**30))
 
-        for _, (input_ids, visual_tensors_type, visual_tensors, visual_sizes, cur_prompt, gen_kwargs, visual_tensor_paths, contexts, doc_id) in enumerate(dataloader):
+        for request_idx, (input_ids, visual_tensors_type, visual_tensors, visual_sizes, cur_prompt, gen_kwargs, video_path, visual_feature_key, contexts, doc_id) in enumerate(dataloader):
+            pbar.set_postfix(request_wait=f"{dataloader.wait_times[-1]:.2f}s")
+            memory_snapshot_key = self._memory_snapshot_key(video_path)
+            if visual_tensors_type == "snapshot" and memory_snapshot_key not in self.memory_snapshot_cache:
+                # the snapshot was evicted after this request was prefetched, load its video after all
+                input_ids, visual_tensors_type, visual_tensors, visual_sizes, cur_prompt, gen_kwargs, video_path, visual_feature_key, contexts, doc_id = dataset[request_idx]
 
             if "max_new_tokens" not in gen_kwargs:
                 gen_kwargs["max_new_tokens"] = 16
@@ -304,71 +553,6 @@ class CambrianS_VSC(lmms):
 
             with torch.inference_mode():
 
-                def add_newline_tokens(visual_features):
-                    visual_features = torch.cat([visual_features, self.model.model.image_newline[None, None, None, :].expand(*visual_features.size()[:2], 1, -1)], dim=2)
-                    visual_features = visual_features.flatten(1, 2).flatten(0, 1)
-                    return visual_features
-
-                if visual_tensors_type == "raw":
-                    # extract image features
-                    visual_tensors = visual_tensors[0].flatten(0, 1)
-                    block_size = 128
-                    visual_features = []
-                    vit_visual_features = []
-                    miv_token_len = self.model.get_model().config.miv_token_len
-                    miv_side_len = int(math.sqrt(miv_token_len))
-
-                    for bid in range(math.ceil(visual_tensors.size(0) / block_size)):
-                        chunked_visual_features = visual_tensors[bid * block_size : (bid + 1) * block_size].half().to(self._device)
-                        chunked_visual_features = self.model.encode_images([chunked_visual_features])[0]
-                        vit_chunked_visual_features = chunked_visual_features.clone()
-                        chunked_visual_features = self.model.get_model().mm_projector(chunked_visual_features)
-                        
-                        feature_side_len = int(math.sqrt(chunked_visual_features.size(1)))
-                        chunked_visual_features = chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
-                        vit_chunked_visual_features = vit_chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
-                        if feature_side_len != miv_side_len:
-                            chunked_visual_features = torch.nn.functional.interpolate(chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
-                            chunked_visual_features = chunked_visual_features.permute(0, 2, 3, 1)
-                            vit_chunked_visual_features = torch.nn.functional.interpolate(vit_chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
-                            vit_chunked_visual_features = vit_chunked_visual_features.permute(0, 2, 3, 1)
-
-                        visual_features.append(chunked_visual_features)
-                        vit_visual_features.append(vit_chunked_visual_features)
-                    visual_features = torch.cat(visual_features, dim=0)
-                    vit_visual_features = torch.cat(vit_visual_features, dim=0)
-
-                    if self.enable_visual_feature_caching:
-                        eval_logger.info("Saving visual features to disk...")
-                        if isinstance(visual_tensor_paths, list):
-                            for _, visual_tensor_path in enumerate(visual_tensor_paths):
-                                visual_feature = visual_features[_:_+1].cpu()
-                                vit_visual_feature = vit_visual_features[_:_+1].cpu()
-                                if not os.path.exists(self.cache_dir):
-                                    os.makedirs(self.cache_dir)
-                                torch.save(visual_feature, os.path.join(self.cache_dir, visual_tensor_path))
-                                torch.save(vit_visual_feature, os.path.join(self.cache_dir, visual_tensor_path.replace(".pt", "_vit.pt")))
-                        elif isinstance(visual_tensor_paths, str):
-                            visual_feature = visual_features.cpu()
-                            vit_visual_feature = vit_visual_features.cpu()
-                            if not os.path.exists(self.cache_dir):
-                                os.makedirs(self.cache_dir)
-                            torch.save(visual_feature, os.path.join(self.cache_dir, visual_tensor_paths))
-                            torch.save(vit_visual_feature, os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_vit.pt")))
-                            torch.save(visual_sizes, os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_size.pt")))
-                        else:
-                            raise NotImplementedError
-                elif visual_tensors_type == "feature":
-                    # skip visual encoder
-                    visual_tensors, vit_visual_features = visual_tensors
-                    visual_features = visual_tensors.to(self._device)
-
-                else:
-                    raise NotImplementedError
-
-                visual_features = unpad_image(visual_features, visual_sizes[0][:2])
-                vit_visual_features = unpad_image(vit_visual_features, visual_sizes[0][:2])
-
                 from qwen2_monkey_patch import Qwen2SdpaAttention
                 for layer in self.model.model.layers:
                     layer.self_attn.__class__ = Qwen2SdpaAttention
@@ -377,191 +561,18 @@ class CambrianS_VSC(lmms):
                 CambrianQwenModel.forward = cambrian_qwen2_forward
 
                 input_ids = input_ids.to(self._device)
-                pre_img_embeds = self.model.get_input_embeddings()(pre_vid_input_ids)
-                global_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": [], "episodic_index": []} for _ in range(self.model.config.num_hidden_layers)]
-                runtime_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": []} for _ in range(self.model.config.num_hidden_layers)]
-                episodic_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": []} for _ in range(self.model.config.num_hidden_layers)]
-
-                out = self.model(
-                    input_ids=None,
-                    inputs_embeds=pre_img_embeds,
-                    attention_mask=None,
-                    position_ids=None,
-                    past_key_values=None,
-                    use_cache=True,
-                    output_attentions=False,
-                    output_hidden_states=True,
-                    return_dict=True,
-                )
-
-                for layer_idx, (key_states, value_states) in enumerate(out.past_key_values):
-                    global_kv_cache[layer_idx]["key_states"].append(key_states)
-                    global_kv_cache[layer_idx]["value_states"].append(value_states)
-                    global_kv_cache[layer_idx]["modalities"].append("T")
-                    global_kv_cache[layer_idx]["lengths"].append(key_states.size(2))
-                    global_kv_cache[layer_idx]["surprising_scores"].append(1.) # text is always surprising
-                    global_kv_cache[layer_idx]["episodic_index"].append(0)
-
-                    runtime_kv_cache[layer_idx]["key_states"].append(key_states)
-                    runtime_kv_cache[layer_idx]["value_states"].append(value_states)
-                    runtime_kv_cache[layer_idx]["modalities"].append("T")
-                    runtime_kv_cache[layer_idx]["lengths"].append(key_states.size(2))
-                    runtime_kv_cache[layer_idx]["surprising_scores"].append(1.) # text is always surprising
-
-
-                episodic_starts = 1
-                episodic_ends = -1
+                if self.memory_snapshot_cache is not None and memory_snapshot_key in self.memory_snapshot_cache:
+                    # an earlier question on this video already built its memory, possibly while this one was being prefetched
+                    global_kv_cache, episode_ranges = self.memory_snapshot_cache.get(memory_snapshot_key, self._device)
+                    global_kv_cache = EpisodicKVCache.from_snapshot(global_kv_cache)
+                else:
+                    global_kv_cache, episode_ranges = self._build_memory(pre_vid_input_ids, visual_tensors_type, visual_tensors, visual_sizes, visual_feature_key)
+                    if self.memory_snapshot_cache is not None:
+                        self.memory_snapshot_cache.put(memory_snapshot_key, (global_kv_cache.snapshot(), episode_ranges))
 
                 outputs = []
-                for frame_idx in range(visual_features.size(0)):
-
-                    past_key_values = []
-
-                    for layer_idx, layer_wise_runtime_cache in enumerate(runtime_kv_cache):
-                        past_key_values.append((
-                            torch.cat(layer_wise_runtime_cache["key_states"], dim=2),
-                            torch.cat(layer_wise_runtime_cache["value_states"], dim=2),
-                        ))
-
-                    frame_feature = visual_features[frame_idx:frame_idx+1]
-
-                    if frame_idx == 0:
-                        surprisingness_score = 1.
-                    else:
-                        frame_feature_prediction = frame_feature_prediction.unflatten(1, (vit_visual_features.size(1), vit_visual_features.size(2) + 1))[:, :, :-1]
-                        surprisingness_score = 1 - torch.cosine_similarity(frame_feature_prediction.flatten(1, 2), vit_visual_features[frame_idx:frame_idx+1].flatten(1, 2).to(frame_feature_prediction.device), dim=-1).mean(1).item()
-
-                    frame_feature = add_newline_tokens(frame_feature).unsqueeze(0)
-                    input_embeds = frame_feature
-
-                    out = self.model(
-                        input_ids=None,
-                        inputs_embeds=input_embeds,
-                        attention_mask=None,
-                        position_ids=None,
-                        use_cache=True,
-                        return_dict=True,
-                        past_key_values=past_key_values,
-                        output_attentions=False,
-                        output_hidden_states=True,
-                    )
-
-                    hidden_states = out.hidden_states
-                    frame_feature_prediction = self.model.model.nfp_head(hidden_states)
-
-                    for layer_idx, (layer_wise_past_key_values, layer_wise_output_cache) in enumerate(zip(past_key_values, out.past_key_values)):
-                        input_seq_len = layer_wise_past_key_values[0].size(2)
-                        runtime_kv_cache[layer_idx]["key_states"].append(layer_wise_output_cache[0][..., input_seq_len:, :].clone())
-                        runtime_kv_cache[layer_idx]["value_states"].append(layer_wise_output_cache[1][..., input_seq_len:, :].clone())
-                        runtime_kv_cache[layer_idx]["modalities"].append("I")
-                        runtime_kv_cache[layer_idx]["lengths"].append(runtime_kv_cache[layer_idx]["key_states"][-1].size(2))
-                        runtime_kv_cache[layer_idx]["surprising_scores"].append(surprisingness_score)
-
-                        if self.sensory_window_size > 0 and len(runtime_kv_cache[layer_idx]["key_states"]) > self.sensory_window_size + 1: # +1 for pre_img_tokens
-
-                            _key_states = runtime_kv_cache[layer_idx]["key_states"].pop(1)
-                            _value_states = runtime_kv_cache[layer_idx]["value_states"].pop(1)
-                            _modalities = runtime_kv_cache[layer_idx]["modalities"].pop(1)
-                            _surprising_score = runtime_kv_cache[layer_idx]["surprising_scores"].pop(1)
-                            _lengths = runtime_kv_cache[layer_idx]["lengths"].pop(1)
-                            
-                            global_kv_cache[layer_idx]["key_states"].append(_key_states)
-                            global_kv_cache[layer_idx]["value_states"].append(_value_states)
-                            global_kv_cache[layer_idx]["modalities"].append(_modalities)
-                            global_kv_cache[layer_idx]["lengths"].append(_lengths)
-                            global_kv_cache[layer_idx]["surprising_scores"].append(_surprising_score)
-
-                    if (frame_idx > 0 and surprisingness_score > self.surprise_threshold) or (frame_idx == visual_features.size(0) - 1):
-
-                        episodic_ends = frame_idx + 1
-                        if frame_idx == visual_features.size(0) - 1:
-                            episodic_ends = frame_idx + 2
-
-                        for layer_idx in range(len(episodic_kv_cache)):
-                            episodic_kv_cache[layer_idx]["key_states"] = []
-                            episodic_kv_cache[layer_idx]["value_states"] = []
-                            episodic_kv_cache[layer_idx]["modalities"] = []
-                            episodic_kv_cache[layer_idx]["lengths"] = []
-                            episodic_kv_cache[layer_idx]["surprising_scores"] = []
-
-                        num_kvcache_elements = len(global_kv_cache[0]["key_states"]) + len(runtime_kv_cache[0]["key_states"]) - 1
-
-                        for ele_idx in range(num_kvcache_elements):
-                            if ele_idx == 0:
-                                for layer_idx in range(len(episodic_kv_cache)):
-                                    episodic_kv_cache[layer_idx]["key_states"].append(global_kv_cache[layer_idx]["key_states"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["value_states"].append(global_kv_cache[layer_idx]["value_states"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["modalities"].append(global_kv_cache[layer_idx]["modalities"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["lengths"].append(global_kv_cache[layer_idx]["lengths"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["surprising_scores"].append(global_kv_cache[layer_idx]["surprising_scores"][ele_idx])
-                            elif ele_idx >= episodic_starts and ele_idx < episodic_ends:
-                                if ele_idx < len(global_kv_cache[0]["key_states"]):
-                                    for layer_idx in range(len(episodic_kv_cache)):
-                                        episodic_kv_cache[layer_idx]["key_states"].append(global_kv_cache[layer_idx]["key_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["value_states"].append(global_kv_cache[layer_idx]["value_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["modalities"].append(global_kv_cache[layer_idx]["modalities"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["lengths"].append(global_kv_cache[layer_idx]["lengths"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["surprising_scores"].append(global_kv_cache[layer_idx]["surprising_scores"][ele_idx])
-                                else:
-                                    ele_idx = ele_idx - len(global_kv_cache[0]["key_states"]) + 1
-                                    for layer_idx in range(len(episodic_kv_cache)):
-                                        episodic_kv_cache[layer_idx]["key_states"].append(runtime_kv_cache[layer_idx]["key_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["value_states"].append(runtime_kv_cache[layer_idx]["value_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["modalities"].append(runtime_kv_cache[layer_idx]["modalities"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["lengths"].append(runtime_kv_cache[layer_idx]["lengths"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["surprising_scores"].append(runtime_kv_cache[layer_idx]["surprising_scores"][ele_idx])
-                            else:
-                                pass
-
-                        past_key_values = []
-                        for layer_idx, layer_wise_episodic_cache in enumerate(episodic_kv_cache):
-                            past_key_values.append((
-                                torch.cat(layer_wise_episodic_cache["key_states"], dim=2),
-                                torch.cat(layer_wise_episodic_cache["value_states"], dim=2),
-                            ))
-                        assert past_key_values[0][0].size(2) == frame_feature.size(1) * (episodic_ends - episodic_starts) + global_kv_cache[0]["key_states"][0].size(2)
-                        episodic_starts = episodic_ends
-
-                        out = self.model(
-                            input_ids=episodic_caption_input_ids,
-                            attention_mask=None,
-                            position_ids=None,
-                            use_cache=True,
-                            return_dict=True,
-                            past_key_values=past_key_values,
-                            output_attentions=False,
-                            output_hidden_states=True,
-                        )
-                        logits = out.logits[:, -1, :].softmax(-1)
-                        pred = logits.argmax(dim=-1)
-                        output_ids = torch.cat([torch.zeros_like(pred)[:, None].long().fill_(self._tokenizer.pad_token_id), pred[:, None]], dim=1)
-
-                        for _ in range(gen_kwargs["max_new_tokens"] - 1):
-                            if pred == self._tokenizer.eos_token_id:
-                                break
-                            out = self.model(
-                                input_ids=output_ids[:, -1:],
-                                attention_mask=None,
-                                position_ids=None,
-                                use_cache=True,
-                                return_dict=True,
-                                past_key_values=out.past_key_values,
-                                output_attentions=False,
-                                output_hidden_states=True,
-                            )
-                            logits = out.logits[:, -1, :]
-
-                            # 1.1 repetation penalty by default
-                            score = torch.gather(logits, 1, output_ids)
-                            score = torch.where(score < 0, score * 1.1, score / 1.1)
-                            logits.scatter_(1, output_ids, score)
-
-                            pred = logits.argmax(dim=-1)
-                            if pred == self._tokenizer.eos_token_id:
-                                break
-                            output_ids = torch.cat([output_ids, pred[:, None]], dim=-1)
-
-                        outputs.append(self.tokenizer.decode(output_ids[0, 1:].tolist()))
+                for batch_start in range(0, len(episode_ranges), self.caption_batch_size):
+                    outputs.extend(self._caption_episodes(global_kv_cache, episode_ranges[batch_start : batch_start + self.caption_batch_size], episodic_caption_input_ids, gen_kwargs["max_new_tokens"]))
 
             def to_float(x):
                 try:
@@ -576,6 +587,7 @@ class CambrianS_VSC(lmms):
 
             res.append(outputs)
             pbar.update(1)
+        eval_logger.info(f"Waited {sum(dataloader.wait_times):.1f}s in total for the {len(dataloader.wait_times)} requests to load (max {max(dataloader.wait_times, default=0.):.2f}s)")
         return res
 
     def generate_until_multi_round(self, requests) -> List[str]:
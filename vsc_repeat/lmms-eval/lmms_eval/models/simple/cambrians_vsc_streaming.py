@@ -33,6 +33,9 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.episodic_kv_cache import EpisodicKVCache
+from lmms_eval.models.model_utils.request_prefetcher import RequestPrefetcher
+from lmms_eval.models.model_utils.streaming_kv_cache import StreamingKVCache
 
 def is_video_file(file_path: str) -> bool:
     if isinstance(file_path, Image.Image):
@@ -68,6 +71,7 @@ class CambrianS_VSC_Streaming(lmms):
         video_max_frames: int = -1,
         video_fps: int = 1,
         video_force_sample: bool = False,
+        video_decode_downscale: bool = False, # let decord decode frames at just the size the vision towers take
         add_time_instruction: bool = False,
         #############################
         miv_token_len: int = 64,
@@ -78,6 +82,9 @@ class CambrianS_VSC_Streaming(lmms):
         enable_visual_feature_caching: bool = True,
         sensory_window_size: int = 128, # disable sensory by setting to -1
         surprise_threshold: float = 0.,
+        rope_cache_mode: str = "pre", # "post" stores keys after RoPE in the sensory window
+        request_prefetch: int = 1, # requests loaded on a background thread while the current one is ingested, disable by setting to 0
+        request_prefetch_max_gb: float = 16., # cap on the host memory of the prefetched requests, no cap by setting to 0
         #############################
         **kwargs,
     ) -> None:
@@ -104,6 +111,7 @@ class CambrianS_VSC_Streaming(lmms):
         self._model.config.video_max_frames = video_max_frames
         self._model.config.video_fps = video_fps
         self._model.config.video_force_sample = video_force_sample
+        self._model.config.video_decode_downscale = video_decode_downscale
         self._model.config.add_time_instruction = add_time_instruction
         self._model.config.miv_token_len = miv_token_len
         self._model.config.si_token_len = si_token_len
@@ -113,6 +121,7 @@ class CambrianS_VSC_Streaming(lmms):
         eval_logger.info(f"video_max_frames: {video_max_frames}")
         eval_logger.info(f"video_fps: {video_fps}")
         eval_logger.info(f"video_force_sample: {video_force_sample}")
+        eval_logger.info(f"video_decode_downscale: {video_decode_downscale}")
         eval_logger.info(f"add_time_instruction: {add_time_instruction}")
         eval_logger.info(f"miv_token_len: {miv_token_len}")
         eval_logger.info(f"si_token_len: {si_token_len}")
@@ -121,9 +130,15 @@ class CambrianS_VSC_Streaming(lmms):
 
         self.sensory_window_size = sensory_window_size
         self.surprise_threshold = surprise_threshold
+        self.rope_cache_mode = rope_cache_mode
+        self.request_prefetch = request_prefetch
+        self.request_prefetch_max_gb = request_prefetch_max_gb
 
         eval_logger.info(f"sensory_window_size: {sensory_window_size}")
         eval_logger.info(f"surprise_threshold: {surprise_threshold}")
+        eval_logger.info(f"rope_cache_mode: {rope_cache_mode}")
+        eval_logger.info(f"request_prefetch: {request_prefetch}")
+        eval_logger.info(f"request_prefetch_max_gb: {request_prefetch_max_gb}")
 
         self._config = self._model.config
 
@@ -291,8 +306,11 @@ class CambrianS_VSC_Streaming(lmms):
 
         dataset = Dataset(requests, self.task_dict, self.tokenizer, self._image_processor, self._config, self.conv_template, self.pretrained, self.enable_visual_feature_caching, self.cache_dir)
         dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=lambda x: x[0], num_workers=0, pin_memory=True)
+        # load the next requests while the current one is ingested
+        dataloader = RequestPrefetcher(dataloader, prefetch=self.request_prefetch, max_bytes=int(self.request_prefetch_max_gb * 2**30))
 
         for _, (input_ids, visual_tensors_type, visual_tensors, visual_sizes, cur_prompt, gen_kwargs, visual_tensor_paths, contexts, doc_id, task, split) in enumerate(dataloader):
+            pbar.set_postfix(request_wait=f"{dataloader.wait_times[-1]:.2f}s")
 
             query_times = self.task_dict[task][split][doc_id]["query_times"]
 
@@ -383,9 +401,13 @@ class CambrianS_VSC_Streaming(lmms):
 
                 input_ids = input_ids.to(self._device)
                 pre_img_embeds = self.model.get_input_embeddings()(pre_vid_input_ids)
-                global_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": [], "episodic_index": []} for _ in range(self.model.config.num_hidden_layers)]
-                runtime_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": []} for _ in range(self.model.config.num_hidden_layers)]
-                episodic_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": []} for _ in range(self.model.config.num_hidden_layers)]
+                global_kv_cache = EpisodicKVCache(self.model.config.num_hidden_layers, reserve_frames=visual_features.size(0))
+                runtime_kv_cache = StreamingKVCache(
+                    self.model.config.num_hidden_layers,
+                    window_size=self.sensory_window_size,
+                    rope_mode=self.rope_cache_mode,
+                    inv_freq=self.model.model.layers[0].self_attn.rotary_emb.inv_freq,
+                )
 
                 out = self.model(
                     input_ids=None,
@@ -399,20 +421,8 @@ class CambrianS_VSC_Streaming(lmms):
                     return_dict=True,
                 )
 
-                for layer_idx, (key_states, value_states) in enumerate(out.past_key_values):
-                    global_kv_cache[layer_idx]["key_states"].append(key_states)
-                    global_kv_cache[layer_idx]["value_states"].append(value_states)
-                    global_kv_cache[layer_idx]["modalities"].append("T")
-                    global_kv_cache[layer_idx]["lengths"].append(key_states.size(2))
-                    global_kv_cache[layer_idx]["surprising_scores"].append(1.) # text is always surprising
-                    global_kv_cache[layer_idx]["episodic_index"].append(0)
-
-                    runtime_kv_cache[layer_idx]["key_states"].append(key_states)
-                    runtime_kv_cache[layer_idx]["value_states"].append(value_states)
-                    runtime_kv_cache[layer_idx]["modalities"].append("T")
-                    runtime_kv_cache[layer_idx]["lengths"].append(key_states.size(2))
-                    runtime_kv_cache[layer_idx]["surprising_scores"].append(1.) # text is always surprising
-
+                global_kv_cache.set_prefix(out.past_key_values)
+                runtime_kv_cache.set_prefix(out.past_key_values)
 
                 episodic_starts = 1
                 episodic_ends = -1
@@ -421,14 +431,6 @@ class CambrianS_VSC_Streaming(lmms):
                 intermediate_predictions = []
                 for frame_idx in range(visual_features.size(0)):
 
-                    past_key_values = []
-
-                    for layer_idx, layer_wise_runtime_cache in enumerate(runtime_kv_cache):
-                        past_key_values.append((
-                            torch.cat(layer_wise_runtime_cache["key_states"], dim=2),
-                            torch.cat(layer_wise_runtime_cache["value_states"], dim=2),
-                        ))
-
                     frame_feature = visual_features[frame_idx:frame_idx+1]
 
                     if frame_idx == 0:
@@ -447,7 +449,7 @@ class CambrianS_VSC_Streaming(lmms):
                         position_ids=None,
                         use_cache=True,
                         return_dict=True,
-                        past_key_values=past_key_values,
+                        past_key_values=runtime_kv_cache.layers,
                         output_attentions=False,
                         output_hidden_states=True,
                     )
@@ -455,27 +457,10 @@ class CambrianS_VSC_Streaming(lmms):
                     hidden_states = out.hidden_states
                     frame_feature_prediction = self.model.model.nfp_head(hidden_states)
 
-                    for layer_idx, (layer_wise_past_key_values, layer_wise_output_cache) in enumerate(zip(past_key_values, out.past_key_values)):
-                        input_seq_len = layer_wise_past_key_values[0].size(2)
-                        runtime_kv_cache[layer_idx]["key_states"].append(layer_wise_output_cache[0][..., input_seq_len:, :].clone())
-                        runtime_kv_cache[layer_idx]["value_states"].append(layer_wise_output_cache[1][..., input_seq_len:, :].clone())
-                        runtime_kv_cache[layer_idx]["modalities"].append("I")
-                        runtime_kv_cache[layer_idx]["lengths"].append(runtime_kv_cache[layer_idx]["key_states"][-1].size(2))
-                        runtime_kv_cache[layer_idx]["surprising_scores"].append(surprisingness_score)
-
-                        if self.sensory_window_size > 0 and len(runtime_kv_cache[layer_idx]["key_states"]) > self.sensory_window_size + 1: # +1 for pre_img_tokens
-
-                            _key_states = runtime_kv_cache[layer_idx]["key_states"].pop(1)
-                            _value_states = runtime_kv_cache[layer_idx]["value_states"].pop(1)
-                            _modalities = runtime_kv_cache[layer_idx]["modalities"].pop(1)
-                            _surprising_score = runtime_kv_cache[layer_idx]["surprising_scores"].pop(1)
-                            _lengths = runtime_kv_cache[layer_idx]["lengths"].pop(1)
-                            
-                            global_kv_cache[layer_idx]["key_states"].append(_key_states)
-                            global_kv_cache[layer_idx]["value_states"].append(_value_states)
-                            global_kv_cache[layer_idx]["modalities"].append(_modalities)
-                            global_kv_cache[layer_idx]["lengths"].append(_lengths)
-                            global_kv_cache[layer_idx]["surprising_scores"].append(_surprising_score)
+                    # the frame kv is already in the sensory window, the oldest frame falls out of it once it is full
+                    evicted = runtime_kv_cache.commit("I", surprisingness_score)
+                    if evicted is not None:
+                        global_kv_cache.append(evicted)
 
                     if (frame_idx > 0 and surprisingness_score > self.surprise_threshold) or (frame_idx in query_times) or (frame_idx == visual_features.size(0) - 1):
 
@@ -483,49 +468,9 @@ class CambrianS_VSC_Streaming(lmms):
                         if frame_idx == visual_features.size(0) - 1:
                             episodic_ends = frame_idx + 2
 
-                        for layer_idx in range(len(episodic_kv_cache)):
-                            episodic_kv_cache[layer_idx]["key_states"] = []
-                            episodic_kv_cache[layer_idx]["value_states"] = []
-                            episodic_kv_cache[layer_idx]["modalities"] = []
-                            episodic_kv_cache[layer_idx]["lengths"] = []
-                            episodic_kv_cache[layer_idx]["surprising_scores"] = []
-
-                        num_kvcache_elements = len(global_kv_cache[0]["key_states"]) + len(runtime_kv_cache[0]["key_states"]) - 1
-
-                        for ele_idx in range(num_kvcache_elements):
-                            if ele_idx == 0:
-                                for layer_idx in range(len(episodic_kv_cache)):
-                                    episodic_kv_cache[layer_idx]["key_states"].append(global_kv_cache[layer_idx]["key_states"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["value_states"].append(global_kv_cache[layer_idx]["value_states"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["modalities"].append(global_kv_cache[layer_idx]["modalities"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["lengths"].append(global_kv_cache[layer_idx]["lengths"][ele_idx])
-                                    episodic_kv_cache[layer_idx]["surprising_scores"].append(global_kv_cache[layer_idx]["surprising_scores"][ele_idx])
-                            elif ele_idx >= episodic_starts and ele_idx < episodic_ends:
-                                if ele_idx < len(global_kv_cache[0]["key_states"]):
-                                    for layer_idx in range(len(episodic_kv_cache)):
-                                        episodic_kv_cache[layer_idx]["key_states"].append(global_kv_cache[layer_idx]["key_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["value_states"].append(global_kv_cache[layer_idx]["value_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["modalities"].append(global_kv_cache[layer_idx]["modalities"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["lengths"].append(global_kv_cache[layer_idx]["lengths"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["surprising_scores"].append(global_kv_cache[layer_idx]["surprising_scores"][ele_idx])
-                                else:
-                                    ele_idx = ele_idx - len(global_kv_cache[0]["key_states"]) + 1
-                                    for layer_idx in range(len(episodic_kv_cache)):
-                                        episodic_kv_cache[layer_idx]["key_states"].append(runtime_kv_cache[layer_idx]["key_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["value_states"].append(runtime_kv_cache[layer_idx]["value_states"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["modalities"].append(runtime_kv_cache[layer_idx]["modalities"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["lengths"].append(runtime_kv_cache[layer_idx]["lengths"][ele_idx])
-                                        episodic_kv_cache[layer_idx]["surprising_scores"].append(runtime_kv_cache[layer_idx]["surprising_scores"][ele_idx])
-                            else:
-                                pass
-
-                        past_key_values = []
-                        for layer_idx, layer_wise_episodic_cache in enumerate(episodic_kv_cache):
-                            past_key_values.append((
-                                torch.cat(layer_wise_episodic_cache["key_states"], dim=2),
-                                torch.cat(layer_wise_episodic_cache["value_states"], dim=2),
-                            ))
-                        assert past_key_values[0][0].size(2) == frame_feature.size(1) * (episodic_ends - episodic_starts) + global_kv_cache[0]["key_states"][0].size(2)
+                        # prompt + frames [episodic_starts, episodic_ends), sliced from the global and the runtime cache
+                        past_key_values = global_kv_cache.episode(episodic_starts, episodic_ends, runtime_kv_cache)
+                        assert past_key_values[0][0].size(2) == frame_feature.size(1) * (episodic_ends - episodic_starts) + global_kv_cache.lengths[0]
 
                         if surprisingness_score > self.surprise_threshold or frame_idx == visual_features.size(0) - 1:
                             episodic_starts = episodic_ends
@@ -588,6 +533,7 @@ class CambrianS_VSC_Streaming(lmms):
 
             res.append(outputs)
             pbar.update(1)
+        eval_logger.info(f"Waited {sum(dataloader.wait_times):.1f}s in total for the {len(dataloader.wait_times)} requests to load (max {max(dataloader.wait_times, default=0.):.2f}s)")
         return res
 
     def generate_until_multi_round(self, requests) -> List[str]:
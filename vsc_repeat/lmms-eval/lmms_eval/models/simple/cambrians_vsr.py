@@ -1,8 +1,13 @@
+import contextlib
 import glob
 import math
 import os
+import queue
 import shutil
 import functools
+import threading
+import time
+import weakref
 from datetime import timedelta
 from typing import List, Optional, Tuple, Union
 from collections import defaultdict
@@ -19,24 +24,21 @@ sys.path = ["../"] + sys.path
 from cambrian.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from cambrian.conversation import conv_templates
 from cambrian.model.builder import load_pretrained_model
-from cambrian.mm_utils import tokenizer_image_token, get_model_name_from_path, expand2square
+from cambrian.mm_utils import tokenizer_image_token, get_model_name_from_path, expand2square, supports_tensor_preprocess, preprocess_video_tensor, open_video_reader, processor_output_size
 from cambrian.model.cambrian_arch import unpad_image
 
 from decord import VideoReader, cpu
 from PIL import Image
 
-def process_video_with_decor_vsr(video_file, model_cfg, num_threads=-1):
+def process_video_with_decor_vsr(video_file, model_cfg, num_threads=-1, target_size=None):
 
-    if num_threads < 1:
-        vr = VideoReader(video_file, ctx=cpu(0))
-    else:
-        vr = VideoReader(video_file, ctx=cpu(0), num_threads=num_threads)
+    vr, video_size = open_video_reader(video_file, num_threads=num_threads, target_size=target_size)
     frame_idx = list(range(len(vr)))
 
     video = vr.get_batch(frame_idx).asnumpy()
 
     vr.seek(0)
-    return video, None, None, None
+    return video, video_size, None, None
 
 
 def process_videos_vsr(videos, image_processor, model_cfg, num_threads=-1):
@@ -44,14 +46,20 @@ def process_videos_vsr(videos, image_processor, model_cfg, num_threads=-1):
     new_videos_aux_list = []
     video_sizes = []
 
+    # decode frames just large enough for the processors
+    target_size = processor_output_size(processor_aux_list) if getattr(model_cfg, "video_decode_downscale", False) else None
+
     for video in videos:
-        video, _, _, _ = process_video_with_decor_vsr(video, model_cfg, num_threads=num_threads)
-        video_sizes.append((video.shape[2], video.shape[1], video.shape[0])) # W, H, T
-        video = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])] # covert to PIL.Image.Image
+        video, (width, height), _, _ = process_video_with_decor_vsr(video, model_cfg, num_threads=num_threads, target_size=target_size)
+        video_sizes.append((width, height, video.shape[0])) # W, H, T
 
         video_aux_list = []
         for processor_aux in processor_aux_list:
-            video_aux_list.append(processor_aux.preprocess(video, return_tensors='pt')['pixel_values'])
+            if supports_tensor_preprocess(processor_aux):
+                video_aux_list.append(preprocess_video_tensor(torch.from_numpy(video), processor_aux))
+                continue
+            video_aux = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])] # covert to PIL.Image.Image
+            video_aux_list.append(processor_aux.preprocess(video_aux, return_tensors='pt')['pixel_values'])
 
         new_videos_aux_list.append(video_aux_list)
 
@@ -61,6 +69,85 @@ def process_videos_vsr(videos, image_processor, model_cfg, num_threads=-1):
     return new_videos_aux_list, video_sizes, None
 
 
+class VideoFrameStream:
+    """
+    Preprocessed frames of a video, decoded in chunks of `chunk_size` frames on a background thread that starts
+    right away, so a request prefetched by `RequestPrefetcher` is already being decoded. At most `prefetch` chunks
+    wait in a bounded queue, so host memory does not grow with the length of the video and decoding overlaps
+    with the vision encoder consuming the chunks. The stream can be iterated once.
+    """
+
+    def __init__(self, video_file, image_processor, chunk_size=128, prefetch=2, num_threads=-1, decode_downscale=False):
+        target_size = processor_output_size([image_processor]) if decode_downscale else None
+        self.vr, (width, height) = open_video_reader(video_file, num_threads=num_threads, target_size=target_size)
+        self.image_processor = image_processor
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.video_size = (width, height, len(self.vr)) # W, H, T
+
+        self.chunks = queue.Queue(maxsize=prefetch)
+        self.stop = threading.Event()
+        self.chunk_nbytes = [0]
+        self.first_chunk = threading.Event()
+        # the thread does not hold the stream, which stops it once garbage collected even if it was never iterated
+        self.producer = threading.Thread(target=self._produce, args=(self.vr, image_processor, chunk_size, self.chunks, self.stop, self.chunk_nbytes, self.first_chunk), daemon=True)
+        self.producer.start()
+        weakref.finalize(self, self.stop.set)
+
+    def __len__(self):
+        return len(self.vr)
+
+    def host_nbytes(self):
+        """Bytes the queued chunks can hold, known once the first chunk is decoded (see `request_prefetcher.host_nbytes`)."""
+        self.first_chunk.wait()
+        return self.prefetch * self.chunk_nbytes[0]
+
+    @staticmethod
+    def _produce(vr, image_processor, chunk_size, chunks, stop, chunk_nbytes, first_chunk):
+        def put(item):
+            # give up once the consumer is gone, instead of blocking on a full queue forever
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for start in range(0, len(vr), chunk_size):
+                video = vr.get_batch(list(range(start, min(start + chunk_size, len(vr))))).asnumpy()
+                if supports_tensor_preprocess(image_processor):
+                    video = preprocess_video_tensor(torch.from_numpy(video), image_processor)
+                else:
+                    video = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])] # covert to PIL.Image.Image
+                    video = image_processor.preprocess(video, return_tensors="pt")["pixel_values"]
+                if not first_chunk.is_set():
+                    chunk_nbytes[0] = video.nbytes
+                    first_chunk.set()
+                if not put(video):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        finally:
+            first_chunk.set()
+        put(None)
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            self.stop.set()
+            self.producer.join()
+
+
 def nfp_loss(pred, target, type="cosine"):
     pred_ = pred.reshape(-1, pred.size(-1))
     target_ = target.reshape(-1, target.size(-1)).type_as(pred).to(pred.device)
@@ -81,6 +168,13 @@ from tqdm import tqdm
 from lmms_eval.api.instance import Instance
 from lmms_eval.api.model import lmms
 from lmms_eval.api.registry import register_model
+from lmms_eval.models.model_utils.memory_snapshot_cache import MemorySnapshotCache
+from lmms_eval.models.model_utils.paged_kv_memory import PagedKVMemory, consolidate_memory
+from lmms_eval.models.model_utils.request_prefetcher import RequestPrefetcher
+from lmms_eval.models.model_utils.streaming_kv_cache import StreamingKVCache, batched_layers
+from lmms_eval.models.model_utils.surprise_trace import SurpriseTraceWriter, iter_surprise_trace, load_surprise_trace_prefix
+from lmms_eval.models.model_utils.tiered_kv_memory import ColdKVMemory, PinnedSlabPool
+from lmms_eval.models.model_utils.visual_feature_store import VisualFeatureStore, processor_config
 
 def is_video_file(file_path: str) -> bool:
     if isinstance(file_path, Image.Image):
@@ -96,17 +190,159 @@ def is_image_file(file_path: str) -> bool:
     _, ext = os.path.splitext(file_path)
     return ext.lower() in image_extensions
 
-def downsample_cache_states(cache_states, downsample_ratio, visual_features):
+def downsample_cache_states(cache_states, downsample_ratio, frame_size):
+    # works on BHTC as well as on kv stacked over layers (LBHTC), in a single pooling call
     cache_states_shape = cache_states.shape
-    cache_states = cache_states.flatten(0, 1).unflatten(1, (visual_features.size(1), visual_features.size(2) + 1)).permute(0, 3, 1, 2) # BHWC -> BCHW
+    cache_states = cache_states.flatten(0, -3).unflatten(1, (frame_size[0], frame_size[1] + 1)).permute(0, 3, 1, 2) # BHWC -> BCHW
     cache_states = torch.nn.functional.avg_pool2d(cache_states, kernel_size=downsample_ratio, stride=downsample_ratio)
-    cache_states = cache_states.flatten(2, 3).unflatten(0, cache_states_shape[:2]).permute(0, 1, 3, 2)
+    cache_states = cache_states.flatten(2, 3).unflatten(0, cache_states_shape[:-2]).transpose(-1, -2)
     return cache_states
 
 @functools.lru_cache(None)
 def print_once(*args, **kwargs):
     print(*args, **kwargs)
 
+class VideoIngest:
+    """
+    Streaming ingest of one video by `CambrianS_VSR`: its sensory window, its consolidated memory and the
+    prediction of its next frame. `next_chunk` stages the next frames in the window and returns their input
+    embeddings, `commit` takes the hidden states the LLM produced for them. The forward in between is run by the
+    wrapper, so the frames of several videos can share it (`ingest_batch_videos`).
+    """
+
+    def __init__(self, lm, input_ids, visual_features, vit_visual_features, surprise_trace_key):
+        self.lm = lm
+        self.visual_features = visual_features
+        self.vit_visual_features = vit_visual_features
+        self.frame_size = visual_features.shape[1:3]
+        self.num_frames = visual_features.size(0)
+
+        pre_img_tokens = input_ids[:, :torch.where(input_ids[0]==-200)[0][0]]
+        pre_img_embeds = lm.model.get_input_embeddings()(pre_img_tokens)
+        self.global_kv_cache = lm._new_global_memory()
+        self.runtime_kv_cache = StreamingKVCache(
+            lm.model.config.num_hidden_layers,
+            window_size=lm.sensory_window_size,
+            rope_mode=lm.rope_cache_mode,
+            inv_freq=lm.model.model.layers[0].self_attn.rotary_emb.inv_freq,
+        )
+
+        out = lm.model(
+            input_ids=None,
+            inputs_embeds=pre_img_embeds,
+            attention_mask=None,
+            position_ids=None,
+            past_key_values=None,
+            use_cache=True,
+            output_attentions=False,
+            output_hidden_states=True,
+            return_dict=True,
+        )
+
+        prefix_key_states = torch.stack([key_states for key_states, _ in out.past_key_values])
+        prefix_value_states = torch.stack([value_states for _, value_states in out.past_key_values])
+        self.global_kv_cache.append(
+            prefix_key_states,
+            prefix_value_states,
+            "T",
+            1., # text is always surprising
+            pinned=True,
+        )
+
+        self.runtime_kv_cache.set_prefix(out.past_key_values)
+
+        self.surprise_trace = None
+        if lm.surprise_trace_store is not None:
+            self.surprise_trace = SurpriseTraceWriter(lm.surprise_trace_store, surprise_trace_key, quant_bits=lm.surprise_trace_quant_bits, max_bytes=int(lm.surprise_trace_max_gb * 2**30))
+            self.surprise_trace.set_prefix(prefix_key_states, prefix_value_states)
+
+        self.next_frame = 0
+        self.num_fed_frames = 0 # frames that went through the LLM, without the ones the static gate skipped
+        self.frame_feature_prediction = None
+        self.static_frame_reference = None
+        self.num_static_frames = 0
+        self.chunk_vit_visual_features = None # vision features of the staged frames
+        self.requests = [] # questions waiting for the memory of this video, see `CambrianS_VSR.generate_until`
+        self.memory_snapshot_key = None
+
+    def _add_newline_tokens(self, visual_features):
+        visual_features = torch.cat([visual_features, self.lm.model.model.image_newline[None, None, None, :].expand(*visual_features.size()[:2], 1, -1)], dim=2) # BHWC -> BH(W+1)C
+        visual_features = visual_features.flatten(1, 2).flatten(0, 1) # BHWC -> (BHW)C
+        return visual_features
+
+    def next_chunk(self):
+        """Stage the next frames and return their input embeddings, `[tokens, dim]`, or None once every frame was fed."""
+        lm = self.lm
+        while self.next_frame < self.num_frames:
+            chunk_start, chunk_end = self.next_frame, min(self.next_frame + lm.ingest_chunk_frames, self.num_frames)
+            self.next_frame = chunk_end
+            chunk_visual_features = self.visual_features[chunk_start:chunk_end]
+            chunk_vit_visual_features = self.vit_visual_features[chunk_start:chunk_end].to(lm.device)
+            if lm.static_frame_threshold > 0:
+                # frames that barely change from the last frame the LLM saw skip it, it already stands for them
+                admitted, self.static_frame_reference = lm._gate_static_frames(chunk_vit_visual_features, self.static_frame_reference)
+                self.num_static_frames += chunk_vit_visual_features.size(0) - len(admitted)
+                if len(admitted) == 0:
+                    continue
+                if len(admitted) < chunk_vit_visual_features.size(0):
+                    admitted = torch.tensor(admitted, device=lm.device)
+                    chunk_visual_features = chunk_visual_features[admitted.to(chunk_visual_features.device)]
+                    chunk_vit_visual_features = chunk_vit_visual_features[admitted]
+            self.chunk_vit_visual_features = chunk_vit_visual_features
+            self.num_fed_frames += chunk_visual_features.size(0)
+
+            # with several frames per forward, every frame still only sees its own sensory window
+            self.runtime_kv_cache.stage_frames(chunk_visual_features.size(0))
+            return self._add_newline_tokens(chunk_visual_features)
+        return None
+
+    def commit(self, hidden_states):
+        """Score the staged frames from the hidden states (`[1, tokens, dim]`) of their forward and consolidate the frames leaving the window."""
+        lm = self.lm
+        num_chunk_frames = self.chunk_vit_visual_features.size(0)
+
+        # the surprise of a frame is how far it is from the prediction made at the frame before it
+        chunk_predictions = lm.model.model.nfp_head(hidden_states).unflatten(1, (num_chunk_frames, -1))[0]
+        chunk_predictions = chunk_predictions.unflatten(1, (self.vit_visual_features.size(1), self.vit_visual_features.size(2) + 1))[:, :, :-1]
+        surprisingness_scores = [1.] if self.frame_feature_prediction is None else [] # nothing predicts the first frame
+        frame_feature_predictions = chunk_predictions[:-1] if self.frame_feature_prediction is None else torch.cat([self.frame_feature_prediction, chunk_predictions[:-1]])
+        if frame_feature_predictions.size(0) > 0:
+            frame_features = self.chunk_vit_visual_features[num_chunk_frames - frame_feature_predictions.size(0):].to(frame_feature_predictions.device)
+            similarities = torch.cosine_similarity(frame_feature_predictions.flatten(1, 2), frame_features.flatten(1, 2), dim=-1).mean(1)
+            surprisingness_scores += [1 - similarity for similarity in similarities.tolist()]
+        self.frame_feature_prediction = chunk_predictions[-1:]
+
+        # the frames kv is already in the sensory window, the oldest frames fall out of it once it is full
+        for evicted in self.runtime_kv_cache.commit_frames("I", surprisingness_scores):
+            if self.surprise_trace is not None:
+                self.surprise_trace.append(evicted)
+            lm._consolidate_block(self.global_kv_cache, evicted, self.frame_size)
+
+    def finish(self):
+        """Consolidate the frames left in the sensory window and return the memory, as `CambrianS_VSR._finish_memory`."""
+        lm = self.lm
+        for block in self.runtime_kv_cache.blocks():
+            if self.surprise_trace is not None:
+                self.surprise_trace.append(block)
+            lm._consolidate_block(self.global_kv_cache, block, self.frame_size)
+
+        if self.surprise_trace is not None:
+            if not self.surprise_trace.active:
+                eval_logger.warning("The surprise trace of this video outgrew surprise_trace_max_gb and was not recorded")
+            self.surprise_trace.finish({"frame_size": list(self.frame_size)})
+
+        if lm.static_frame_threshold > 0:
+            eval_logger.info(f"Skipped {self.num_static_frames}/{self.num_frames} static frames ({self.num_static_frames / max(self.num_frames, 1):.1%})")
+            lm.static_frame_counts[0] += self.num_static_frames
+            lm.static_frame_counts[1] += self.num_frames
+
+        return lm._finish_memory(self.global_kv_cache)
+
+    def abort(self):
+        # drop the partial surprise trace, if the ingest failed
+        if self.surprise_trace is not None:
+            self.surprise_trace.abort()
+
 @register_model("cambrians_vsr")
 class CambrianS_VSR(lmms):
 
@@ -123,6 +359,7 @@ class CambrianS_VSR(lmms):
         video_max_frames: int = -1,
         video_fps: int = 1,
         video_force_sample: bool = False,
+        video_decode_downscale: bool = False, # let decord decode frames at just the size the vision towers take
         add_time_instruction: bool = False,
         #############################
         miv_token_len: int = 64,
@@ -131,12 +368,29 @@ class CambrianS_VSR(lmms):
         anyres_max_subimages: int = 9,
         #############################
         enable_visual_feature_caching: bool = False,
+        visual_feature_hash_content: bool = False, # key cached visual features by the video content instead of its size and mtime
         sensory_window_size: int = 32, # disable sensory by setting to -1
         surprise_threshold: float = 0.,
         compression_downsample_ratio: int = 2, # disable compression by setting to 1
         consolidation_method: str = "drop", # disable consolidation by setting to ""
         consolidation_mem_budget: int = 8192,
+        kv_quant_bits: int = 16, # store the consolidated memory as 8 or 4-bit codes, consolidation_mem_budget then holds 2x or 4x the tokens, disable by setting to 16
+        kv_host_mem_budget: int = 0, # tokens of memory blocks kept in pinned host memory instead of being dropped by consolidation, retrieval pages them back, disable by setting to 0
+        kv_disk_mem_budget: int = 0, # tokens of memory blocks moved on from host memory to a memory-mapped file once it is full, disable by setting to 0
+        kv_disk_dir: str = "", # directory of that file, the system temp dir if ""
         retrieval_topk: int = 1, # disable_retrieval by setting to -1
+        rope_cache_mode: str = "pre", # "post" stores keys after RoPE in the sensory window
+        memory_snapshot_cache_size: int = 0, # number of videos whose memory is kept for later questions, disable by setting to 0
+        memory_snapshot_dir: str = "", # keep memory snapshots on disk instead of CPU
+        surprise_trace_dir: str = "", # record the frame blocks leaving the sensory window there, and replay them instead of ingesting the videos on later runs, disable by setting to ""
+        surprise_trace_quant_bits: int = 8, # store the traced frame blocks as 8 or 4-bit codes, ~2 or ~1 MiB per frame for the 7B model (~4 MiB in fp16), keep the fp16 kv by setting to 16
+        surprise_trace_max_gb: float = 0., # give up the trace of a video growing past this, no cap by setting to 0
+        video_decode_prefetch: int = 2, # decoded frame chunks buffered ahead of the vision encoder, decode whole videos upfront by setting to 0
+        ingest_chunk_frames: int = 1, # frames prefilled together in one forward during ingest, feed frames one at a time by setting to 1
+        ingest_batch_videos: int = 1, # videos ingested in lock-step, one forward feeds the next frames of each and finished videos are swapped for the next requests, ingest one video at a time by setting to 1. every video in flight keeps its visual features on the device (several GB for a 4-hour "raw"/"stream" video), so peak memory grows linearly with it
+        static_frame_threshold: float = 0., # frames whose vision features change less than this (1 - cosine) from the last frame fed to the LLM skip it, disable by setting to 0
+        request_prefetch: int = 1, # requests loaded on a background thread while the current one is ingested, disable by setting to 0
+        request_prefetch_max_gb: float = 16., # cap on the host memory of the prefetched requests, no cap by setting to 0
         #############################
         **kwargs,
     ) -> None:
@@ -163,6 +417,7 @@ class CambrianS_VSR(lmms):
         self._model.config.video_max_frames = video_max_frames
         self._model.config.video_fps = video_fps
         self._model.config.video_force_sample = video_force_sample
+        self._model.config.video_decode_downscale = video_decode_downscale
         self._model.config.add_time_instruction = add_time_instruction
         self._model.config.miv_token_len = miv_token_len
         self._model.config.si_token_len = si_token_len
@@ -172,6 +427,7 @@ class CambrianS_VSR(lmms):
         eval_logger.info(f"video_max_frames: {video_max_frames}")
         eval_logger.info(f"video_fps: {video_fps}")
         eval_logger.info(f"video_force_sample: {video_force_sample}")
+        eval_logger.info(f"video_decode_downscale: {video_decode_downscale}")
         eval_logger.info(f"add_time_instruction: {add_time_instruction}")
         eval_logger.info(f"miv_token_len: {miv_token_len}")
         eval_logger.info(f"si_token_len: {si_token_len}")
@@ -183,14 +439,57 @@ class CambrianS_VSR(lmms):
         self.compression_downsample_ratio = compression_downsample_ratio
         self.consolidation_method = consolidation_method
         self.consolidation_mem_budget = consolidation_mem_budget
+        self.kv_quant_bits = kv_quant_bits
+        # the budget is in fp16 tokens, quantized tokens take a fraction of one (plus a few percent of scales)
+        self.consolidation_token_budget = consolidation_mem_budget * 16 // kv_quant_bits
+        self.kv_host_mem_budget = kv_host_mem_budget
+        self.kv_disk_mem_budget = kv_disk_mem_budget
+        self.kv_disk_dir = kv_disk_dir
+        self.kv_host_slab_pool = PinnedSlabPool()  # pinned host memory shared by the cold memories of all videos
         self.retrieval_topk = retrieval_topk
+        self.rope_cache_mode = rope_cache_mode
 
         eval_logger.info(f"sensory_window_size: {sensory_window_size}")
         eval_logger.info(f"surprise_threshold: {surprise_threshold}")
         eval_logger.info(f"compression_downsample_ratio: {compression_downsample_ratio}")
         eval_logger.info(f"consolidation_method: {consolidation_method}")
         eval_logger.info(f"consolidation_mem_budget: {consolidation_mem_budget}")
+        eval_logger.info(f"kv_quant_bits: {kv_quant_bits}")
+        eval_logger.info(f"kv_host_mem_budget: {kv_host_mem_budget}")
+        eval_logger.info(f"kv_disk_mem_budget: {kv_disk_mem_budget}")
+        eval_logger.info(f"kv_disk_dir: {kv_disk_dir}")
         eval_logger.info(f"retrieval_topk: {retrieval_topk}")
+        eval_logger.info(f"rope_cache_mode: {rope_cache_mode}")
+        eval_logger.info(f"memory_snapshot_cache_size: {memory_snapshot_cache_size}")
+        eval_logger.info(f"memory_snapshot_dir: {memory_snapshot_dir}")
+        eval_logger.info(f"surprise_trace_dir: {surprise_trace_dir}")
+        eval_logger.info(f"surprise_trace_quant_bits: {surprise_trace_quant_bits}")
+        eval_logger.info(f"surprise_trace_max_gb: {surprise_trace_max_gb}")
+        self.surprise_trace_quant_bits = surprise_trace_quant_bits
+        self.surprise_trace_max_gb = surprise_trace_max_gb
+        eval_logger.info(f"video_decode_prefetch: {video_decode_prefetch}")
+        eval_logger.info(f"ingest_chunk_frames: {ingest_chunk_frames}")
+        eval_logger.info(f"ingest_batch_videos: {ingest_batch_videos}")
+        eval_logger.info(f"static_frame_threshold: {static_frame_threshold}")
+        eval_logger.info(f"visual_feature_hash_content: {visual_feature_hash_content}")
+        self.video_decode_prefetch = video_decode_prefetch
+        self.ingest_chunk_frames = ingest_chunk_frames
+        self.ingest_batch_videos = ingest_batch_videos
+        self.static_frame_threshold = static_frame_threshold
+        self.static_frame_counts = [0, 0] # skipped and total frames of the videos ingested so far
+        eval_logger.info(f"request_prefetch: {request_prefetch}")
+        eval_logger.info(f"request_prefetch_max_gb: {request_prefetch_max_gb}")
+        self.request_prefetch = request_prefetch
+        self.request_prefetch_max_gb = request_prefetch_max_gb
+
+        assert kv_disk_mem_budget <= 0 or kv_host_mem_budget > 0, "blocks only reach the disk tier through the host tier"
+        assert kv_host_mem_budget <= 0 or not (memory_snapshot_cache_size > 0 and memory_snapshot_dir), "memory snapshots on disk cannot hold the host and disk tiers"
+        if kv_host_mem_budget > 0 and retrieval_topk <= 1:
+            eval_logger.warning("kv_host_mem_budget is set but retrieval is disabled, blocks spilled from the device are never used")
+
+        self.memory_snapshot_cache = None
+        if memory_snapshot_cache_size > 0:
+            self.memory_snapshot_cache = MemorySnapshotCache(memory_snapshot_cache_size, memory_snapshot_dir, rank=accelerator.process_index)
 
         self._config = self._model.config
 
@@ -203,10 +502,17 @@ class CambrianS_VSR(lmms):
         self.truncate_context = truncate_context
 
         self.enable_visual_feature_caching = enable_visual_feature_caching
+        self.visual_feature_hash_content = visual_feature_hash_content
 
+        self.visual_feature_store = None
         if self.enable_visual_feature_caching:
             self.cache_dir = os.path.join(".cache", self.pretrained, "visual_features")
-            os.makedirs(self.cache_dir, exist_ok=True)
+            self.visual_feature_store = VisualFeatureStore(self.cache_dir)
+
+        self.surprise_trace_store = None
+        if surprise_trace_dir:
+            # a frame block holds the kv of all layers, so shards are kept small
+            self.surprise_trace_store = VisualFeatureStore(surprise_trace_dir, frames_per_shard=64)
 
         if accelerator.num_processes > 1:
             assert accelerator.distributed_type in [DistributedType.FSDP, DistributedType.MULTI_GPU, DistributedType.DEEPSPEED], "Unsupported distributed type provided. Only DDP and FSDP are supported."
@@ -278,12 +584,295 @@ class CambrianS_VSR(lmms):
     def loglikelihood(self, requests: List[Instance]) -> List[Tuple[float, bool]]:
         raise NotImplementedError
 
+    def _consolidate_block(self, global_kv_cache, block, frame_size):
+        # move a frame leaving the sensory window into the global memory, compressing it if it is not surprising
+        key_states, value_states = block.key_states, block.value_states
+        if self.compression_downsample_ratio > 1 and block.surprising_score < self.surprise_threshold:
+            key_states = downsample_cache_states(key_states, self.compression_downsample_ratio, frame_size)
+            value_states = downsample_cache_states(value_states, self.compression_downsample_ratio, frame_size)
+
+        global_kv_cache.append(key_states, value_states, block.modality, block.surprising_score)
+        consolidate_memory(global_kv_cache, self.consolidation_method, self.consolidation_token_budget, self.surprise_threshold)
+
+    def _encode_frames(self, pixel_values):
+        # projected and raw vision features of a block of preprocessed [N, 3, H, W] frames, at miv_token_len tokens per frame
+        miv_side_len = int(math.sqrt(self.model.get_model().config.miv_token_len))
+        chunked_visual_features = self.model.encode_images([pixel_values.half().to(self._device)])[0]
+        vit_chunked_visual_features = chunked_visual_features.clone()
+        chunked_visual_features = self.model.get_model().mm_projector(chunked_visual_features)
+
+        feature_side_len = int(math.sqrt(chunked_visual_features.size(1)))
+        chunked_visual_features = chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
+        vit_chunked_visual_features = vit_chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
+        if feature_side_len != miv_side_len:
+            chunked_visual_features = torch.nn.functional.interpolate(chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
+            chunked_visual_features = chunked_visual_features.permute(0, 2, 3, 1)
+            vit_chunked_visual_features = torch.nn.functional.interpolate(vit_chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
+            vit_chunked_visual_features = vit_chunked_visual_features.permute(0, 2, 3, 1)
+        return chunked_visual_features, vit_chunked_visual_features
+
+    def _gate_static_frames(self, vit_frames, reference):
+        # indices of the frames that change by at least static_frame_threshold from the last admitted frame (`reference`), and the new last admitted frame
+        admitted, start = [], 0
+        while start < vit_frames.size(0):
+            if reference is None:
+                index = start
+            else:
+                changes = 1 - torch.cosine_similarity(vit_frames[start:].flatten(1, 2), reference.flatten(0, 1)[None], dim=-1).mean(1)
+                moving = torch.nonzero(changes >= self.static_frame_threshold)
+                if moving.numel() == 0:
+                    break
+                index = start + moving[0, 0].item()
+            admitted.append(index)
+            reference = vit_frames[index]
+            start = index + 1
+        return admitted, reference
+
+    def _new_global_memory(self):
+        # the device tier of the consolidated memory, blocks consolidation evicts go to the host and disk tiers if enabled
+        cold_memory = None
+        if self.kv_host_mem_budget > 0:
+            cold_memory = ColdKVMemory(self.model.config.num_hidden_layers, self.kv_host_mem_budget, self.kv_disk_mem_budget, self.kv_disk_dir, slab_pool=self.kv_host_slab_pool)
+        return PagedKVMemory(self.model.config.num_hidden_layers, reserve_tokens=self.consolidation_token_budget, cold_memory=cold_memory, quant_bits=self.kv_quant_bits)
+
+    def _finish_memory(self, global_kv_cache):
+        print(global_kv_cache.lengths, global_kv_cache.total_length)
+        past_key_values = global_kv_cache.materialize()
+        key_summaries = global_kv_cache.key_summaries()
+
+        cold_memory = global_kv_cache.cold_memory
+        if cold_memory is not None:
+            eval_logger.info(f"Cold memory: {cold_memory}")
+            cold_memory.device_block_ids = global_kv_cache.block_ids
+            if len(cold_memory) == 0:
+                cold_memory = None
+            else:
+                key_summaries = torch.cat([key_summaries, cold_memory.key_summaries()], dim=1)
+
+        # unit mean key of every block, [layers, num_blocks, kv_heads * dim], retrieval ranks the blocks with one matmul
+        key_summaries = torch.nn.functional.normalize(key_summaries.flatten(2), dim=-1)
+        return past_key_values, global_kv_cache.modalities, global_kv_cache.lengths, key_summaries, cold_memory
+
+    def _replay_memory(self, surprise_trace):
+        # rebuild the memory from the recorded frame blocks of a video, under the current compression and consolidation settings
+        global_kv_cache = self._new_global_memory()
+        prefix_key_states, prefix_value_states = load_surprise_trace_prefix(surprise_trace, self._device)
+        global_kv_cache.append(prefix_key_states, prefix_value_states, "T", 1., pinned=True)
+
+        for block in iter_surprise_trace(surprise_trace, self._device):
+            self._consolidate_block(global_kv_cache, block, surprise_trace.meta["frame_size"])
+
+        return self._finish_memory(global_kv_cache)
+
+    def _start_ingest(self, input_ids, visual_tensors_type, visual_tensors, visual_sizes, visual_feature_key, surprise_trace_key):
+        # encode (or load) the frames of a video and run its pre-image prompt, the frames are then fed by `_ingest_step`
+        if visual_tensors_type in ["raw", "stream"]:
+            # extract image features
+            block_size = 128
+            if visual_tensors_type == "raw":
+                visual_chunks = visual_tensors[0].flatten(0, 1).split(block_size)
+            else:
+                # a VideoFrameStream, which decodes the next blocks while the current one is encoded
+                visual_chunks = visual_tensors
+            visual_features = []
+            vit_visual_features = []
+
+            for chunked_visual_features in visual_chunks:
+                chunked_visual_features, vit_chunked_visual_features = self._encode_frames(chunked_visual_features)
+
+                visual_features.append(chunked_visual_features)
+                vit_visual_features.append(vit_chunked_visual_features)
+            visual_features = torch.cat(visual_features, dim=0)
+            vit_visual_features = torch.cat(vit_visual_features, dim=0)
+
+            if self.visual_feature_store is not None:
+                eval_logger.info("Saving visual features to disk...")
+                self.visual_feature_store.put(visual_feature_key, {"features": visual_features, "vit_features": vit_visual_features}, meta={"visual_sizes": [list(_) for _ in visual_sizes]})
+        elif visual_tensors_type == "feature":
+            # skip visual encoder, frames are paged in from the feature store as the stream reaches them
+            visual_features = visual_tensors.frames("features", device=self._device)
+            vit_visual_features = visual_tensors.frames("vit_features")
+
+        else:
+            raise NotImplementedError
+
+        visual_features = unpad_image(visual_features, visual_sizes[0][:2])
+        vit_visual_features = unpad_image(vit_visual_features, visual_sizes[0][:2])
+        return VideoIngest(self, input_ids, visual_features, vit_visual_features, surprise_trace_key)
+
+    def _ingest_step(self, ingests):
+        # feed the next frames of every video to one forward, padded to the video with the most tokens; returns the videos with no frames left
+        input_embeds, running = [], []
+        for ingest in ingests:
+            chunk_embeds = ingest.next_chunk()
+            if chunk_embeds is not None:
+                input_embeds.append(chunk_embeds)
+                running.append(ingest)
+        if len(running) == 0:
+            return ingests
+
+        num_tokens = [_.size(0) for _ in input_embeds]
+        if len(running) == 1:
+            past_key_values = running[0].runtime_kv_cache.layers
+        else:
+            past_key_values = batched_layers([ingest.runtime_kv_cache for ingest in running], num_tokens)
+        out = self.model(
+            input_ids=None,
+            inputs_embeds=torch.nn.utils.rnn.pad_sequence(input_embeds, batch_first=True),
+            attention_mask=None,
+            position_ids=None,
+            use_cache=True,
+            return_dict=True,
+            past_key_values=past_key_values,
+            output_attentions=False,
+            output_hidden_states=True,
+        )
+        for video_idx, ingest in enumerate(running):
+            ingest.commit(out.hidden_states[video_idx : video_idx + 1, : num_tokens[video_idx]])
+        return [ingest for ingest in ingests if ingest not in running]
+
+    def _build_memory(self, input_ids, visual_tensors_type, visual_tensors, visual_sizes, visual_feature_key, surprise_trace_key):
+        # stream the frames of a video through the sensory window into the consolidated memory
+        if visual_tensors_type == "trace":
+            # the frame blocks of this video were recorded by an earlier run, skip the vision encoder and the per-frame forwards
+            return self._replay_memory(visual_tensors)
+
+        ingest = self._start_ingest(input_ids, visual_tensors_type, visual_tensors, visual_sizes, visual_feature_key, surprise_trace_key)
+        with self._abort_on_error([ingest]):
+            while len(self._ingest_step([ingest])) == 0:
+                pass
+            return ingest.finish()
+
+    @contextlib.contextmanager
+    def _abort_on_error(self, ingests):
+        # a failed ingest would leave the tmp dir of its partial surprise trace behind
+        try:
+            yield
+        except BaseException:
+            for ingest in ingests:
+                ingest.abort()
+            raise
+
+    def _answer(self, input_ids, memory, gen_kwargs):
+        # answer the question of `input_ids` from the memory of its video
+        past_key_values, cache_modalities, cache_lengths, cache_key_summaries, cold_memory = memory
+        if self.retrieval_topk > 1:
+            for layer_idx, layer in enumerate(self.model.model.layers):
+                layer.self_attn.use_retrieval = True
+                layer.self_attn.retrieval_topk = self.retrieval_topk
+                layer.self_attn.cache_modalities = list(cache_modalities)
+                layer.self_attn.cache_lengths = list(cache_lengths) # extended in place by the attention
+                layer.self_attn.cache_key_summaries = cache_key_summaries[layer_idx]
+                if cold_memory is not None:
+                    layer.self_attn.cold_memory = cold_memory
+
+        post_img_tokens = input_ids[:, torch.where(input_ids[0]==-200)[0][0]+1:]
+        post_img_embeds = self.model.get_input_embeddings()(post_img_tokens)
+
+        out = self.model(
+            input_ids=None,
+            inputs_embeds=post_img_embeds,
+            attention_mask=None,
+            position_ids=None,
+            use_cache=True,
+            return_dict=True,
+            past_key_values=past_key_values,
+            output_attentions=False,
+            output_hidden_states=True,
+        )
+        past_key_values = out.past_key_values
+
+        logits = out.logits[:, -1, :]
+        pred = logits.argmax(dim=-1)
+        output_ids = torch.cat([torch.zeros_like(pred)[:, None].long().fill_(self._tokenizer.pad_token_id), pred[:, None]], dim=1)
+
+        for _ in range(gen_kwargs["max_new_tokens"] - 1):
+            if pred == self._tokenizer.eos_token_id:
+                break
+            out = self.model(
+                input_ids=output_ids[:, -1:],
+                inputs_embeds=None,
+                attention_mask=None,
+                position_ids=None,
+                use_cache=True,
+                return_dict=True,
+                past_key_values=past_key_values,
+                output_attentions=False,
+                output_hidden_states=True,
+            )
+            past_key_values = out.past_key_values
+            logits = out.logits[:, -1, :]
+            
+            # 1.1 repetation penalty by default
+            score = torch.gather(logits, 1, output_ids)
+            score = torch.where(score < 0, score * 1.1, score / 1.1)
+            logits.scatter_(1, output_ids, score)
+            
+            pred = logits.argmax(dim=-1)
+            output_ids = torch.cat([output_ids, pred[:, None]], dim=-1)
+
+        return self._tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
+
+    def _memory_snapshot_key(self, video_path):
+        return MemorySnapshotCache.make_key(
+            video_path,
+            pretrained=self.pretrained,
+            conv_template=self.conv_template,
+            video_max_frames=self._config.video_max_frames,
+            video_fps=self._config.video_fps,
+            video_force_sample=self._config.video_force_sample,
+            video_decode_downscale=self._config.video_decode_downscale,
+            miv_token_len=self._config.miv_token_len,
+            sensory_window_size=self.sensory_window_size,
+            static_frame_threshold=self.static_frame_threshold,
+            surprise_threshold=self.surprise_threshold,
+            compression_downsample_ratio=self.compression_downsample_ratio,
+            consolidation_method=self.consolidation_method,
+            consolidation_mem_budget=self.consolidation_mem_budget,
+            kv_quant_bits=self.kv_quant_bits,
+            kv_host_mem_budget=self.kv_host_mem_budget,
+            kv_disk_mem_budget=self.kv_disk_mem_budget,
+            rope_cache_mode=self.rope_cache_mode,
+        )
+
+    def _surprise_trace_key(self, video_path):
+        # everything the frame blocks depend on, but none of the settings applied after the sensory window
+        return VisualFeatureStore.make_key(
+            video_path,
+            hash_content=self.visual_feature_hash_content,
+            pretrained=self.pretrained,
+            conv_template=self.conv_template,
+            video_max_frames=self._config.video_max_frames,
+            video_fps=self._config.video_fps,
+            video_force_sample=self._config.video_force_sample,
+            video_decode_downscale=self._config.video_decode_downscale,
+            miv_token_len=self._config.miv_token_len,
+            image_processors=[processor_config(image_processor) for image_processor in self._image_processor],
+            sensory_window_size=self.sensory_window_size,
+            static_frame_threshold=self.static_frame_threshold,
+            rope_cache_mode=self.rope_cache_mode,
+            surprise_trace_quant_bits=self.surprise_trace_quant_bits,
+        )
+
+    def _visual_feature_key(self, video_path):
+        return VisualFeatureStore.make_key(
+            video_path,
+            hash_content=self.visual_feature_hash_content,
+            pretrained=self.pretrained,
+            video_max_frames=self._config.video_max_frames,
+            video_fps=self._config.video_fps,
+            video_force_sample=self._config.video_force_sample,
+            video_decode_downscale=self._config.video_decode_downscale,
+            miv_token_len=self._config.miv_token_len,
+            image_processors=[processor_config(image_processor) for image_processor in self._image_processor],
+        )
+
     def generate_until(self, requests) -> List[str]:
-        res = []
+        res = [None] * len(requests) # filled in the order the videos finish
         pbar = tqdm(total=len(requests), disable=(self.rank != 0), desc="Model Responding")
 
         class Dataset(torch.utils.data.Dataset):
-            def __init__(self, requests, task_dict, tokenizer, image_processor, model_config, conv_template, pretrained, enable_visual_feature_caching, cache_dir):
+            def __init__(self, requests, task_dict, tokenizer, image_processor, model_config, conv_template, pretrained, visual_feature_store, visual_feature_key, memory_snapshot_cache, memory_snapshot_key, surprise_trace_store, surprise_trace_key, video_decode_prefetch):
                 self.requests = requests
                 self.task_dict = task_dict
                 self.tokenizer = tokenizer
@@ -291,23 +880,23 @@ class CambrianS_VSR(lmms):
                 self.model_config = model_config
                 self.conv_template = conv_template
                 self.pretrained = pretrained
-                self.enable_visual_feature_caching = enable_visual_feature_caching
-                self.cache_dir = cache_dir
+                self.visual_feature_store = visual_feature_store
+                self.visual_feature_key = visual_feature_key
+                self.memory_snapshot_cache = memory_snapshot_cache
+                self.memory_snapshot_key = memory_snapshot_key
+                self.surprise_trace_store = surprise_trace_store
+                self.surprise_trace_key = surprise_trace_key
+                self.video_decode_prefetch = video_decode_prefetch
 
             def __len__(self):
                 return len(self.requests)
 
             def __getitem__(self, idx):
-
-                def feature_path_exists(paths):
-                    if not self.enable_visual_feature_caching: return False
-                    for path in paths:
-                        if not os.path.exists(os.path.join(self.cache_dir, path.replace("/", "_") + ".pt")):
-                            return False
-                    return True
-
                 contexts, gen_kwargs, doc_to_visual, doc_id, task, split = self.requests[idx].args
                 visuals = doc_to_visual(self.task_dict[task][split][doc_id])
+                video_path = None
+                visual_feature_key = None
+                surprise_trace_key = None
 
                 if visuals is not None:
                     qs = contexts
@@ -315,18 +904,36 @@ class CambrianS_VSR(lmms):
                         assert len(visuals) == 1
                         assert isinstance(visuals[0], str)
                         assert is_video_file(visuals[0])
-                        if not feature_path_exists(visuals):
+                        if self.visual_feature_store is not None:
+                            visual_feature_key = self.visual_feature_key(visuals[0])
+                        features_cached = visual_feature_key is not None and visual_feature_key in self.visual_feature_store
+                        if self.surprise_trace_store is not None:
+                            surprise_trace_key = self.surprise_trace_key(visuals[0])
+                        if self.memory_snapshot_cache is not None and self.memory_snapshot_key(visuals[0]) in self.memory_snapshot_cache:
+                            # the memory of this video is cached, no need to decode it
+                            visual_tensors, visual_sizes = None, None
+                            visual_tensors_type = "snapshot"
+                            video_path = visuals[0]
+                        elif surprise_trace_key is not None and surprise_trace_key in self.surprise_trace_store:
+                            # the frame blocks of this video were recorded, no need to decode it
+                            visual_tensors, visual_sizes = self.surprise_trace_store.get(surprise_trace_key), None
+                            visual_tensors_type = "trace"
+                            video_path = visuals[0]
+                        elif not features_cached and self.video_decode_prefetch > 0:
+                            # one chunk per encode_images block of the wrapper, only the first vision tower is used
+                            visual_tensors = VideoFrameStream(visuals[0], self.image_processor[0], chunk_size=128, prefetch=self.video_decode_prefetch, num_threads=-1, decode_downscale=getattr(self.model_config, "video_decode_downscale", False))
+                            visual_sizes = [visual_tensors.video_size]
+                            visual_tensors_type = "stream"
+                            video_path = visuals[0]
+                        elif not features_cached:
                             visual_tensors, visual_sizes, _ = process_videos_vsr(visuals, self.image_processor, self.model_config, num_threads=-1)
                             visual_tensors_type = "raw"
-                            visual_tensor_paths = [path.replace("/", "_") + ".pt" for path in visuals]
-                            visual_tensor_paths = visuals[0].replace("/", "_") + ".pt"
+                            video_path = visuals[0]
                         else:
-                            visual_tensor_paths = visuals[0].replace("/", "_") + ".pt"
-                            visual_tensors = torch.load(os.path.join(self.cache_dir, visual_tensor_paths))
-                            vit_visual_tensors = torch.load(os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_vit.pt")))
+                            video_path = visuals[0]
+                            visual_tensors = self.visual_feature_store.get(visual_feature_key)
                             visual_tensors_type = "feature"
-                            visual_tensors = (visual_tensors, vit_visual_tensors)
-                            visual_sizes = torch.load(os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_size.pt")))
+                            visual_sizes = visual_tensors.meta["visual_sizes"]
                     except Exception as e:
                         raise e
 
@@ -350,395 +957,98 @@ class CambrianS_VSR(lmms):
                 prompt = conv.get_prompt()
 
                 input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0)
-                return input_ids, visual_tensors_type, visual_tensors, visual_sizes, prompt, gen_kwargs, visual_tensor_paths, contexts, doc_id
+                return input_ids, visual_tensors_type, visual_tensors, visual_sizes, prompt, gen_kwargs, video_path, visual_feature_key, surprise_trace_key, contexts, doc_id
 
-        dataset = Dataset(requests, self.task_dict, self.tokenizer, self._image_processor, self._config, self.conv_template, self.pretrained, self.enable_visual_feature_caching, self.cache_dir)
+        dataset = Dataset(requests, self.task_dict, self.tokenizer, self._image_processor, self._config, self.conv_template, self.pretrained, self.visual_feature_store, self._visual_feature_key, self.memory_snapshot_cache, self._memory_snapshot_key, self.surprise_trace_store, self._surprise_trace_key, self.video_decode_prefetch)
         dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=lambda x: x[0], num_workers=0, pin_memory=True)
-
-        for _, (input_ids, visual_tensors_type, visual_tensors, visual_sizes, cur_prompt, gen_kwargs, visual_tensor_paths, contexts, doc_id) in enumerate(dataloader):
-
-            if "max_new_tokens" not in gen_kwargs:
-                gen_kwargs["max_new_tokens"] = 16
-            if "temperature" not in gen_kwargs:
-                gen_kwargs["temperature"] = 0
-            if "top_p" not in gen_kwargs:
-                gen_kwargs["top_p"] = None
-            if "num_beams" not in gen_kwargs:
-                gen_kwargs["num_beams"] = 1
-
-            with torch.inference_mode():
-
-                def add_newline_tokens(visual_features):
-                    visual_features = torch.cat([visual_features, self.model.model.image_newline[None, None, None, :].expand(*visual_features.size()[:2], 1, -1)], dim=2) # BHWC -> BH(W+1)C
-                    visual_features = visual_features.flatten(1, 2).flatten(0, 1) # BHWC -> (BHW)C
-                    return visual_features
-
-                if visual_tensors_type == "raw":
-                    # extract image features
-                    visual_tensors = visual_tensors[0].flatten(0, 1)
-                    block_size = 128
-                    visual_features = []
-                    vit_visual_features = []
-                    miv_token_len = self.model.get_model().config.miv_token_len
-                    miv_side_len = int(math.sqrt(miv_token_len))
-
-                    for bid in range(math.ceil(visual_tensors.size(0) / block_size)):
-                        chunked_visual_features = visual_tensors[bid * block_size : (bid + 1) * block_size].half().to(self._device)
-                        chunked_visual_features = self.model.encode_images([chunked_visual_features])[0]
-                        vit_chunked_visual_features = chunked_visual_features.clone()
-                        chunked_visual_features = self.model.get_model().mm_projector(chunked_visual_features)
-                        
-                        feature_side_len = int(math.sqrt(chunked_visual_features.size(1)))
-                        chunked_visual_features = chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
-                        vit_chunked_visual_features = vit_chunked_visual_features.unflatten(1, (feature_side_len, feature_side_len)).permute(0, 3, 1, 2)
-                        if feature_side_len != miv_side_len:
-                            chunked_visual_features = torch.nn.functional.interpolate(chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
-                            chunked_visual_features = chunked_visual_features.permute(0, 2, 3, 1)
-                            vit_chunked_visual_features = torch.nn.functional.interpolate(vit_chunked_visual_features, size=(miv_side_len, miv_side_len), mode="bilinear", align_corners=False)
-                            vit_chunked_visual_features = vit_chunked_visual_features.permute(0, 2, 3, 1)
-
-                        visual_features.append(chunked_visual_features)
-                        vit_visual_features.append(vit_chunked_visual_features)
-                    visual_features = torch.cat(visual_features, dim=0)
-                    vit_visual_features = torch.cat(vit_visual_features, dim=0)
-
-                    eval_logger.info("Saving visual features to disk...")
-                    if self.enable_visual_feature_caching:
-                        if isinstance(visual_tensor_paths, list):
-                            for _, visual_tensor_path in enumerate(visual_tensor_paths):
-                                visual_feature = visual_features[_:_+1].cpu()
-                                vit_visual_feature = vit_visual_features[_:_+1].cpu()
-                                if not os.path.exists(self.cache_dir):
-                                    os.makedirs(self.cache_dir)
-                                torch.save(visual_feature, os.path.join(self.cache_dir, visual_tensor_path))
-                                torch.save(vit_visual_feature, os.path.join(self.cache_dir, visual_tensor_path.replace(".pt", "_vit.pt")))
-                        elif isinstance(visual_tensor_paths, str):
-                            visual_feature = visual_features.cpu()
-                            vit_visual_feature = vit_visual_features.cpu()
-                            if not os.path.exists(self.cache_dir):
-                                os.makedirs(self.cache_dir)
-                            torch.save(visual_feature, os.path.join(self.cache_dir, visual_tensor_paths))
-                            torch.save(vit_visual_feature, os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_vit.pt")))
-                            torch.save(visual_sizes, os.path.join(self.cache_dir, visual_tensor_paths.replace(".pt", "_size.pt")))
-                        else:
-                            raise NotImplementedError
-                elif visual_tensors_type == "feature":
-                    # skip visual encoder
-                    visual_tensors, vit_visual_features = visual_tensors
-                    visual_features = visual_tensors.to(self._device)
-
-                else:
-                    raise NotImplementedError
-
-                visual_features = unpad_image(visual_features, visual_sizes[0][:2])
-                vit_visual_features = unpad_image(vit_visual_features, visual_sizes[0][:2])
-
-                from qwen2_monkey_patch import Qwen2SdpaAttention
-                for layer in self.model.model.layers:
-                    layer.self_attn.__class__ = Qwen2SdpaAttention
-                from qwen2_monkey_patch import cambrian_qwen2_forward
-                from cambrian.model.language_model.cambrian_qwen2 import CambrianQwenModel
-                CambrianQwenModel.forward = cambrian_qwen2_forward
-
-                input_ids = input_ids.to(self._device)
-                assert input_ids.size(0) == 1
-                pre_img_tokens = input_ids[:, :torch.where(input_ids[0]==-200)[0][0]]
-                pre_img_embeds = self.model.get_input_embeddings()(pre_img_tokens)
-                global_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": []} for _ in range(self.model.config.num_hidden_layers)]
-                runtime_kv_cache = [{"key_states": [], "value_states": [], "modalities": [], "lengths": [], "surprising_scores": []} for _ in range(self.model.config.num_hidden_layers)]
-
-                out = self.model(
-                    input_ids=None,
-                    inputs_embeds=pre_img_embeds,
-                    attention_mask=None,
-                    position_ids=None,
-                    past_key_values=None,
-                    use_cache=True,
-                    output_attentions=False,
-                    output_hidden_states=True,
-                    return_dict=True,
-                )
-
-                for layer_idx, (key_states, value_states) in enumerate(out.past_key_values):
-                    global_kv_cache[layer_idx]["key_states"].append(key_states)
-                    global_kv_cache[layer_idx]["value_states"].append(value_states)
-                    global_kv_cache[layer_idx]["modalities"].append("T")
-                    global_kv_cache[layer_idx]["lengths"].append(key_states.size(2))
-                    global_kv_cache[layer_idx]["surprising_scores"].append(1.) # text is always surprising
-
-                    runtime_kv_cache[layer_idx]["key_states"].append(key_states)
-                    runtime_kv_cache[layer_idx]["value_states"].append(value_states)
-                    runtime_kv_cache[layer_idx]["modalities"].append("T")
-                    runtime_kv_cache[layer_idx]["lengths"].append(key_states.size(2))
-                    runtime_kv_cache[layer_idx]["surprising_scores"].append(1.) # text is always surprising
-
-                for frame_idx in range(visual_features.size(0)):
-                    past_key_values = []
-
-                    for layer_idx, layer_wise_runtime_cache in enumerate(runtime_kv_cache):
-                        past_key_values.append((
-                            torch.cat(layer_wise_runtime_cache["key_states"], dim=2),
-                            torch.cat(layer_wise_runtime_cache["value_states"], dim=2),
-                        ))
-
-                    frame_feature = visual_features[frame_idx:frame_idx+1]
-
-                    # calculate the surprising score of current frame
-                    if frame_idx == 0:
-                        surprisingness_score = 1.
-                    else:
-                        frame_feature_prediction = frame_feature_prediction.unflatten(1, (vit_visual_features.size(1), vit_visual_features.size(2) + 1))[:, :, :-1]
-                        surprisingness_score = 1 - torch.cosine_similarity(frame_feature_prediction.flatten(1, 2), vit_visual_features[frame_idx:frame_idx+1].flatten(1, 2).to(frame_feature_prediction.device), dim=-1).mean(1).item()
-
-                    frame_feature = add_newline_tokens(frame_feature).unsqueeze(0)
-                    input_embeds = frame_feature
-
-                    out = self.model(
-                        input_ids=None,
-                        inputs_embeds=input_embeds,
-                        attention_mask=None,
-                        position_ids=None,
-                        use_cache=True,
-                        return_dict=True,
-                        past_key_values=past_key_values,
-                        output_attentions=False,
-                        output_hidden_states=True,
-                    )
-
-                    hidden_states = out.hidden_states
-                    frame_feature_prediction = self.model.model.nfp_head(hidden_states)
-
-                    for layer_idx, (layer_wise_past_key_values, layer_wise_output_cache) in enumerate(zip(past_key_values, out.past_key_values)):
-                        input_seq_len = layer_wise_past_key_values[0].size(2)
-                        runtime_kv_cache[layer_idx]["key_states"].append(layer_wise_output_cache[0][..., input_seq_len:, :].clone())
-                        runtime_kv_cache[layer_idx]["value_states"].append(layer_wise_output_cache[1][..., input_seq_len:, :].clone())
-                        runtime_kv_cache[layer_idx]["modalities"].append("I")
-                        runtime_kv_cache[layer_idx]["lengths"].append(runtime_kv_cache[layer_idx]["key_states"][-1].size(2))
-                        runtime_kv_cache[layer_idx]["surprising_scores"].append(surprisingness_score)
-
-                        if self.sensory_window_size > 0 and len(runtime_kv_cache[layer_idx]["key_states"]) > self.sensory_window_size + 1: # +1 for pre_img_tokens
-
-                            _key_states = runtime_kv_cache[layer_idx]["key_states"].pop(1)
-                            _value_states = runtime_kv_cache[layer_idx]["value_states"].pop(1)
-                            _surprising_score = runtime_kv_cache[layer_idx]["surprising_scores"].pop(1)
-                            _lengths = runtime_kv_cache[layer_idx]["lengths"].pop(1)
-
-                            if self.compression_downsample_ratio > 1 and _surprising_score < self.surprise_threshold:
-                                _key_states = downsample_cache_states(_key_states, self.compression_downsample_ratio, visual_features)
-                                _value_states = downsample_cache_states(_value_states, self.compression_downsample_ratio, visual_features)
-                                _lengths = _key_states.size(2)
-
-                            global_kv_cache[layer_idx]["key_states"].append(_key_states)
-                            global_kv_cache[layer_idx]["value_states"].append(_value_states)
-                            global_kv_cache[layer_idx]["modalities"].append(runtime_kv_cache[layer_idx]["modalities"].pop(1))
-                            global_kv_cache[layer_idx]["lengths"].append(_lengths)
-                            global_kv_cache[layer_idx]["surprising_scores"].append(_surprising_score)
-
-                            if sum(global_kv_cache[layer_idx]["lengths"]) > self.consolidation_mem_budget:
-                                if self.consolidation_method == "drop_merge":
-                                    index = 1 # start from 1 since 0 is pre_img_tokens
-                                    while True:
-                                        if index >= len(global_kv_cache[layer_idx]["surprising_scores"]) - 1:
-                                            break
-                                        if global_kv_cache[layer_idx]["surprising_scores"][index] >= self.surprise_threshold and global_kv_cache[layer_idx]["surprising_scores"][index + 1] >= self.surprise_threshold:
-                                            # merge index and index + 1
-                                            global_kv_cache[layer_idx]["key_states"][index] = (global_kv_cache[layer_idx]["key_states"][index] + global_kv_cache[layer_idx]["key_states"][index + 1]) / 2.
-                                            global_kv_cache[layer_idx]["value_states"][index] = (global_kv_cache[layer_idx]["value_states"][index] + global_kv_cache[layer_idx]["value_states"][index + 1]) / 2.
-                                            global_kv_cache[layer_idx]["surprising_scores"][index] = (global_kv_cache[layer_idx]["surprising_scores"][index] + global_kv_cache[layer_idx]["surprising_scores"][index + 1]) / 2.
-                                            global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                            torch.cuda.empty_cache()
-                                            index -= 1
-                                        index += 1
-
-                                    while True:
-                                        index = np.array(global_kv_cache[layer_idx]["surprising_scores"][1:]).argmin()
-                                        global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                        torch.cuda.empty_cache()
-                                        
-                                        # merge if possible
-                                        if index > 0 and index < len(global_kv_cache[layer_idx]["surprising_scores"]) - 1 and global_kv_cache[layer_idx]["surprising_scores"][index] >= self.surprise_threshold and global_kv_cache[layer_idx]["surprising_scores"][index + 1] >= self.surprise_threshold:
-                                            global_kv_cache[layer_idx]["key_states"][index] = (global_kv_cache[layer_idx]["key_states"][index] + global_kv_cache[layer_idx]["key_states"][index + 1]) / 2.
-                                            global_kv_cache[layer_idx]["value_states"][index] = (global_kv_cache[layer_idx]["value_states"][index] + global_kv_cache[layer_idx]["value_states"][index + 1]) / 2.
-                                            global_kv_cache[layer_idx]["surprising_scores"][index] = (global_kv_cache[layer_idx]["surprising_scores"][index] + global_kv_cache[layer_idx]["surprising_scores"][index + 1]) / 2.
-                                            global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                            global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                            torch.cuda.empty_cache()
-
-                                        if sum(global_kv_cache[layer_idx]["lengths"]) < self.consolidation_mem_budget:
-                                            break
-                                elif self.consolidation_method == "drop":
-                                    while True:
-                                        # drop the frame with the smallest surprise
-                                        index = np.array(global_kv_cache[layer_idx]["surprising_scores"][1:]).argmin()
-                                        global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                        torch.cuda.empty_cache()
-                                        
-                                        if sum(global_kv_cache[layer_idx]["lengths"]) < self.consolidation_mem_budget:
-                                            break
-                                else:
-                                    raise NotImplementedError
-
-                for layer_idx in range(self.model.config.num_hidden_layers):
-                    for cache_idx in range(len(runtime_kv_cache[layer_idx]["key_states"])):
-                        if cache_idx == 0: continue
-                        _key_states = runtime_kv_cache[layer_idx]["key_states"][cache_idx]
-                        _value_states = runtime_kv_cache[layer_idx]["value_states"][cache_idx]
-                        _surprising_score = runtime_kv_cache[layer_idx]["surprising_scores"][cache_idx]
-                        _lengths = runtime_kv_cache[layer_idx]["lengths"][cache_idx]
-
-                        if self.compression_downsample_ratio > 1 and _surprising_score < self.surprise_threshold:
-                            _key_states = downsample_cache_states(_key_states, self.compression_downsample_ratio, visual_features)
-                            _value_states = downsample_cache_states(_value_states, self.compression_downsample_ratio, visual_features)
-                            _lengths = _key_states.size(2)
-
-                        global_kv_cache[layer_idx]["key_states"].append(_key_states)
-                        global_kv_cache[layer_idx]["value_states"].append(_value_states)
-                        global_kv_cache[layer_idx]["modalities"].append(runtime_kv_cache[layer_idx]["modalities"][cache_idx])
-                        global_kv_cache[layer_idx]["lengths"].append(_lengths)
-                        global_kv_cache[layer_idx]["surprising_scores"].append(_surprising_score)
-                        
-                        if sum(global_kv_cache[layer_idx]["lengths"]) > self.consolidation_mem_budget:
-                            if self.consolidation_method == "drop_merge":
-                                index = 1
-                                while True:
-                                    if index >= len(global_kv_cache[layer_idx]["surprising_scores"]) - 1:
-                                        break
-                                    if global_kv_cache[layer_idx]["surprising_scores"][index] >= self.surprise_threshold and global_kv_cache[layer_idx]["surprising_scores"][index + 1] >= self.surprise_threshold:
-                                        # merge index and index + 1
-                                        global_kv_cache[layer_idx]["key_states"][index] = (global_kv_cache[layer_idx]["key_states"][index] + global_kv_cache[layer_idx]["key_states"][index + 1]) / 2.
-                                        global_kv_cache[layer_idx]["value_states"][index] = (global_kv_cache[layer_idx]["value_states"][index] + global_kv_cache[layer_idx]["value_states"][index + 1]) / 2.
-                                        global_kv_cache[layer_idx]["surprising_scores"][index] = (global_kv_cache[layer_idx]["surprising_scores"][index] + global_kv_cache[layer_idx]["surprising_scores"][index + 1]) / 2.
-                                        global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                        torch.cuda.empty_cache()
-                                        index -= 1
-                                    index += 1
-
-                                while True:
-                                    index = np.array(global_kv_cache[layer_idx]["surprising_scores"][1:]).argmin()
-                                    global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                    torch.cuda.empty_cache()
-                                    
-                                    # merge if possible
-                                    if index > 0 and index < len(global_kv_cache[layer_idx]["surprising_scores"]) - 1 and global_kv_cache[layer_idx]["surprising_scores"][index] >= self.surprise_threshold and global_kv_cache[layer_idx]["surprising_scores"][index + 1] >= self.surprise_threshold:
-                                        global_kv_cache[layer_idx]["key_states"][index] = (global_kv_cache[layer_idx]["key_states"][index] + global_kv_cache[layer_idx]["key_states"][index + 1]) / 2.
-                                        global_kv_cache[layer_idx]["value_states"][index] = (global_kv_cache[layer_idx]["value_states"][index] + global_kv_cache[layer_idx]["value_states"][index + 1]) / 2.
-                                        global_kv_cache[layer_idx]["surprising_scores"][index] = (global_kv_cache[layer_idx]["surprising_scores"][index] + global_kv_cache[layer_idx]["surprising_scores"][index + 1]) / 2.
-                                        global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                        global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                        torch.cuda.empty_cache()
-
-                                    if sum(global_kv_cache[layer_idx]["lengths"]) < self.consolidation_mem_budget:
-                                        break
-                            elif self.consolidation_method == "drop":
-                                while True:
-                                    index = np.array(global_kv_cache[layer_idx]["surprising_scores"][1:]).argmin()
-                                    global_kv_cache[layer_idx]["key_states"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["value_states"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["modalities"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["lengths"].pop(index + 1)
-                                    global_kv_cache[layer_idx]["surprising_scores"].pop(index + 1)
-                                    torch.cuda.empty_cache()
-                                    if sum(global_kv_cache[layer_idx]["lengths"]) < self.consolidation_mem_budget:
-                                        break
-                            else:
-                                raise NotImplementedError
-
-                past_key_values = []
-
-                for layer_idx in range(self.model.config.num_hidden_layers):
-                    if layer_idx == 0:
-                        print(global_kv_cache[layer_idx]["lengths"], sum(global_kv_cache[layer_idx]["lengths"]))
-                    global_kv_cache[layer_idx]["key_states"] = torch.cat(global_kv_cache[layer_idx]["key_states"], dim=2)
-                    global_kv_cache[layer_idx]["value_states"] = torch.cat(global_kv_cache[layer_idx]["value_states"], dim=2)
-                    past_key_values.append((
-                        global_kv_cache[layer_idx]["key_states"],
-                        global_kv_cache[layer_idx]["value_states"],
-                    ))
-
-                if self.retrieval_topk > 1:
-                    for layer_idx, layer in enumerate(self.model.model.layers):
-                        layer.self_attn.use_retrieval = True
-                        layer.self_attn.retrieval_topk = self.retrieval_topk
-                        layer.self_attn.cache_modalities = global_kv_cache[layer_idx]["modalities"]
-                        layer.self_attn.cache_lengths = global_kv_cache[layer_idx]["lengths"]
-
-                post_img_tokens = input_ids[:, torch.where(input_ids[0]==-200)[0][0]+1:]
-                post_img_embeds = self.model.get_input_embeddings()(post_img_tokens)
-
-                out = self.model(
-                    input_ids=None,
-                    inputs_embeds=post_img_embeds,
-                    attention_mask=None,
-                    position_ids=None,
-                    use_cache=True,
-                    return_dict=True,
-                    past_key_values=past_key_values,
-                    output_attentions=False,
-                    output_hidden_states=True,
-                )
-                past_key_values = out.past_key_values
-
-                logits = out.logits[:, -1, :]
-                pred = logits.argmax(dim=-1)
-                output_ids = torch.cat([torch.zeros_like(pred)[:, None].long().fill_(self._tokenizer.pad_token_id), pred[:, None]], dim=1)
-
-                for _ in range(gen_kwargs["max_new_tokens"] - 1):
-                    if pred == self._tokenizer.eos_token_id:
-                        break
-                    out = self.model(
-                        input_ids=output_ids[:, -1:],
-                        inputs_embeds=None,
-                        attention_mask=None,
-                        position_ids=None,
-                        use_cache=True,
-                        return_dict=True,
-                        past_key_values=past_key_values,
-                        output_attentions=False,
-                        output_hidden_states=True,
-                    )
-                    past_key_values = out.past_key_values
-                    logits = out.logits[:, -1, :]
-                    
-                    # 1.1 repetation penalty by default
-                    score = torch.gather(logits, 1, output_ids)
-                    score = torch.where(score < 0, score * 1.1, score / 1.1)
-                    logits.scatter_(1, output_ids, score)
-                    
-                    pred = logits.argmax(dim=-1)
-                    output_ids = torch.cat([output_ids, pred[:, None]], dim=-1)
-
-            outputs = self._tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
-
+        # load the next requests while the current one is ingested
+        dataloader = RequestPrefetcher(dataloader, prefetch=self.request_prefetch, max_bytes=int(self.request_prefetch_max_gb * 2**30))
+
+        from qwen2_monkey_patch import Qwen2SdpaAttention
+        for layer in self.model.model.layers:
+            layer.self_attn.__class__ = Qwen2SdpaAttention
+        from qwen2_monkey_patch import cambrian_qwen2_forward
+        from cambrian.model.language_model.cambrian_qwen2 import CambrianQwenModel
+        CambrianQwenModel.forward = cambrian_qwen2_forward
+
+        def respond(request, memory):
+            request_idx, input_ids, cur_prompt, gen_kwargs = request
+            outputs = self._answer(input_ids, memory, gen_kwargs)
             eval_logger.info(f"Question: {cur_prompt}")
             eval_logger.info(f"Answer: {outputs}")
-            res.append(outputs)
+            res[request_idx] = outputs
             pbar.update(1)
+
+        def remember(memory_snapshot_key, memory):
+            if self.memory_snapshot_cache is not None:
+                # the host and disk tiers are kept by reference, they are never written again
+                self.memory_snapshot_cache.put(memory_snapshot_key, memory)
+            return memory
+
+        # videos being ingested in lock-step, like continuous batching: once a video has no frames left its
+        # questions are answered and the next request takes its place
+        ingests = []
+        pending = enumerate(dataloader)
+        num_ingested_frames, ingest_time = 0, 0.
+        with torch.inference_mode(), self._abort_on_error(ingests):
+            while True:
+                while len(ingests) < self.ingest_batch_videos:
+                    item = next(pending, None)
+                    if item is None:
+                        break
+                    request_idx, (input_ids, visual_tensors_type, visual_tensors, visual_sizes, cur_prompt, gen_kwargs, video_path, visual_feature_key, surprise_trace_key, contexts, doc_id) = item
+                    pbar.set_postfix(request_wait=f"{dataloader.wait_times[-1]:.2f}s")
+                    memory_snapshot_key = self._memory_snapshot_key(video_path)
+                    if visual_tensors_type == "snapshot" and memory_snapshot_key not in self.memory_snapshot_cache:
+                        # the snapshot was evicted after this request was prefetched, load its video after all
+                        input_ids, visual_tensors_type, visual_tensors, visual_sizes, cur_prompt, gen_kwargs, video_path, visual_feature_key, surprise_trace_key, contexts, doc_id = dataset[request_idx]
+
+                    if "max_new_tokens" not in gen_kwargs:
+                        gen_kwargs["max_new_tokens"] = 16
+                    if "temperature" not in gen_kwargs:
+                        gen_kwargs["temperature"] = 0
+                    if "top_p" not in gen_kwargs:
+                        gen_kwargs["top_p"] = None
+                    if "num_beams" not in gen_kwargs:
+                        gen_kwargs["num_beams"] = 1
+
+                    input_ids = input_ids.to(self._device)
+                    assert input_ids.size(0) == 1
+                    request = (request_idx, input_ids, cur_prompt, gen_kwargs)
+                    ingesting = [ingest for ingest in ingests if ingest.memory_snapshot_key == memory_snapshot_key]
+                    if self.memory_snapshot_cache is not None and memory_snapshot_key in self.memory_snapshot_cache:
+                        # an earlier question on this video already built its memory, possibly while this one was being prefetched
+                        respond(request, self.memory_snapshot_cache.get(memory_snapshot_key, self._device))
+                    elif len(ingesting) > 0:
+                        # an earlier question on this video is still ingesting it, wait for its memory instead of ingesting (and tracing) it twice
+                        ingesting[0].requests.append(request)
+                    elif visual_tensors_type == "trace":
+                        respond(request, remember(memory_snapshot_key, self._build_memory(input_ids, visual_tensors_type, visual_tensors, visual_sizes, visual_feature_key, surprise_trace_key)))
+                    else:
+                        ingest = self._start_ingest(input_ids, visual_tensors_type, visual_tensors, visual_sizes, visual_feature_key, surprise_trace_key)
+                        ingest.memory_snapshot_key = memory_snapshot_key
+                        ingest.requests.append(request)
+                        ingests.append(ingest)
+
+                if len(ingests) == 0:
+                    break
+
+                start = time.perf_counter()
+                finished = self._ingest_step(ingests)
+                ingest_time += time.perf_counter() - start
+                for ingest in finished:
+                    num_ingested_frames += ingest.num_fed_frames
+                    memory = remember(ingest.memory_snapshot_key, ingest.finish())
+                    for request in ingest.requests:
+                        respond(request, memory)
+                ingests[:] = [ingest for ingest in ingests if ingest not in finished] # in place, `_abort_on_error` holds the list
+
+        eval_logger.info(f"Waited {sum(dataloader.wait_times):.1f}s in total for the {len(dataloader.wait_times)} requests to load (max {max(dataloader.wait_times, default=0.):.2f}s)")
+        # aggregate throughput of the frame forwards, without the vision encoder, the questions and the frames skipped by the static gate
+        eval_logger.info(f"Fed {num_ingested_frames} frames to the LLM in {ingest_time:.1f}s ({num_ingested_frames / max(ingest_time, 1e-8):.1f} frames/s) with up to {self.ingest_batch_videos} videos per forward")
+        if self.static_frame_threshold > 0:
+            num_static_frames, num_frames = self.static_frame_counts
+            eval_logger.info(f"Skipped {num_static_frames}/{num_frames} static frames in total ({num_static_frames / max(num_frames, 1):.1%})")
         return res
 
     def generate_until_multi_round(self, requests) -> List[str]:
@@ -1,4 +1,5 @@
 from transformers.models.qwen2.modeling_qwen2 import Qwen2Attention, repeat_kv
+import math
 import torch
 from typing import Optional, Tuple
 from transformers.cache_utils import Cache
@@ -7,6 +8,8 @@ import logging
 from transformers.modeling_attn_mask_utils import _prepare_4d_causal_attention_mask_for_sdpa
 from transformers.modeling_outputs import BaseModelOutputWithPast
 
+from lmms_eval.models.model_utils.streaming_kv_cache import chunked_frame_attention, rotary_cos_sin
+
 flash_attn_func = None
 try:
     from flash_attn import flash_attn_func
@@ -70,16 +73,48 @@ class Qwen2SdpaAttention(Qwen2Attention):
         key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        if past_key_value is not None:
+        if hasattr(past_key_value, "videos"):
+            # several videos ingested in lock-step: projections run on the padded batch, attention on every video
+            # with its own tokens and sensory window, padding is left out
+            attn_output = torch.zeros_like(query_states)
+            for video_idx, (layer_cache, num_tokens) in enumerate(zip(past_key_value.videos, past_key_value.num_tokens)):
+                attn_output[video_idx : video_idx + 1, :, :num_tokens] = self._streaming_attention(
+                    query_states[video_idx : video_idx + 1, :, :num_tokens],
+                    key_states[video_idx : video_idx + 1, :, :num_tokens],
+                    value_states[video_idx : video_idx + 1, :, :num_tokens],
+                    layer_cache,
+                )
+            attn_output = attn_output.transpose(1, 2).contiguous().view(bsz, q_len, self.hidden_size)
+            return self.o_proj(attn_output), None, past_key_value
+
+        key_position_ids = None
+        keys_are_rotated = getattr(past_key_value, "stores_rotated_keys", False)
+        if keys_are_rotated:
+            # the cache holds keys after RoPE: only rotate the new tokens, at the positions given by the cache
+            cos, sin = rotary_cos_sin(self.rotary_emb.inv_freq, past_key_value.staged_position_ids(q_len, query_states.device), value_states.dtype)
+            query_states = apply_rotary_pos_emb(query_states, cos, sin)
+            key_states = apply_rotary_pos_emb(key_states, cos, sin)
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        elif hasattr(past_key_value, "update"):
+            # preallocated streaming cache: new kv is written in place, we get views over the live cache
+            key_states, value_states = past_key_value.update(key_states, value_states)
+            key_position_ids = past_key_value.key_position_ids(key_states.device)
+        elif past_key_value is not None:
             past_key_value = (
                 torch.cat([past_key_value[0], key_states], dim=2),
                 torch.cat([past_key_value[1], value_states], dim=2),
             )
+            key_states, value_states = past_key_value
         else:
             past_key_value = (key_states, value_states)
 
-        key_states, value_states = past_key_value
-        kv_seq_len = past_key_value[1].size(2)
+        if getattr(past_key_value, "staged_frames", 1) > 1:
+            # several frames in one forward, each of them attends to its own sensory window
+            attn_output = chunked_frame_attention(query_states, key_states, value_states, past_key_value, self.rotary_emb.inv_freq, self.num_key_value_groups)
+            attn_output = attn_output.transpose(1, 2).contiguous().view(bsz, q_len, self.hidden_size)
+            return self.o_proj(attn_output), None, past_key_value
+
+        kv_seq_len = value_states.size(2)
 
         if hasattr(self, "use_retrieval") and self.retrieval_topk > 0:
             # ! NOTE@sy: use retrieval
@@ -87,41 +122,64 @@ class Qwen2SdpaAttention(Qwen2Attention):
             del self.use_retrieval
             del self.retrieval_topk
 
-            img_mask = [1 if _ == "I" else 0 for _ in self.cache_modalities]
+            cache_modalities = self.cache_modalities
+            cold_memory = getattr(self, "cold_memory", None)
+            if cold_memory is not None:
+                del self.cold_memory
+                cache_modalities = cache_modalities + cold_memory.modalities
+
+            img_mask = [1 if _ == "I" else 0 for _ in cache_modalities]
             img_mask = torch.Tensor(img_mask).long().to(query_states.device)
             kvcache_lengths = self.cache_lengths
             kvcache_lengths.append(query_states.size(2))
-            sub_key_states = torch.split(repeat_kv(key_states, self.num_key_value_groups), kvcache_lengths, dim=2)[:-1]
-            sub_key_reprs = torch.cat([_.mean(dim=2).flatten(1, 2) for _ in sub_key_states], dim=0)
-            query_repr = query_states.mean(dim=2).flatten(1, 2)
-
-            query_subkey_sims = torch.cosine_similarity(query_repr, sub_key_reprs, dim=-1) * img_mask
+            # blocks (including the ones spilled to host memory or disk) are ranked on their unit mean keys, computed
+            # when they entered the memory. with GQA, summing the query heads of a group gives the dot product with the
+            # keys repeated over the group, whose norm is sqrt(groups) times the one of the keys
+            query_repr = query_states.mean(dim=2)
+            query_norm = query_repr.flatten(1).norm(dim=-1) * math.sqrt(self.num_key_value_groups)
+            query_repr = query_repr.unflatten(1, (self.num_key_value_heads, self.num_key_value_groups)).sum(2).flatten(1)
+
+            query_subkey_sims = torch.mv(self.cache_key_summaries, query_repr[0]) / query_norm[0].clamp_min(1e-8) * img_mask
             topk = torch.topk(query_subkey_sims, min(retrieval_topk, query_subkey_sims.size(0)), dim=-1)
             topk_indices = topk.indices.tolist()
 
+            paged_in = None
+            num_device_blocks = len(self.cache_modalities)
+            cold_indices = [_ - num_device_blocks for _ in topk_indices if _ >= num_device_blocks]
+            if len(cold_indices) > 0:
+                paged_in = cold_memory.fetch(self.layer_idx, cold_indices, key_states.device)
+
             splited_key_states = torch.split(key_states, kvcache_lengths, dim=2)
             splited_value_states = torch.split(value_states, kvcache_lengths, dim=2)
 
-            retrieved_key_states = []
-            retrieved_value_states = []
-
-            for blkidx in range(len(self.cache_modalities)):
+            # (block id, key, value), the ids give the temporal order of device and paged in blocks
+            block_ids = cold_memory.device_block_ids if cold_memory is not None else range(num_device_blocks)
+            retrieved = []
+            for blkidx in range(num_device_blocks):
                 if blkidx in topk_indices or self.cache_modalities[blkidx] == "T":
-                    retrieved_key_states.append(splited_key_states[blkidx])
-                    retrieved_value_states.append(splited_value_states[blkidx])
-            retrieved_key_states.append(splited_key_states[-1])
-            retrieved_value_states.append(splited_value_states[-1])
+                    retrieved.append((block_ids[blkidx], splited_key_states[blkidx], splited_value_states[blkidx]))
+            if paged_in is not None:
+                retrieved = sorted(retrieved + paged_in, key=lambda _: _[0])
+            retrieved_key_states = [_[1] for _ in retrieved] + [splited_key_states[-1]]
+            retrieved_value_states = [_[2] for _ in retrieved] + [splited_value_states[-1]]
             retrieved_key_states = torch.cat(retrieved_key_states, dim=2)
             retrieved_value_states = torch.cat(retrieved_value_states, dim=2)
             key_states = retrieved_key_states
             value_states = retrieved_value_states
             kv_seq_len = key_states.size(2)
             past_key_value = (key_states, value_states)
+            if attention_mask is not None and attention_mask.size(-1) < kv_seq_len:
+                # paged in blocks can make the retrieved kv longer than the device memory the mask was built for
+                attention_mask = torch.nn.functional.pad(attention_mask, (kv_seq_len - attention_mask.size(-1), 0))
             attention_mask = attention_mask[..., -kv_seq_len:].contiguous()
 
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-        query_states = apply_rotary_pos_emb(query_states, cos[-q_len:], sin[-q_len:])
-        key_states = apply_rotary_pos_emb(key_states, cos, sin)
+        if not keys_are_rotated:
+            cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+            query_states = apply_rotary_pos_emb(query_states, cos[-q_len:], sin[-q_len:])
+            if key_position_ids is None:
+                key_states = apply_rotary_pos_emb(key_states, cos, sin)
+            else:
+                key_states = apply_rotary_pos_emb(key_states, cos[key_position_ids], sin[key_position_ids])
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -137,7 +195,7 @@ class Qwen2SdpaAttention(Qwen2Attention):
             key_states = key_states.contiguous()
             value_states = value_states.contiguous()
 
-        if flash_attn_func is None:
+        if flash_attn_func is None or getattr(self, "has_padding", False):
             attn_output = torch.nn.functional.scaled_dot_product_attention(
                 query_states,
                 key_states,
@@ -163,6 +221,39 @@ class Qwen2SdpaAttention(Qwen2Attention):
 
         return attn_output, None, past_key_value
 
+    def _streaming_attention(self, query_states, key_states, value_states, layer_cache):
+        """
+        Attention of the new tokens of one video (BHQC, batch of 1) over its sensory window, a `StreamingLayerCache`
+        the new kv is written to. Same as the streaming cache path of `forward`, which has no retrieval either.
+        """
+        q_len = query_states.size(2)
+        if layer_cache.stores_rotated_keys:
+            cos, sin = rotary_cos_sin(self.rotary_emb.inv_freq, layer_cache.staged_position_ids(q_len, query_states.device), value_states.dtype)
+            query_states = apply_rotary_pos_emb(query_states, cos, sin)
+            key_states = apply_rotary_pos_emb(key_states, cos, sin)
+        key_states, value_states = layer_cache.update(key_states, value_states)
+
+        if layer_cache.staged_frames > 1:
+            return chunked_frame_attention(query_states, key_states, value_states, layer_cache, self.rotary_emb.inv_freq, self.num_key_value_groups)
+
+        kv_seq_len = value_states.size(2)
+        if not layer_cache.stores_rotated_keys:
+            cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+            key_position_ids = layer_cache.key_position_ids(key_states.device)
+            query_states = apply_rotary_pos_emb(query_states, cos[-q_len:], sin[-q_len:])
+            if key_position_ids is None:
+                key_states = apply_rotary_pos_emb(key_states, cos, sin)
+            else:
+                key_states = apply_rotary_pos_emb(key_states, cos[key_position_ids], sin[key_position_ids])
+
+        key_states = repeat_kv(key_states, self.num_key_value_groups)
+        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        if flash_attn_func is None:
+            # causal over the new tokens, which sit at the end of the window
+            attention_mask = torch.ones((q_len, kv_seq_len), dtype=torch.bool, device=query_states.device).tril(kv_seq_len - q_len)
+            return torch.nn.functional.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask=attention_mask)
+        return flash_attn_func(query_states.transpose(1, 2), key_states.transpose(1, 2), value_states.transpose(1, 2), causal=True).transpose(1, 2)
+
 
 def cambrian_qwen2_forward(
     self,
@@ -187,7 +278,15 @@ def cambrian_qwen2_forward(
     kv_cache = tuple()
     
     batch_size, seq_length, _ = inputs_embeds.size()
-    past_key_values_length = 0 if past_key_values is None else past_key_values[0][0].size(2)
+    if past_key_values is None:
+        past_key_values_length = 0
+    elif hasattr(past_key_values[0], "get_seq_length"):
+        past_key_values_length = past_key_values[0].get_seq_length()
+    else:
+        past_key_values_length = past_key_values[0][0].size(2)
+
+    # flash_attn only knows causal masks, padded batches go through SDPA with the 4d mask
+    has_padding = attention_mask is not None and not bool(attention_mask.all())
 
     attention_mask = _prepare_4d_causal_attention_mask_for_sdpa(
         attention_mask,
@@ -200,6 +299,7 @@ def cambrian_qwen2_forward(
     hidden_states = inputs_embeds
 
     for i, decoder_layer in enumerate(self.layers):
+        decoder_layer.self_attn.has_padding = has_padding
         layer_outputs = decoder_layer(
             hidden_states,
             attention_mask=attention_mask,
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the per-frame KV bookkeeping of the streaming Cambrian-S wrappers.
+
+Compares the original list-of-dicts layout (one dict per layer, every append/pop/downsample/torch.cat run
+once per layer) with the stacked layout of `StreamingKVCache` and `PagedKVMemory` ([layers, batch, heads,
+tokens, dim], one kernel for all layers). The LLM forward is not run: the kv a forward would produce is
+random, and only the cache operations around it are timed. Run it from the lmms-eval directory, e.g.
+
+    python scripts/benchmark_kv_layout.py --num_frames 600 --sensory_window_size 4
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+sys.path = ["."] + sys.path
+
+from lmms_eval.models.model_utils.paged_kv_memory import PagedKVMemory, consolidate_memory
+from lmms_eval.models.model_utils.streaming_kv_cache import StreamingKVCache
+from lmms_eval.models.simple.cambrians_vsr import downsample_cache_states
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_layers", type=int, default=28)
+    parser.add_argument("--num_kv_heads", type=int, default=4)
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--grid_size", type=int, default=8, help="Frames have grid_size x (grid_size + 1) tokens (with newline tokens).")
+    parser.add_argument("--prefix_len", type=int, default=32)
+    parser.add_argument("--num_frames", type=int, default=300)
+    parser.add_argument("--sensory_window_size", type=int, default=4)
+    parser.add_argument("--consolidation_mem_budget", type=int, default=8192)
+    parser.add_argument("--compression_downsample_ratio", type=int, default=2)
+    parser.add_argument("--surprise_threshold", type=float, default=0.5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def run_list_of_dicts(args, prefix, frames, scores, frame_size):
+    """Per-layer bookkeeping of the original wrappers (`drop` consolidation)."""
+    runtime_kv_cache = [{"key_states": [k], "value_states": [v], "lengths": [k.size(2)], "surprising_scores": [1.]} for k, v in prefix]
+    global_kv_cache = [{"key_states": [k], "value_states": [v], "lengths": [k.size(2)], "surprising_scores": [1.]} for k, v in prefix]
+
+    for (frame_keys, frame_values), surprisingness_score in zip(frames, scores):
+        # the kv the forward attends to
+        past_key_values = [(torch.cat(_["key_states"], dim=2), torch.cat(_["value_states"], dim=2)) for _ in runtime_kv_cache]
+
+        for layer_idx in range(args.num_layers):
+            runtime_kv_cache[layer_idx]["key_states"].append(frame_keys[layer_idx].clone())
+            runtime_kv_cache[layer_idx]["value_states"].append(frame_values[layer_idx].clone())
+            runtime_kv_cache[layer_idx]["lengths"].append(frame_keys[layer_idx].size(2))
+            runtime_kv_cache[layer_idx]["surprising_scores"].append(surprisingness_score)
+
+            if len(runtime_kv_cache[layer_idx]["key_states"]) > args.sensory_window_size + 1:
+                _key_states = runtime_kv_cache[layer_idx]["key_states"].pop(1)
+                _value_states = runtime_kv_cache[layer_idx]["value_states"].pop(1)
+                _surprising_score = runtime_kv_cache[layer_idx]["surprising_scores"].pop(1)
+                runtime_kv_cache[layer_idx]["lengths"].pop(1)
+                if args.compression_downsample_ratio > 1 and _surprising_score < args.surprise_threshold:
+                    _key_states = downsample_cache_states(_key_states, args.compression_downsample_ratio, frame_size)
+                    _value_states = downsample_cache_states(_value_states, args.compression_downsample_ratio, frame_size)
+
+                global_kv_cache[layer_idx]["key_states"].append(_key_states)
+                global_kv_cache[layer_idx]["value_states"].append(_value_states)
+                global_kv_cache[layer_idx]["lengths"].append(_key_states.size(2))
+                global_kv_cache[layer_idx]["surprising_scores"].append(_surprising_score)
+
+                if sum(global_kv_cache[layer_idx]["lengths"]) > args.consolidation_mem_budget:
+                    while True:
+                        index = min(range(1, len(global_kv_cache[layer_idx]["lengths"])), key=global_kv_cache[layer_idx]["surprising_scores"].__getitem__)
+                        for key in global_kv_cache[layer_idx]:
+                            global_kv_cache[layer_idx][key].pop(index)
+                        if sum(global_kv_cache[layer_idx]["lengths"]) < args.consolidation_mem_budget:
+                            break
+
+    return [(torch.cat(_["key_states"], dim=2), torch.cat(_["value_states"], dim=2)) for _ in global_kv_cache]
+
+
+def run_stacked(args, prefix, frames, scores, frame_size):
+    """Bookkeeping of the current wrappers: ring-buffer sensory window and paged global memory."""
+    runtime_kv_cache = StreamingKVCache(args.num_layers, window_size=args.sensory_window_size)
+    global_kv_cache = PagedKVMemory(args.num_layers, reserve_tokens=args.consolidation_mem_budget)
+    runtime_kv_cache.set_prefix(prefix)
+    global_kv_cache.append(torch.stack([k for k, _ in prefix]), torch.stack([v for _, v in prefix]), "T", 1., pinned=True)
+
+    for (frame_keys, frame_values), surprisingness_score in zip(frames, scores):
+        # what the patched attention does in every layer of the forward
+        for layer_idx, layer in enumerate(runtime_kv_cache.layers):
+            layer.update(frame_keys[layer_idx], frame_values[layer_idx])
+
+        block = runtime_kv_cache.commit("I", surprisingness_score)
+        if block is not None:
+            key_states, value_states = block.key_states, block.value_states
+            if args.compression_downsample_ratio > 1 and block.surprising_score < args.surprise_threshold:
+                key_states = downsample_cache_states(key_states, args.compression_downsample_ratio, frame_size)
+                value_states = downsample_cache_states(value_states, args.compression_downsample_ratio, frame_size)
+            global_kv_cache.append(key_states, value_states, block.modality, block.surprising_score)
+            consolidate_memory(global_kv_cache, "drop", args.consolidation_mem_budget, args.surprise_threshold)
+
+    return global_kv_cache.materialize()
+
+
+def main():
+    args = parse_args()
+    dtype = getattr(torch, args.dtype)
+    generator = torch.Generator().manual_seed(args.seed)
+    frame_len = args.grid_size * (args.grid_size + 1)
+
+    def random_kv(num_tokens):
+        shape = (1, args.num_kv_heads, num_tokens, args.head_dim)
+        return torch.randn(shape, generator=generator).to(args.device, dtype), torch.randn(shape, generator=generator).to(args.device, dtype)
+
+    prefix = [random_kv(args.prefix_len) for _ in range(args.num_layers)]
+    frames = []
+    for _ in range(args.num_frames):
+        kv = [random_kv(frame_len) for _ in range(args.num_layers)]
+        frames.append(([k for k, _ in kv], [v for _, v in kv]))
+    scores = torch.rand(args.num_frames, generator=generator).tolist()
+    frame_size = (args.grid_size, args.grid_size)
+
+    results = {}
+    for name, run in [("list-of-dicts", run_list_of_dicts), ("stacked", run_stacked)]:
+        run(args, prefix, frames[: args.sensory_window_size + 2], scores, frame_size)  # warm-up
+        synchronize(args.device)
+        start = time.perf_counter()
+        results[name] = run(args, prefix, frames, scores, frame_size)
+        synchronize(args.device)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>14}: {elapsed / args.num_frames * 1e3:.3f} ms/frame ({elapsed:.2f}s for {args.num_frames} frames)")
+
+    # both layouts must end up with the same global memory
+    for (key_states, value_states), (_key_states, _value_states) in zip(results["list-of-dicts"], results["stacked"]):
+        assert torch.equal(key_states, _key_states) and torch.equal(value_states, _value_states)
+    print(f"global memory: {results['stacked'][0][0].size(2)} tokens per layer, identical for both layouts")
+
+
+if __name__ == "__main__":
+    main()
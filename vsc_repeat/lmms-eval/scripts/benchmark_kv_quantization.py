@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the quantized storage of the consolidated memory of `cambrians_vsr` (`kv_quant_bits`).
+
+The same stream of frame blocks is consolidated into a `PagedKVMemory` with 16, 8 and 4-bit storage, under
+the same `--consolidation_mem_budget` (in fp16 tokens, so the quantized memories keep 2x and 4x the tokens).
+For every setting it reports the frames kept, the device memory of the pools, the time per frame of append
+and consolidation, the time to materialize the memory, and the error against the fp16 kv of the kept blocks,
+both on the kv and on the output of a random-query attention over it.
+
+Blocks are random by default. Recorded blocks of a real video are used with `--surprise_trace`, the path of
+an entry of the `surprise_trace_dir` of the wrapper. The LLM is not run. For the accuracy deltas on the VSR
+benchmarks see `scripts/vsr_kv_quant.sh`. Run it from the lmms-eval directory, e.g.
+
+    python scripts/benchmark_kv_quantization.py --num_frames 1200 --consolidation_mem_budget 16384
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+sys.path = ["."] + sys.path
+
+from lmms_eval.models.model_utils.paged_kv_memory import PagedKVMemory, consolidate_memory
+from lmms_eval.models.model_utils.streaming_kv_cache import StreamingBlock
+from lmms_eval.models.model_utils.surprise_trace import iter_surprise_trace, load_surprise_trace_prefix
+from lmms_eval.models.model_utils.visual_feature_store import FeatureEntry
+from lmms_eval.models.simple.cambrians_vsr import downsample_cache_states
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--surprise_trace", default="", help="Recorded frame blocks to use instead of random ones.")
+    parser.add_argument("--num_layers", type=int, default=28)
+    parser.add_argument("--num_kv_heads", type=int, default=4)
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--grid_size", type=int, default=8, help="Frames have grid_size x (grid_size + 1) tokens (with newline tokens).")
+    parser.add_argument("--prefix_len", type=int, default=32)
+    parser.add_argument("--num_frames", type=int, default=600)
+    parser.add_argument("--consolidation_mem_budget", type=int, default=8192)
+    parser.add_argument("--compression_downsample_ratio", type=int, default=2)
+    parser.add_argument("--surprise_threshold", type=float, default=0.5)
+    parser.add_argument("--num_query_heads", type=int, default=28)
+    parser.add_argument("--num_query_tokens", type=int, default=32)
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def load_blocks(args, generator):
+    """kv of the pre-image prompt (LBHTC), the frame blocks and the frame size."""
+    if args.surprise_trace:
+        trace = FeatureEntry(args.surprise_trace)
+        prefix = load_surprise_trace_prefix(trace, args.device)
+        blocks = [block for _, block in zip(range(args.num_frames), iter_surprise_trace(trace, args.device))]
+        return prefix, blocks, trace.meta["frame_size"]
+
+    def random_kv(num_tokens):
+        shape = (args.num_layers, 1, args.num_kv_heads, num_tokens, args.head_dim)
+        return torch.randn(shape, generator=generator).to(args.device, torch.float16), torch.randn(shape, generator=generator).to(args.device, torch.float16)
+
+    frame_len = args.grid_size * (args.grid_size + 1)
+    scores = torch.rand(args.num_frames, generator=generator).tolist()
+    blocks = [StreamingBlock(*random_kv(frame_len), "I", frame_len, score) for score in scores]
+    return random_kv(args.prefix_len), blocks, [args.grid_size, args.grid_size]
+
+
+def consolidate(args, quant_bits, prefix, blocks, frame_size):
+    """The memory and the fp16 kv every block was appended with, as `_consolidate_block` builds it (`drop` consolidation)."""
+    memory = PagedKVMemory(args.num_layers, reserve_tokens=args.consolidation_mem_budget * 16 // quant_bits, quant_bits=quant_bits)
+    appended = {memory.append(*prefix, "T", 1., pinned=True): prefix}
+    for block in blocks:
+        key_states, value_states = block.key_states, block.value_states
+        if args.compression_downsample_ratio > 1 and block.surprising_score < args.surprise_threshold:
+            key_states = downsample_cache_states(key_states, args.compression_downsample_ratio, frame_size)
+            value_states = downsample_cache_states(value_states, args.compression_downsample_ratio, frame_size)
+        appended[memory.append(key_states, value_states, block.modality, block.surprising_score)] = (key_states, value_states)
+        consolidate_memory(memory, "drop", args.consolidation_mem_budget * 16 // quant_bits, args.surprise_threshold)
+    return memory, appended
+
+
+def pool_bytes(memory):
+    return sum(pool.nbytes for pool in [memory.key_pool, memory.value_pool, memory.value_scale_pool] if pool is not None)
+
+
+def attention(query_states, key_states, value_states):
+    # every query head of a group attends to the same kv head
+    num_groups = query_states.size(1) // key_states.size(1)
+    return torch.nn.functional.scaled_dot_product_attention(query_states, key_states.repeat_interleave(num_groups, dim=1), value_states.repeat_interleave(num_groups, dim=1))
+
+
+def main():
+    args = parse_args()
+    generator = torch.Generator().manual_seed(args.seed)
+    prefix, blocks, frame_size = load_blocks(args, generator)
+    num_layers, _, num_kv_heads, _, head_dim = prefix[0].shape
+    args.num_layers = num_layers
+    query_states = torch.randn((1, args.num_query_heads, args.num_query_tokens, head_dim), generator=generator).to(args.device, torch.float16)
+
+    print(f"{len(blocks)} frames, budget of {args.consolidation_mem_budget} fp16 tokens")
+    for quant_bits in [16, 8, 4]:
+        consolidate(args, quant_bits, prefix, blocks[: 4], frame_size)  # warm-up
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        memory, appended = consolidate(args, quant_bits, prefix, blocks, frame_size)
+        torch.cuda.synchronize()
+        ingest_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        past_key_values = memory.materialize()
+        torch.cuda.synchronize()
+        materialize_time = time.perf_counter() - start
+
+        # the error against the fp16 kv of the same blocks
+        kv_error, output_error = 0., 0.
+        for layer_idx, (key_states, value_states) in enumerate(past_key_values):
+            reference_key_states = torch.cat([appended[block_id][0][layer_idx] for block_id in memory.index], dim=2)
+            reference_value_states = torch.cat([appended[block_id][1][layer_idx] for block_id in memory.index], dim=2)
+            for a, b in [(reference_key_states, key_states), (reference_value_states, value_states)]:
+                kv_error = max(kv_error, ((a.float() - b.float()).norm() / a.float().norm()).item())
+            reference_output = attention(query_states, reference_key_states, reference_value_states).float()
+            output = attention(query_states, key_states, value_states).float()
+            output_error = max(output_error, ((reference_output - output).norm() / reference_output.norm()).item())
+
+        print(
+            f"{quant_bits:>2} bits: {len(memory) - 1:>5} frames / {memory.total_length:>6} tokens kept, "
+            f"pools {pool_bytes(memory) / 2**20:8.1f} MiB, "
+            f"{ingest_time / len(blocks) * 1e3:.3f} ms/frame, materialize {materialize_time * 1e3:.1f} ms, "
+            f"max rel. error kv {kv_error:.4f} / attention output {output_error:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Checks the chunked ingest of `cambrians_vsr` (`ingest_chunk_frames > 1`, several frames prefilled per forward)
+against the frame-by-frame ingest it replaces, and times both. The first `--num_frames` frames of `--video`
+are ingested both ways; the surprise scores of all frames and the memory both ingests build must agree within
+the given tolerances. Run it from the lmms-eval directory, e.g.
+
+    python scripts/check_chunked_prefill.py --video /path/to/video.mp4 --chunk_frames 16 \\
+        --model_args pretrained=ShushengYang/Cambrian-S-7B-LFP,sensory_window_size=32
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+sys.path = ["../"] + sys.path
+
+from cambrian.constants import DEFAULT_IMAGE_TOKEN, IMAGE_TOKEN_INDEX
+from cambrian.conversation import conv_templates
+from cambrian.mm_utils import tokenizer_image_token
+
+from lmms_eval.models import get_model
+from lmms_eval.models.model_utils.streaming_kv_cache import StreamingKVCache
+from lmms_eval.models.simple.cambrians_vsr import process_videos_vsr
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--model_args", default="")
+    parser.add_argument("--num_frames", type=int, default=256)
+    parser.add_argument("--chunk_frames", type=int, default=16)
+    parser.add_argument("--score_atol", type=float, default=1e-2, help="On the surprise score of every frame.")
+    parser.add_argument("--memory_rtol", type=float, default=2e-2, help="On the relative norm of the difference of the memory kv.")
+    return parser.parse_args()
+
+
+def ingest(lm, input_ids, visual_tensors, visual_sizes, chunk_frames):
+    """Memory of the video and the surprise score of every frame, with `chunk_frames` frames per forward."""
+    surprising_scores = []
+    commit_frames = StreamingKVCache.commit_frames
+
+    def recording_commit_frames(cache, modality, scores):
+        surprising_scores.extend(scores)
+        return commit_frames(cache, modality, scores)
+
+    lm.ingest_chunk_frames = chunk_frames
+    StreamingKVCache.commit_frames = recording_commit_frames
+    try:
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.inference_mode():
+            past_key_values, modalities, lengths, _, _ = lm._build_memory(input_ids, "raw", visual_tensors, visual_sizes, None, None)
+        torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    finally:
+        StreamingKVCache.commit_frames = commit_frames
+    return past_key_values, modalities, lengths, surprising_scores, elapsed
+
+
+def main():
+    args = parse_args()
+    lm = get_model("cambrians_vsr").create_from_arg_string(args.model_args)
+
+    # the attention patches generate_until applies before ingesting
+    from qwen2_monkey_patch import Qwen2SdpaAttention, cambrian_qwen2_forward
+    from cambrian.model.language_model.cambrian_qwen2 import CambrianQwenModel
+    for layer in lm.model.model.layers:
+        layer.self_attn.__class__ = Qwen2SdpaAttention
+    CambrianQwenModel.forward = cambrian_qwen2_forward
+
+    conv = conv_templates[lm.conv_template].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + "\n" + "What happens in the video?")
+    conv.append_message(conv.roles[1], None)
+    input_ids = tokenizer_image_token(conv.get_prompt(), lm.tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to(lm.device)
+
+    visual_tensors, visual_sizes, _ = process_videos_vsr([args.video], lm._image_processor, lm._config)
+    visual_tensors = [video_aux[:, : args.num_frames] for video_aux in visual_tensors]
+    visual_sizes = [(width, height, visual_tensors[0].size(1)) for width, height, _ in visual_sizes]
+
+    reference = ingest(lm, input_ids, visual_tensors, visual_sizes, 1)
+    chunked = ingest(lm, input_ids, visual_tensors, visual_sizes, args.chunk_frames)
+
+    num_frames = len(reference[3])
+    print(f"frame by frame: {reference[4]:.2f}s ({num_frames / reference[4]:.1f} frames/s)")
+    print(f"{args.chunk_frames:>3} per forward: {chunked[4]:.2f}s ({num_frames / chunked[4]:.1f} frames/s), {reference[4] / chunked[4]:.2f}x")
+
+    score_diff = max(abs(a - b) for a, b in zip(reference[3], chunked[3]))
+    print(f"max abs diff of the surprise scores: {score_diff:.5f}")
+    assert len(reference[3]) == len(chunked[3]) and score_diff <= args.score_atol, f"surprise scores differ by more than {args.score_atol}"
+
+    assert list(reference[1]) == list(chunked[1]) and list(reference[2]) == list(chunked[2]), "the memories differ in layout, a score close to surprise_threshold was probably flipped"
+    memory_diff = 0.
+    for (reference_keys, reference_values), (chunked_keys, chunked_values) in zip(reference[0], chunked[0]):
+        for a, b in [(reference_keys, chunked_keys), (reference_values, chunked_values)]:
+            memory_diff = max(memory_diff, ((a.float() - b.float()).norm() / a.float().norm()).item())
+    print(f"max relative diff of the memory kv: {memory_diff:.5f}")
+    assert memory_diff <= args.memory_rtol, f"memory kv differs by more than {args.memory_rtol}"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Checks the batched tensor preprocessing of the Cambrian-S video wrappers (`preprocess_video_tensor`) against
+the per-frame PIL path of the SigLIP processor it replaces, and times both. Frames are decoded from `--video`
+or drawn at random. Run it from the lmms-eval directory, e.g.
+
+    python scripts/check_tensor_preprocess.py --video /path/to/video.mp4 --num_frames 256
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path = ["../"] + sys.path
+
+from cambrian.mm_utils import expand2square, expand2square_video, preprocess_video_tensor
+from cambrian.model.multimodal_encoder.llava_next_siglip_encoder import SigLipImageProcessor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video", default="", help="Decode the first frames of this video instead of using random ones.")
+    parser.add_argument("--num_frames", type=int, default=128)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--pad_to_square", action="store_true", help="Pad to square with the mean color first, like `process_videos`.")
+    parser.add_argument("--atol", type=float, default=2 * 2 / 255, help="Two uint8 levels after normalization with std 0.5.")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.video:
+        from decord import VideoReader, cpu
+        vr = VideoReader(args.video, ctx=cpu(0))
+        video = vr.get_batch(list(range(min(args.num_frames, len(vr))))).asnumpy()
+    else:
+        video = np.random.default_rng(args.seed).integers(0, 256, (args.num_frames, args.height, args.width, 3), dtype=np.uint8)
+    processor = SigLipImageProcessor()
+    background_color = tuple(int(x*255) for x in processor.image_mean)
+
+    start = time.perf_counter()
+    images = [Image.fromarray(video[_], mode="RGB") for _ in range(video.shape[0])]
+    if args.pad_to_square:
+        images = [expand2square(image, background_color) for image in images]
+    pil_pixel_values = processor.preprocess(images, return_tensors="pt")["pixel_values"]
+    pil_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    frames = torch.from_numpy(video)
+    if args.pad_to_square:
+        frames = expand2square_video(frames, background_color)
+    tensor_pixel_values = preprocess_video_tensor(frames, processor)
+    tensor_elapsed = time.perf_counter() - start
+
+    assert pil_pixel_values.shape == tensor_pixel_values.shape, (pil_pixel_values.shape, tensor_pixel_values.shape)
+    diff = (pil_pixel_values - tensor_pixel_values).abs()
+    print(f"   pil: {pil_elapsed / video.shape[0] * 1e3:.3f} ms/frame")
+    print(f"tensor: {tensor_elapsed / video.shape[0] * 1e3:.3f} ms/frame ({torch.get_num_threads()} threads)")
+    print(f"max abs diff: {diff.max().item():.5f}, mean abs diff: {diff.mean().item():.6f}")
+    assert diff.max().item() <= args.atol, f"tensor preprocessing differs from the PIL path by more than {args.atol}"
+
+
+if __name__ == "__main__":
+    main()
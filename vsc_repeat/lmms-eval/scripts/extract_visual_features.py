@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Pre-populates the visual feature store of the Cambrian-S streaming wrappers (`cambrians_vsr`, `cambrians_vsc`)
+for the videos of one or more tasks, so evaluation runs start directly from features instead of decoding and
+encoding every video while the LLM waits.
+
+Videos are decoded and preprocessed in a pool of `--num_workers` DataLoader processes, exactly as the wrapper
+ingests them, and their frames are encoded in batches of `--encode_batch_size` frames that may span several
+videos. Every video is written to the store once all of its frames are encoded, so an interrupted run is resumed
+by running it again: videos already in the store are skipped. Under `accelerate launch` every process extracts
+its share of the videos.
+
+`--model_args` must match the ones of the evaluation (`video_max_frames`, `video_fps`, `miv_token_len`, ...),
+since the features are keyed by them. Run it from the lmms-eval directory, e.g.
+
+    python scripts/extract_visual_features.py --model cambrians_vsr --tasks cambrians_vsr_240mins \\
+        --model_args pretrained=ShushengYang/Cambrian-S-7B-LFP,miv_token_len=64 --num_workers 8
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+from loguru import logger as eval_logger
+from tqdm import tqdm
+
+sys.path = ["../"] + sys.path
+
+from cambrian.mm_utils import process_videos
+
+from lmms_eval.models import get_model
+from lmms_eval.models.simple.cambrians_vsr import VideoFrameStream
+from lmms_eval.tasks import TaskManager, get_task_dict
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="cambrians_vsr", choices=["cambrians_vsr", "cambrians_vsc"])
+    parser.add_argument("--model_args", default="")
+    parser.add_argument("--tasks", required=True, help="Comma-separated task or group names.")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first videos of every task.")
+    parser.add_argument("--num_workers", type=int, default=8, help="Decoding processes.")
+    parser.add_argument("--decode_chunk_size", type=int, default=128, help="Frames a worker decodes and hands over at once.")
+    parser.add_argument("--encode_batch_size", type=int, default=512, help="Frames encoded together.")
+    return parser.parse_args()
+
+
+def iter_task_docs(task_dict):
+    for task in task_dict.values():
+        if isinstance(task, dict):
+            yield from iter_task_docs(task)
+            continue
+        if isinstance(task, tuple):
+            _, task = task
+        if task is not None:
+            yield from ((task, doc) for doc in task.eval_docs)
+
+
+def collect_video_paths(task_dict, limit=None):
+    """Unique video paths of all docs of the tasks, in order."""
+    video_paths, num_docs = {}, {}
+    for task, doc in iter_task_docs(task_dict):
+        num_docs[task] = num_docs.get(task, 0) + 1
+        if limit is not None and num_docs[task] > limit:
+            continue
+        visuals = task.doc_to_visual(doc)
+        assert visuals is not None and len(visuals) == 1 and isinstance(visuals[0], str), f"{task.config.task}: expected a single video per doc, got {visuals}"
+        video_paths.setdefault(visuals[0], None)
+    return list(video_paths)
+
+
+class VideoChunkDataset(torch.utils.data.IterableDataset):
+    """
+    Preprocessed frames of the videos, `chunk_size` at a time. Every worker decodes its own videos, one after
+    the other, and the chunks of a video come in order with the last one flagged.
+    """
+
+    def __init__(self, model, video_paths, image_processor, model_config, chunk_size):
+        self.model = model
+        self.video_paths = video_paths
+        self.image_processor = image_processor
+        self.model_config = model_config
+        self.chunk_size = chunk_size
+
+    def _iter_chunks(self, video_path):
+        if self.model == "cambrians_vsr":
+            # all frames, through the same stream the wrapper ingests, decoding the next chunk while this one is handed over
+            stream = VideoFrameStream(video_path, self.image_processor[0], chunk_size=self.chunk_size, prefetch=1, num_threads=1, decode_downscale=getattr(self.model_config, "video_decode_downscale", False))
+            for pixel_values in stream:
+                yield pixel_values, stream.video_size
+        else:
+            visual_tensors, visual_sizes, _ = process_videos([video_path], self.image_processor, self.model_config, num_threads=1)
+            for pixel_values in visual_tensors[0].flatten(0, 1).split(self.chunk_size):
+                yield pixel_values, visual_sizes[0]
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for video_index in range(worker_id, len(self.video_paths), num_workers):
+            chunks = self._iter_chunks(self.video_paths[video_index])
+            chunk = next(chunks, None)
+            while chunk is not None:
+                next_chunk = next(chunks, None)
+                pixel_values, video_size = chunk
+                yield {"video_index": video_index, "pixel_values": pixel_values, "video_size": list(video_size), "last": next_chunk is None}
+                chunk = next_chunk
+
+
+def main():
+    args = parse_args()
+    lm = get_model(args.model).create_from_arg_string(args.model_args, {"enable_visual_feature_caching": True})
+    store = lm.visual_feature_store
+
+    task_dict = get_task_dict(args.tasks.split(","), TaskManager(model_name=args.model))
+    video_paths = collect_video_paths(task_dict, args.limit)[lm.rank :: lm.world_size]
+    keys = [lm._visual_feature_key(video_path) for video_path in video_paths]
+    todo = [_ for _, key in enumerate(keys) if key not in store]
+    eval_logger.info(f"{len(video_paths)} videos, {len(video_paths) - len(todo)} already in {store.root}, extracting {len(todo)}")
+
+    dataset = VideoChunkDataset(args.model, [video_paths[_] for _ in todo], lm._image_processor, lm._config, args.decode_chunk_size)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=args.num_workers, prefetch_factor=2 if args.num_workers > 0 else None)
+
+    writers, video_sizes = {}, {}
+    pending, num_pending = [], 0
+    num_frames, decode_time, encode_time = 0, 0., 0.
+    pbar = tqdm(total=len(todo), disable=(lm.rank != 0), desc="Extracting visual features")
+
+    def flush():
+        # encode the pending chunks in one batch, then hand every video its frames
+        nonlocal pending, num_pending, num_frames, encode_time
+        start = time.perf_counter()
+        with torch.inference_mode():
+            features, vit_features = lm._encode_frames(torch.cat([chunk["pixel_values"] for chunk in pending]))
+        offset = 0
+        for chunk in pending:
+            key = keys[todo[chunk["video_index"]]]
+            length = chunk["pixel_values"].size(0)
+            writers[key].append("features", features[offset : offset + length])
+            writers[key].append("vit_features", vit_features[offset : offset + length])
+            offset += length
+            if chunk["last"]:
+                writers.pop(key).finish({"visual_sizes": [video_sizes.pop(key)]})
+                pbar.update(1)
+        torch.cuda.synchronize()
+        encode_time += time.perf_counter() - start
+        num_frames += num_pending
+        pending, num_pending = [], 0
+        pbar.set_postfix(frames_per_s=f"{num_frames / (decode_time + encode_time):.1f}")
+
+    start_time = time.perf_counter()
+    try:
+        start = time.perf_counter()
+        for chunk in dataloader:
+            decode_time += time.perf_counter() - start
+            key = keys[todo[chunk["video_index"]]]
+            if key not in writers:
+                writers[key] = store.writer(key)
+                video_sizes[key] = chunk["video_size"]
+            pending.append(chunk)
+            num_pending += chunk["pixel_values"].size(0)
+            if num_pending >= args.encode_batch_size:
+                flush()
+            start = time.perf_counter()
+        if len(pending) > 0:
+            flush()
+    finally:
+        # videos that were not complete are not stored, and are extracted again by the next run
+        for writer in writers.values():
+            writer.abort()
+    pbar.close()
+
+    elapsed = time.perf_counter() - start_time
+    eval_logger.info(f"extracted {len(todo)} videos, {num_frames} frames in {elapsed:.1f}s ({num_frames / max(elapsed, 1e-6):.1f} frames/s)")
+    eval_logger.info(f"waiting for decoded frames: {decode_time:.1f}s, encoding and writing: {encode_time:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
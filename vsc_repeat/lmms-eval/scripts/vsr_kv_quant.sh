@@ -0,0 +1,45 @@
+if [ -z "$CUDA_VISIBLE_DEVICES" ]; then
+    export CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7
+else
+    export CUDA_VISIBLE_DEVICES=$CUDA_VISIBLE_DEVICES
+fi
+export DECORD_EOF_RETRY_MAX=20480 # videommu and hourvideo require this
+
+if [ -z "$CUDA_VISIBLE_DEVICES" ]; then
+    num_processes=$(nvidia-smi --query-gpu=index --format=csv,noheader | wc -l)
+else
+    IFS=',' read -r -a devices <<< "$CUDA_VISIBLE_DEVICES"
+    num_processes=${#devices[@]}
+fi
+
+checkpoint="ShushengYang/Cambrian-S-7B-LFP"
+benchmark=${BENCHMARK:-cambrians_vsr_240mins}
+consolidation_mem_budget=${CONSOLIDATION_MEM_BUDGET:-16384}
+output_root=logs/$(basename $checkpoint)/${benchmark}_kv_quant
+
+# the same consolidation_mem_budget with 16, 8 and 4-bit memory, the quantized runs keep 2x and 4x the tokens.
+# traces are shared between the runs, so only the first one ingests the videos. they are kept in fp16 so that the
+# 16-bit run stays an exact baseline, ~4 MiB per frame: videos whose trace grows past surprise_trace_max_gb are
+# not traced and get ingested by every run.
+surprise_trace_dir=${SURPRISE_TRACE_DIR:-.cache/$checkpoint/surprise_traces}
+surprise_trace_max_gb=${SURPRISE_TRACE_MAX_GB:-16}
+
+for kv_quant_bits in 16 8 4; do
+    bash evaluate_all_in_one.sh --model cambrians_vsr --benchmark $benchmark --num_processes ${num_processes:-1} --num_frames ${NUM_FRAMES:-128} --pretrained $checkpoint --miv_token_len ${MIV_TOKEN_LEN:-64} --si_token_len ${SI_TOKEN_LEN:-729} --sensory_window_size 32 --compression_downsample_ratio 2 --consolidation_method drop --retrieval_topk 32 --enable_visual_feature_caching True --surprise_threshold 0.35 --consolidation_mem_budget $consolidation_mem_budget --kv_quant_bits $kv_quant_bits --surprise_trace_dir $surprise_trace_dir --surprise_trace_quant_bits 16 --surprise_trace_max_gb $surprise_trace_max_gb --output_path $output_root/b${kv_quant_bits}
+done
+
+# accuracy of every task against the fp16 memory
+python - $output_root <<'PY'
+import glob, json, os, sys
+
+def load(bits):
+    paths = sorted(glob.glob(os.path.join(sys.argv[1], f"b{bits}", "**", "*_results.json"), recursive=True), key=os.path.getmtime)
+    return json.load(open(paths[-1]))["results"] if paths else {}
+
+results = {bits: load(bits) for bits in [16, 8, 4]}
+for task, metrics in results[16].items():
+    for metric, value in metrics.items():
+        if isinstance(value, (int, float)) and "stderr" not in metric:
+            deltas = ", ".join(f"{bits} bits {results[bits].get(task, {}).get(metric, float('nan')) - value:+.4f}" for bits in [8, 4])
+            print(f"{task} {metric}: 16 bits {value:.4f}, {deltas}")
+PY
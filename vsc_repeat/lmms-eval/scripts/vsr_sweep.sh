@@ -0,0 +1,34 @@
+if [ -z "$CUDA_VISIBLE_DEVICES" ]; then
+    export CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7
+else
+    export CUDA_VISIBLE_DEVICES=$CUDA_VISIBLE_DEVICES
+fi
+export DECORD_EOF_RETRY_MAX=20480 # videommu and hourvideo require this
+
+if [ -z "$CUDA_VISIBLE_DEVICES" ]; then
+    num_processes=$(nvidia-smi --query-gpu=index --format=csv,noheader | wc -l)
+else
+    IFS=',' read -r -a devices <<< "$CUDA_VISIBLE_DEVICES"
+    num_processes=${#devices[@]}
+fi
+
+checkpoint="ShushengYang/Cambrian-S-7B-LFP"
+benchmark=${BENCHMARK:-cambrians_vsr_240mins}
+sensory_window_size=${SENSORY_WINDOW_SIZE:-32}
+
+# the first run ingests every video and records the frame blocks leaving the sensory window, all later runs
+# replay them, so only consolidation and the questions are run again. traces are only shared between runs with
+# the same sensory window (and video and model settings). frame blocks are traced as 8-bit codes, ~2 MiB per frame
+# or ~28 GiB for a 240-minute video, videos whose trace grows past surprise_trace_max_gb are not traced.
+surprise_trace_dir=${SURPRISE_TRACE_DIR:-.cache/$checkpoint/surprise_traces}
+surprise_trace_max_gb=${SURPRISE_TRACE_MAX_GB:-32}
+
+for surprise_threshold in 0.25 0.3 0.35 0.4; do
+for consolidation_method in drop drop_merge; do
+for consolidation_mem_budget in 16384 32768; do
+for retrieval_topk in 32 128; do
+    bash evaluate_all_in_one.sh --model cambrians_vsr --benchmark $benchmark --num_processes ${num_processes:-1} --num_frames ${NUM_FRAMES:-128} --pretrained $checkpoint --miv_token_len ${MIV_TOKEN_LEN:-64} --si_token_len ${SI_TOKEN_LEN:-729} --sensory_window_size $sensory_window_size --compression_downsample_ratio 2 --consolidation_method $consolidation_method --retrieval_topk $retrieval_topk --enable_visual_feature_caching True --surprise_threshold $surprise_threshold --consolidation_mem_budget $consolidation_mem_budget --surprise_trace_dir $surprise_trace_dir --surprise_trace_max_gb $surprise_trace_max_gb --output_path logs/$(basename $checkpoint)/${benchmark}_sweep/w${sensory_window_size}_t${surprise_threshold}_${consolidation_method}_m${consolidation_mem_budget}_k${retrieval_topk}
+done
+done
+done
+done